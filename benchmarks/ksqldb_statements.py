@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of the client CPU spent preparing `utils.ksqldb()` requests, no ksqlDB
+server required.
+
+Compares, per call, the former preparation (chained `str.replace`, `while "  " in`
+loop, headers/payload dicts rebuilt and JSON-encoded every time) with the cached
+one (`utils.prepare_ksqldb_statement`: linear normalization, body encoded once per
+raw statement), for a short repeated statement (health check) and a large DDL.
+
+Usage:
+    python benchmarks/ksqldb_statements.py [--calls N] [--ddl-columns N] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEALTH_CHECK = """
+    SHOW   STREAMS;
+"""
+
+
+def large_ddl(columns: int) -> str:
+    fields = ",\n".join(f"\t\tFIELD_{n}    VARCHAR" for n in range(columns))
+    return f"""
+        CREATE STREAM IF NOT EXISTS PIZZA_BENCHMARK (
+            ORDER_ID   VARCHAR KEY,
+{fields}
+        ) WITH (
+            KAFKA_TOPIC='pizza-benchmark',      VALUE_FORMAT='JSON'
+        );{" " * 64}
+    """
+
+
+def legacy_prepare(statement: str, offset_reset_earliest: bool = True) -> tuple:
+    """Request preparation of utils.ksqldb() before the statement cache"""
+    statement = statement.replace("\r", " ")
+    statement = statement.replace("\t", " ")
+    statement = statement.replace("\n", " ")
+    while statement.find("  ") > -1:
+        statement = statement.replace("  ", " ")
+    headers = {
+        "Accept": "application/vnd.ksql.v1+json",
+        "Content-Type": "application/vnd.ksql.v1+json; charset=utf-8",
+    }
+    payload = {
+        "ksql": statement,
+        "streamsProperties": {
+            "ksql.streams.auto.offset.reset": "earliest"
+            if offset_reset_earliest
+            else "latest",
+            "ksql.streams.cache.max.bytes.buffering": "0",
+        },
+    }
+    # Encoded by requests (`json=payload`) on every call
+    return statement, headers, json.dumps(payload).encode()
+
+
+def time_calls(function, statement: str, calls: int) -> float:
+    """Average microseconds per call"""
+    started = time.perf_counter()
+    for _ in range(calls):
+        function(statement)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the ksqlDB statement preparation")
+    parser.add_argument("--calls", type=int, default=20000, help="calls per statement")
+    parser.add_argument("--ddl-columns", type=int, default=500, help="number of columns of the large DDL")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import utils
+
+    report = dict()
+    for name, statement in (
+        ("health_check", HEALTH_CHECK),
+        ("large_ddl", large_ddl(args.ddl_columns)),
+    ):
+        legacy_statement, _, legacy_body = legacy_prepare(statement)
+        cached_statement, cached_body = utils.prepare_ksqldb_statement(statement)
+        assert (legacy_statement, legacy_body) == (cached_statement, cached_body), name
+
+        utils.prepare_ksqldb_statement.cache_clear()
+        started = time.perf_counter()
+        utils.prepare_ksqldb_statement(statement)
+        first_call = (time.perf_counter() - started) * 1e6
+
+        legacy = time_calls(legacy_prepare, statement, args.calls)
+        cached = time_calls(utils.prepare_ksqldb_statement, statement, args.calls)
+        report[name] = {
+            "statement_bytes": len(statement),
+            "legacy_us": round(legacy, 3),
+            "first_call_us": round(first_call, 3),
+            "cached_us": round(cached, 3),
+            "speedup": round(legacy / cached, 1),
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, stats in report.items():
+            print(
+                f"- {name:<13} {stats['statement_bytes']:>7} bytes  legacy={stats['legacy_us']:>10.3f} us"
+                f"  first={stats['first_call_us']:>10.3f} us  cached={stats['cached_us']:>7.3f} us  (x{stats['speedup']})"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
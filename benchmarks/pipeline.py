@@ -0,0 +1,278 @@
+"""
+Offline end-to-end benchmark of the pizza pipeline, no Kafka cluster required.
+
+msvc_assemble, msvc_bake and msvc_status run in threads of this process against the
+in-process broker (utils.fake_kafka, see config_kafka/benchmark.ini), fed with
+synthetic orders built from the [pizza] section of the system configuration. A
+ksqlDB stand-in forwards pizza-assembled/pizza-baked events to pizza-status.
+
+Reports events/sec, p50/p99 latency per stage (time from an event being appended to
+a topic until the consuming service commits its offset), end-to-end order latency,
+the per-hop latencies traced by msvc_status (trace context headers) and the number
+of SQLite write statements/commits.
+
+Usage:
+    python benchmarks/pipeline.py [--orders N] [--sleep-scale X] [--sys-config FILE] [--json]
+
+`--sleep-scale` multiplies the simulated work (time.sleep) of the services, it
+defaults to 0 so only the pipeline overhead is measured.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import tempfile
+import importlib
+import threading
+
+from collections import Counter, defaultdict
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KAFKA_CONFIG = "benchmark.ini"
+FORWARDER_GROUP = "benchmark_ksqldb"
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class ScaledTime:
+    """Replaces the `time` module of a service, scaling down `time.sleep`"""
+
+    def __init__(self, scale: float):
+        self.scale = scale
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds * self.scale)
+
+
+class CountingSqlite3:
+    """Replaces the `sqlite3` module of utils.db.sqlite, counting write statements and commits"""
+
+    WRITES = ("INSERT", "UPDATE", "DELETE", "COMMIT")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def __getattr__(self, name):
+        return getattr(sqlite3, name)
+
+    def connect(self, *args, **kwargs):
+        conn = sqlite3.connect(*args, **kwargs)
+        conn.set_trace_callback(self.trace)
+        return conn
+
+    def trace(self, statement: str):
+        verb = statement.lstrip()[:6].upper()
+        if verb in self.WRITES:
+            with self.lock:
+                self.counts[verb] += 1
+
+
+class StageLatency:
+    """Broker commit hook recording, per stage, the time from append to commit"""
+
+    def __init__(self, stages: dict, final_status: int):
+        self.stages = stages
+        self.final_status = final_status
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.ordered_at = dict()
+        self.end_to_end = list()
+        self.done = threading.Event()
+        self.expected = 0
+
+    def __call__(self, group: str, topic: str, partition: int, messages: list):
+        stage = self.stages.get((group, topic))
+        if stage is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.latencies[stage].extend(now - msg.appended_at for msg in messages)
+            if stage == "status":
+                for msg in messages:
+                    if json.loads(msg.value()).get("STATUS") == self.final_status:
+                        ordered_at = self.ordered_at.pop(msg.key(), None)
+                        if ordered_at is not None:
+                            self.end_to_end.append(now - ordered_at)
+                if self.expected and len(self.end_to_end) >= self.expected:
+                    self.done.set()
+
+
+def forward_status(consumer, producer, status_topic: str):
+    """ksqlDB stand-in: pizza-assembled/pizza-baked -> pizza-status ({"STATUS": status} as JSON, trace headers kept)"""
+    from utils.serialization import FORMAT_HEADER, deserialize
+
+    while True:
+        for msg in consumer.consume(500, 1):
+            producer.produce(
+                status_topic,
+                key=msg.key(),
+                value=json.dumps({"STATUS": deserialize(msg)["status"]}).encode(),
+                headers=[header for header in msg.headers() or list() if header[0] != FORMAT_HEADER],
+            )
+            consumer.commit(message=msg)
+        producer.poll(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the pizza pipeline")
+    parser.add_argument("--orders", type=int, default=1000, help="number of synthetic orders")
+    parser.add_argument("--sleep-scale", type=float, default=0, help="scale of the simulated work (time.sleep)")
+    parser.add_argument("--sys-config", default="default.ini", help="file under config_sys/")
+    parser.add_argument("--timeout", type=float, default=300, help="maximum run time (seconds)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic orders")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    # Run from a scratch folder (logs, pid and state store files) sharing the repository configuration
+    workdir = tempfile.mkdtemp(prefix="pizza_benchmark_")
+    for folder in ("config_kafka", "config_sys"):
+        os.symlink(os.path.join(ROOT, folder), os.path.join(workdir, folder))
+    os.makedirs(os.path.join(workdir, "logs"))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    sys.argv = [sys.argv[0], KAFKA_CONFIG, args.sys_config]
+    logging.basicConfig(level=logging.WARNING)
+
+    import utils
+    import utils.db.sqlite
+    from utils import fake_kafka
+    from utils.tracing import latency_report
+
+    sql_counter = CountingSqlite3()
+    utils.db.sqlite.sqlite3 = sql_counter
+
+    # Importing the services sets up their consumers/producers against the in-process broker
+    msvc_status = importlib.import_module("msvc_status")
+    msvc_assemble = importlib.import_module("msvc_assemble")
+    msvc_bake = importlib.import_module("msvc_bake")
+    for service in (msvc_assemble, msvc_bake):
+        service.time = ScaledTime(args.sleep_scale)
+
+    sys_config = msvc_status.SYS_CONFIG
+    topics = sys_config["kafka-topics"]
+    broker = msvc_status.CONSUMER.broker
+
+    latency = StageLatency(
+        {
+            (msvc_assemble.CONSUMER.group, topics["pizza_ordered"]): "assemble",
+            (msvc_bake.CONSUMER.group, topics["pizza_assembled"]): "bake",
+            (msvc_status.CONSUMER.group, topics["pizza_status"]): "status",
+        },
+        final_status=sys_config["status-id"]["pizza_baked"],
+    )
+    broker.commit_hooks.append(latency)
+
+    # ksqlDB stand-in
+    forwarder_consumer = fake_kafka.Consumer(
+        {"group.id": FORWARDER_GROUP, "auto.offset.reset": "earliest"},
+        broker=broker,
+    )
+    forwarder_consumer.subscribe([topics["pizza_assembled"], topics["pizza_baked"]])
+    threading.Thread(
+        target=forward_status,
+        args=(forwarder_consumer, fake_kafka.Producer(dict(), broker=broker), topics["pizza_status"]),
+        daemon=True,
+    ).start()
+
+    # Synthetic orders, added to the state store (as the webapp would) before being produced
+    rnd = random.Random(args.seed)
+    orders = dict()
+    for n in range(args.orders):
+        orders[f"bench{n:08d}"] = {
+            "order": {
+                "username": f"user{n % 97}",
+                "customer_id": f"customer{n % 97}",
+                "sauce": rnd.choice(sys_config["pizza"]["sauce"]),
+                "cheese": rnd.choice(sys_config["pizza"]["cheese"]),
+                "main_topping": rnd.choice(sys_config["pizza"]["main_topping"]),
+                "extra_toppings": rnd.sample(sys_config["pizza"]["extra_toppings"], 2),
+            }
+        }
+    with utils.db.sqlite.DB(msvc_status.ORDERS_DB, sys_config=sys_config) as db, db.transaction():
+        for order_id, order_details in orders.items():
+            db.add_order(order_id, order_details)
+    sql_counter.counts.clear()
+
+    for target, target_args in (
+        (msvc_status.get_pizza_status, tuple()),
+        (msvc_assemble.receive_orders, tuple()),
+        (msvc_bake.receive_pizza_assembled, ("", 0)),
+    ):
+        threading.Thread(target=target, args=target_args, daemon=True).start()
+
+    producer = fake_kafka.Producer(dict(), broker=broker)
+    latency.expected = len(orders)
+    started = time.monotonic()
+    for order_id, order_details in orders.items():
+        with latency.lock:
+            latency.ordered_at[order_id.encode()] = time.monotonic()
+        producer.produce(
+            topics["pizza_ordered"],
+            key=order_id,
+            value=json.dumps(order_details).encode(),
+        )
+    completed = latency.done.wait(args.timeout)
+    elapsed = time.monotonic() - started
+
+    # Per-hop latencies recorded by msvc_status from the trace context headers
+    with utils.db.sqlite.DB(msvc_status.ORDERS_DB, sys_config=sys_config) as db:
+        traces = latency_report(list(db.get_traces().values()))
+
+    with latency.lock:
+        events = sum(len(v) for v in latency.latencies.values())
+        report = {
+            "orders": len(orders),
+            "orders_completed": len(latency.end_to_end),
+            "completed": completed,
+            "seconds": round(elapsed, 3),
+            "orders_per_second": round(len(latency.end_to_end) / elapsed, 1),
+            "events_per_second": round(events / elapsed, 1),
+            "latency_ms": {
+                stage: {
+                    "events": len(values),
+                    "p50": round(percentile(values, 50) * 1000, 2),
+                    "p99": round(percentile(values, 99) * 1000, 2),
+                }
+                for stage, values in [*sorted(latency.latencies.items()), ("end_to_end", latency.end_to_end)]
+            },
+            "trace_ms": traces,
+            "sqlite_writes": {
+                **dict(sql_counter.counts),
+                "per_status_event": round(
+                    sum(c for verb, c in sql_counter.counts.items() if verb != "COMMIT")
+                    / max(1, len(latency.latencies["status"])),
+                    2,
+                ),
+            },
+            "workdir": workdir,
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Orders: {report['orders_completed']}/{report['orders']} in {report['seconds']}s ({report['orders_per_second']} orders/s, {report['events_per_second']} events/s)")
+        for stage, stats in report["latency_ms"].items():
+            print(f"- {stage:<11} events={stats['events']:<7} p50={stats['p50']:>9.2f} ms  p99={stats['p99']:>9.2f} ms")
+        for hop, stats in traces["hops"].items():
+            print(f"- trace {hop:<22} p50={stats['p50']:>7} ms  p99={stats['p99']:>7} ms")
+        print(f"Slowest stage: {traces['slowest']}")
+        print(f"SQLite writes: {report['sqlite_writes']}")
+    return 0 if completed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
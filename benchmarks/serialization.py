@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of the event encodings of utils.serialization, no Kafka cluster required.
+
+For the pizza_assembled and pizza_baked events, reports the bytes on the wire
+(value plus `pizza-format` header) and the encode/decode cost per event of each
+format, compared with the former `json.dumps(...).encode()` /
+`json.loads(event.value().decode())`.
+
+Usage:
+    python benchmarks/serialization.py [--events N] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Event:
+    """Minimal consumed event (value and headers)"""
+
+    __slots__ = ("_value", "_headers")
+
+    def __init__(self, value: bytes, headers: list = None):
+        self._value = value
+        self._headers = headers
+
+    def value(self) -> bytes:
+        return self._value
+
+    def headers(self) -> list:
+        return self._headers
+
+
+def time_calls(function, argument, calls: int) -> float:
+    """Average microseconds per call"""
+    started = time.perf_counter()
+    for _ in range(calls):
+        function(argument)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the event encodings")
+    parser.add_argument("--events", type=int, default=100000, help="events encoded/decoded per format")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from utils.serialization import SERIALIZERS, EventSerializer, deserialize
+
+    timestamp = int(time.time() * 1000)
+    events = {
+        "pizza_assembled": {"status": 200, "baking_time": 12, "timestamp": timestamp},
+        "pizza_baked": {"status": 300, "timestamp": timestamp},
+    }
+
+    report = dict()
+    for name, value in events.items():
+        report[name] = dict()
+
+        legacy = json.dumps(value).encode()
+        report[name]["legacy_json"] = {
+            "bytes": len(legacy),
+            "encode_us": round(time_calls(lambda v: json.dumps(v).encode(), value, args.events), 3),
+            "decode_us": round(time_calls(lambda e: json.loads(e.value().decode()), Event(legacy), args.events), 3),
+        }
+
+        for format in SERIALIZERS:
+            serializer = EventSerializer(format)
+            data, headers = serializer.serialize(value)
+            event = Event(data, headers)
+            assert deserialize(event) == value, (name, format)
+            report[name][format] = {
+                "bytes": len(data) + sum(len(k) + len(v) for k, v in headers or list()),
+                "encode_us": round(time_calls(serializer.serialize, value, args.events), 3),
+                "decode_us": round(time_calls(deserialize, event, args.events), 3),
+            }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, formats in report.items():
+            print(name)
+            for format, stats in formats.items():
+                print(
+                    f"- {format:<12} bytes={stats['bytes']:>4}"
+                    f"  encode={stats['encode_us']:>7.3f} us  decode={stats['decode_us']:>7.3f} us"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Startup time of each microservice, no Kafka cluster required.
+
+Each service module is imported (module-level setup: logging, configuration, clients
+against the in-process broker of config_kafka/benchmark.ini, state store) in a fresh
+interpreter, `--runs` times with the configuration snapshot removed beforehand (cold)
+and `--runs` times reusing it (warm). Reports the median time to import the service
+and to run the whole process, and the time spent in `get_system_config`.
+
+Usage:
+    python benchmarks/startup.py [--runs N] [--sys-config FILE] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KAFKA_CONFIG = "benchmark.ini"
+SERVICES = ("msvc_assemble", "msvc_bake", "msvc_status")
+
+# Run in the child interpreter: import the service and report the timings as JSON
+CHILD = """
+import sys, json, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+sys.argv = [{service!r} + ".py", {kafka_config!r}, {sys_config!r}]
+import utils
+get_system_config = utils.get_system_config
+config_seconds = []
+def timed_get_system_config(*args, **kwargs):
+    t = time.perf_counter()
+    try:
+        return get_system_config(*args, **kwargs)
+    finally:
+        config_seconds.append(time.perf_counter() - t)
+utils.get_system_config = timed_get_system_config
+import importlib
+importlib.import_module({service!r})
+print(json.dumps({{
+    "import_seconds": time.perf_counter() - started,
+    "config_seconds": sum(config_seconds),
+    "requests_loaded": "requests" in sys.modules,
+}}))
+"""
+
+
+def run_service(service: str, sys_config: str, workdir: str) -> dict:
+    code = CHILD.format(root=ROOT, service=service, kafka_config=KAFKA_CONFIG, sys_config=sys_config)
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the microservices")
+    parser.add_argument("--runs", type=int, default=5, help="runs per service and mode")
+    parser.add_argument("--sys-config", default="default.ini", help="file under config_sys/")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    # Run from a scratch folder (logs, pid and state store files) sharing the repository configuration
+    workdir = tempfile.mkdtemp(prefix="pizza_startup_")
+    for folder in ("config_kafka", "config_sys"):
+        os.symlink(os.path.join(ROOT, folder), os.path.join(workdir, folder))
+    os.makedirs(os.path.join(workdir, "logs"))
+
+    sys.path.insert(0, ROOT)
+    from utils import config_snapshot_file
+
+    snapshot_file = config_snapshot_file(os.path.join(ROOT, "config_sys", args.sys_config))
+
+    report = dict()
+    for service in SERVICES:
+        report[service] = dict()
+        for mode in ("cold", "warm"):
+            runs = list()
+            for _ in range(args.runs):
+                if mode == "cold" and os.path.exists(snapshot_file):
+                    os.remove(snapshot_file)
+                runs.append(run_service(service, args.sys_config, workdir))
+            report[service][mode] = {
+                key: round(statistics.median(run[key] for run in runs) * 1000, 2)
+                for key in ("process_seconds", "import_seconds", "config_seconds")
+            }
+            report[service][mode]["requests_loaded"] = any(run["requests_loaded"] for run in runs)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for service, modes in report.items():
+            for mode, stats in modes.items():
+                print(
+                    f"- {service:<14} {mode}  process={stats['process_seconds']:>8.2f} ms"
+                    f"  import={stats['import_seconds']:>8.2f} ms  config={stats['config_seconds']:>6.2f} ms"
+                    f"  requests loaded={stats['requests_loaded']}"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import sys
+import json
+import time
+import logging
+import argparse
+
+from utils import (
+    log_ini,
+    get_hostname,
+    get_script_name,
+    get_system_config,
+    validate_cli_args,
+    get_consumer_groups,
+    set_producer_consumer,
+)
+from utils.lag import LagMonitor
+
+
+SCRIPT = get_script_name(__file__)
+
+log_ini(SCRIPT)
+
+# Usage: lag_monitor.py {KAFKA_CONFIG_FILE} {SYS_CONFIG_FILE} [--group GROUP ...] [--workers N] [--once] [--json]
+parser = argparse.ArgumentParser(
+    description="Consumer group lag and recommended number of workers",
+)
+parser.add_argument("kafka_config", nargs="?", help="file under config_kafka/")
+parser.add_argument("sys_config", nargs="?", help="file under config_sys/")
+parser.add_argument(
+    "--group",
+    action="append",
+    help="consumer group to monitor (repeatable, all topics), defaults to the groups of the microservices and the topics they consume",
+)
+parser.add_argument("--hostname", default=get_hostname(), help="hostname suffix of the default groups")
+parser.add_argument("--workers", type=int, default=1, help="current number of workers of each group")
+parser.add_argument("--interval", type=float, help="seconds between two samples (defaults to [lag-monitor] interval_seconds)")
+parser.add_argument("--once", action="store_true", help="take two samples `--interval` seconds apart and exit")
+parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+args = parser.parse_args()
+
+sys.argv = [sys.argv[0]] + [a for a in (args.kafka_config, args.sys_config) if a]
+kafka_config_file, sys_config_file = validate_cli_args(SCRIPT)
+SYS_CONFIG = get_system_config(sys_config_file)
+
+if args.group:
+    GROUPS = {group: list(SYS_CONFIG["kafka-topics"].values()) for group in args.group}
+else:
+    GROUPS = get_consumer_groups(SYS_CONFIG, args.hostname)
+INTERVAL_SECONDS = args.interval or SYS_CONFIG["lag-monitor"]["interval_seconds"] or 60
+
+
+def print_report(report: dict):
+    if args.json:
+        print(json.dumps(report))
+        return
+    for group, group_report in report["groups"].items():
+        if not group_report["topics"]:
+            continue
+        print(
+            f"{group}: lag={group_report['lag']} drain_rate={group_report['drain_rate']}/s "
+            f"produce_rate={group_report['produce_rate']}/s workers={group_report['workers']} "
+            f"recommended_workers={group_report['recommended_workers']}"
+        )
+        for topic, topic_report in group_report["topics"].items():
+            lags = " ".join(
+                f"{partition}:{partition_report['lag']}"
+                for partition, partition_report in sorted(topic_report["partitions"].items())
+            )
+            print(f"  - {topic}: lag={topic_report['lag']} drain_rate={topic_report['drain_rate']}/s [{lags}]")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    _, _, _, admin_client = set_producer_consumer(
+        kafka_config_file,
+        disable_producer=True,
+        disable_consumer=True,
+    )
+    monitor = LagMonitor(
+        lambda group: set_producer_consumer(
+            kafka_config_file,
+            disable_producer=True,
+            consumer_extra_config={"group.id": group},
+            instrument_consumer=False,
+        )[2],
+        admin_client,
+        GROUPS,
+        workers={group: args.workers for group in GROUPS},
+        interval_seconds=INTERVAL_SECONDS,
+        target_drain_seconds=SYS_CONFIG["lag-monitor"]["target_drain_seconds"],
+    )
+    try:
+        samples = 0
+        while True:
+            print_report(monitor.sample())
+            samples += 1
+            # Rates need two samples (none if no group committed anything)
+            if args.once and (samples == 2 or not monitor.previous):
+                break
+            time.sleep(INTERVAL_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+        logging.info("Lag monitor stopped")
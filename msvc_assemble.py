@@ -1,10 +1,17 @@
 import sys
-import json
 import time
+import queue
+import signal
 import hashlib
 import logging
+import threading
+from functools import partial
 
 from utils import (
+    EventView,
+    AsyncProducer,
+    OffsetTracker,
+    KeyedDispatcher,
     GracefulShutdown,
     log_ini,
     save_pid,
@@ -14,49 +21,257 @@ from utils import (
     delivery_report,
     get_script_name,
     get_system_config,
+    get_consumer_group,
     validate_cli_args,
     log_event_received,
     set_producer_consumer,
+    set_event_log_rate,
+    start_metrics,
+    start_lag_monitor,
+    start_dedup,
 )
+from utils.metrics import timed
+from utils.tracing import TraceContext
+from utils.serialization import EventSerializer
 
 
 SCRIPT = get_script_name(__file__)
 HOSTNAME = get_hostname()
 
-log_ini(SCRIPT)
+log_ini(SCRIPT, asynchronous=True)
 kafka_config_file, sys_config_file = validate_cli_args(SCRIPT)
 SYS_CONFIG = get_system_config(sys_config_file)
+set_event_log_rate(SYS_CONFIG["logging"]["event_log_max_per_second"])
 
 # Kafka topics and configurations
 PRODUCE_TOPIC_STATUS = SYS_CONFIG['kafka-topics'].get('pizza_status')
 PRODUCE_TOPIC_ASSEMBLED = SYS_CONFIG['kafka-topics']['pizza_assembled']
-CONSUME_TOPICS = [SYS_CONFIG['kafka-topics']['pizza_ordered']]
+GROUP_ID, CONSUME_TOPICS = get_consumer_group(SYS_CONFIG, SCRIPT, HOSTNAME)
+SERIALIZER_ASSEMBLED = EventSerializer(SYS_CONFIG["kafka-event-format"]["pizza_assembled"])
 
-_, PRODUCER, CONSUMER, _ = set_producer_consumer(
+_, producer, CONSUMER, _ = set_producer_consumer(
     kafka_config_file,
     producer_extra_config={
         "on_delivery": delivery_report,
         "client.id": f"{SYS_CONFIG['kafka-client-id']['microservice_assembled']}_{HOSTNAME}",
     },
     consumer_extra_config={
-        "group.id": f"{SYS_CONFIG['kafka-consumer-group-id']['microservice_assembled']}_{HOSTNAME}",
+        "group.id": GROUP_ID,
         "client.id": f"{SYS_CONFIG['kafka-client-id']['microservice_assembled']}_{HOSTNAME}",
-    }
+    },
+    linger_ms=SYS_CONFIG["kafka-producer"]["linger_ms"],
+    batch_size=SYS_CONFIG["kafka-producer"]["batch_size"],
+)
+PRODUCER = AsyncProducer(
+    producer,
+    max_in_flight=SYS_CONFIG["kafka-producer"]["max_in_flight"],
 )
 
-GRACEFUL_SHUTDOWN = GracefulShutdown(consumer=CONSUMER)
+# Offsets are only committed once the order's pizza_assembled event is delivered
+OFFSETS = OffsetTracker(consumer=CONSUMER)
 
-def pizza_assembled(order_id: str, baking_time: int):
-    PRODUCER.produce(
-        PRODUCE_TOPIC_ASSEMBLED,
-        key=order_id,
-        value=json.dumps({
+# Number of orders that can be assembled at the same time ("in the oven"), events of
+# the same order are always assembled by the same worker, in order. A slot is only taken
+# by a worker actually assembling: with several worker queues per slot, an order waiting
+# behind another order of the same queue does not keep a slot idle
+MAX_CONCURRENT_ORDERS = SYS_CONFIG["microservice-assemble"]["max_concurrent_orders"]
+OVEN_QUEUES_PER_SLOT = 4
+OVEN_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_ORDERS)
+# Orders received and not assembled yet (queued or in the oven), bounds the poll loop
+ORDERS_ADMITTED = threading.BoundedSemaphore(MAX_CONCURRENT_ORDERS * OVEN_QUEUES_PER_SLOT)
+# Set on shutdown: only the orders in the oven are finished, the others are handed back
+# (offsets not committed) so the shutdown fits in the supervisor's shutdown timeout
+STOPPING = threading.Event()
+
+# Orders already assembled (pizza_assembled delivered), so redelivered events are not assembled again
+DEDUP = start_dedup(SCRIPT, SYS_CONFIG["dedup"])
+
+GRACEFUL_SHUTDOWN = GracefulShutdown(consumer=CONSUMER, committer=OFFSETS, producer=PRODUCER, dedup=DEDUP)
+
+# pizza_assembled events whose delivery failed, produced again by the poll loop up to
+# DELIVERY_RETRIES times each (their offset is not done meanwhile, so nothing is committed past them)
+DELIVERY_RETRIES = 3
+FAILED_DELIVERIES = queue.SimpleQueue()
+
+def pizza_assembled(order_id: str, baking_time: int, on_delivery=delivery_report, trace: TraceContext = None):
+    value, headers = SERIALIZER_ASSEMBLED.serialize(
+        {
             "status": SYS_CONFIG["status-id"]["pizza_assembled"],
             "baking_time": baking_time,
             "timestamp": timestamp_now(),
-        }).encode()
+        },
+        headers=None if trace is None else trace.headers(),
     )
-    PRODUCER.flush()
+    PRODUCER.produce(
+        PRODUCE_TOPIC_ASSEMBLED,
+        key=order_id,
+        value=value,
+        on_delivery=on_delivery,
+        headers=headers,
+    )
+
+def order_delivered(event, err, msg, attempt: int = 0):
+    """Delivery callback of pizza_assembled: flags the consumed event as done, or queues it to be produced again"""
+    delivery_report(err, msg)
+    if err is None:
+        if DEDUP is not None:
+            DEDUP.add(event.topic(), event.decoded_key)
+        OFFSETS.done(event.topic(), event.partition(), event.offset())
+    else:
+        FAILED_DELIVERIES.put((event, msg, attempt))
+
+def redeliver_failed() -> bool:
+    """
+    Produces again the pizza_assembled events whose delivery failed (called from the
+    poll loop, not from a delivery callback). Returns False once an event is out of
+    retries: the worker must then stop without committing its offset, so the order is
+    consumed again (by this worker once restarted, or by the next owner of the partition).
+    """
+    while True:
+        try:
+            event, msg, attempt = FAILED_DELIVERIES.get_nowait()
+        except queue.Empty:
+            return True
+        if attempt >= DELIVERY_RETRIES:
+            logging.critical(
+                f"Unable to deliver pizza_assembled of order '{event.decoded_key}' after {attempt + 1} attempt(s), stopping"
+            )
+            return False
+        logging.warning(
+            f"Producing pizza_assembled of order '{event.decoded_key}' again (retry {attempt + 1}/{DELIVERY_RETRIES})"
+        )
+        PRODUCER.produce(
+            msg.topic(),
+            key=msg.key(),
+            value=msg.value(),
+            on_delivery=partial(order_delivered, event, attempt=attempt + 1),
+            headers=msg.headers(),
+        )
+
+def partitions_assigned(consumer, partitions):
+    """Reads the orders assembled by the other workers (previous owners of the partitions)"""
+    if DEDUP is not None:
+        DEDUP.save()
+
+def partitions_revoked(consumer, partitions):
+    """Commits what is already assembled and stops tracking the revoked partitions"""
+    if DEDUP is not None:
+        # Publish the orders assembled so far to the next owner of the partitions
+        DEDUP.save()
+    OFFSETS.commit()
+    OFFSETS.forget(partitions)
+
+@timed("event_handling", label="handler")
+def assemble_order(event):
+    """
+    Assembles a single order (runs in an OVEN worker thread).
+
+    The event offset is flagged as done once pizza_assembled is delivered, or
+    straight away if the event cannot be processed (so it is not retried forever).
+    Orders still waiting for an oven slot on shutdown are handed back: their offset
+    is left in flight, so they are consumed again after the restart.
+    """
+    produced = in_oven = handed_back = False
+    # Khóa và nội dung sự kiện chỉ được giải mã một lần, dùng chung cho ghi log và xử lý
+    event = EventView(event)
+    # Ngữ cảnh truy vết của đơn hàng (bắt đầu từ thời điểm sự kiện pizza-ordered được ghi vào Kafka)
+    trace = TraceContext.from_event(event, origin="ordered").hop("assemble_in")
+    try:
+        # Bỏ qua đơn hàng đã được lắp ráp (sự kiện được Kafka gửi lại sau khi khởi động lại hoặc rebalance)
+        if DEDUP is not None and DEDUP.seen(event.topic(), event.decoded_key):
+            logging.info(f"Order '{event.decoded_key}' already assembled, redelivered event skipped")
+            return
+
+        # Chờ một chỗ trống trong lò (tối đa MAX_CONCURRENT_ORDERS đơn hàng được lắp ráp cùng lúc)
+        OVEN_SLOTS.acquire()
+        in_oven = True
+        if STOPPING.is_set():
+            handed_back = True
+            return
+
+        # Thêm độ trễ ngắn để cho các bản ghi từ microservice khác hiển thị trước
+        time.sleep(0.15)  # Để dễ dàng theo dõi log
+
+        # Ghi log sự kiện vừa nhận để kiểm tra thông tin đơn hàng
+        log_event_received(event)
+
+        # Giải mã key của sự kiện để lấy mã đơn hàng (order_id)
+        order_id = event.decoded_key
+
+        # Giải mã và giải nén dữ liệu JSON của sự kiện để lấy chi tiết đơn hàng
+        try:
+            # `order_details` chứa thông tin chi tiết của đơn hàng
+            order_details = event.data
+            # `order` lấy các thông tin cụ thể của đơn hàng (các thành phần của pizza)
+            order = order_details.get("order", dict())
+        except Exception:
+            # Ghi log nếu có lỗi khi giải mã hoặc giải nén JSON
+            log_exception(
+                f"Error when processing event.value() {event.value()}",
+                sys.exc_info(),
+            )
+
+        else:
+            # Tạo giá trị `seed` ngẫu nhiên từ các thành phần của đơn hàng bằng cách hash MD5
+            seed = int(
+                hashlib.md5(
+                    # Kết hợp các thành phần của pizza để tạo chuỗi unique cho đơn hàng
+                    f"{order['sauce']}@{order['cheese']}@{','.join(order['extra_toppings'])}@{order['main_topping']}".encode()
+                ).hexdigest()[-4:],  # Lấy 4 ký tự cuối của mã hash
+                16  # Đổi thành số nguyên dạng hệ 16 (hexadecimal)
+            )
+
+            # Tính toán thời gian lắp ráp (assembling_time) dựa trên `seed`
+            assembling_time = seed % 8 + 4  # Kết quả sẽ nằm trong khoảng 4-11 giây
+
+            # Ghi log về thời gian lắp ráp và mã đơn hàng hiện tại
+            logging.info(
+                f"Preparing order '{order_id}', assembling time is {assembling_time} second(s)"
+            )
+
+            # Giả lập quá trình lắp ráp (chỉ chặn worker hiện tại, không chặn vòng lặp poll)
+            time.sleep(assembling_time)
+
+            # Ghi log xác nhận pizza đã hoàn thành lắp ráp
+            logging.info(f"Order '{order_id}' is assembled!")
+
+            # Tính toán thời gian nướng bánh dựa trên `seed`
+            baking_time = seed % 8 + 8  # Thời gian sẽ nằm trong khoảng 8-15 giây
+
+            # Gửi thông tin hoàn thành lắp ráp vào Kafka qua topic pizza_assembled (kèm ngữ cảnh truy vết),
+            # offset chỉ được đánh dấu hoàn tất khi sự kiện đã được gửi thành công
+            pizza_assembled(
+                order_id,
+                baking_time,
+                on_delivery=partial(order_delivered, event),
+                trace=trace.hop("assembled"),
+            )
+            produced = True
+
+    except Exception:
+        # Ghi log nếu có lỗi khi xử lý key của sự kiện
+        log_exception(
+            f"Error when processing event.key() {event.key()}",
+            sys.exc_info(),
+        )
+
+    finally:
+        if not produced and not handed_back:
+            # Sự kiện không thể xử lý: bỏ qua để không chặn việc commit offset
+            OFFSETS.done(event.topic(), event.partition(), event.offset())
+        if in_oven:
+            OVEN_SLOTS.release()
+        ORDERS_ADMITTED.release()
+
+# Worker threads (declared after assemble_order, their handler)
+OVEN = KeyedDispatcher(
+    assemble_order,
+    workers=MAX_CONCURRENT_ORDERS * OVEN_QUEUES_PER_SLOT,
+    offsets=OFFSETS,
+    complete_on_return=False,
+    max_queued=0,
+    name="assemble",
+)
 
 def receive_orders():
     # Đăng ký Consumer để nhận các sự kiện từ topic được chỉ định trong CONSUME_TOPICS
@@ -75,92 +290,55 @@ def receive_orders():
         - GracefulShutdown: for safe shutdown handling.
         - Kafka Consumer: to receive events.
         - Kafka Producer: to send assembled pizza status.
+        - OVEN (KeyedDispatcher): to assemble up to MAX_CONCURRENT_ORDERS orders
+          concurrently, in order per order_id, committing offsets only once
+          delivered (OffsetTracker).
         - Logging: for error and process logging.
 
     Raises:
         Exception: If there is an error decoding the event or processing the
         order details.
     """
-    CONSUMER.subscribe(CONSUME_TOPICS)
+    CONSUMER.subscribe(CONSUME_TOPICS, on_assign=partitions_assigned, on_revoke=partitions_revoked)
     logging.info(f"Subscribed to topics: {CONSUME_TOPICS}")
 
     # Vòng lặp liên tục để Consumer kiểm tra và xử lý các sự kiện từ Kafka
     while True:
         # Sử dụng GracefulShutdown để xử lý tín hiệu dừng an toàn khi cần thiết
         with GRACEFUL_SHUTDOWN as _:
-            # Kiểm tra xem có sự kiện nào mới trong Kafka topic không
-            event = CONSUMER.poll(1)  # Đợi tối đa 1 giây để nhận sự kiện
+            # Chỉ nhận sự kiện mới khi số đơn hàng đang chờ hoặc đang lắp ráp chưa vượt giới hạn
+            if ORDERS_ADMITTED.acquire(timeout=1):
+                # Kiểm tra xem có sự kiện nào mới trong Kafka topic không
+                event = CONSUMER.poll(1)  # Đợi tối đa 1 giây để nhận sự kiện
 
-            # Nếu có sự kiện (không rỗng)
-            if event is not None:
-                # Kiểm tra xem sự kiện có lỗi không
-                if event.error():
+                if event is None:
+                    ORDERS_ADMITTED.release()
+                elif event.error():
                     # Nếu có lỗi, ghi lại thông báo lỗi vào log để gỡ lỗi
                     logging.error(event.error())
+                    ORDERS_ADMITTED.release()
                 else:
-                    # Xử lý sự kiện hợp lệ
-                    try:
-                        # Thêm độ trễ ngắn để cho các bản ghi từ microservice khác hiển thị trước
-                        time.sleep(0.15)  # Để dễ dàng theo dõi log
-
-                        # Ghi log sự kiện vừa nhận để kiểm tra thông tin đơn hàng
-                        log_event_received(event)
-
-                        # Giải mã key của sự kiện để lấy mã đơn hàng (order_id)
-                        order_id = event.key().decode()
-                        
-                        # Giải mã và giải nén dữ liệu JSON của sự kiện để lấy chi tiết đơn hàng
-                        try:
-                            # `order_details` chứa thông tin chi tiết của đơn hàng
-                            order_details = json.loads(event.value().decode())
-                            # `order` lấy các thông tin cụ thể của đơn hàng (các thành phần của pizza)
-                            order = order_details.get("order", dict())
-                        except Exception:
-                            # Ghi log nếu có lỗi khi giải mã hoặc giải nén JSON
-                            log_exception(
-                                f"Error when processing event.value() {event.value()}",
-                                sys.exc_info(),
-                            )
-
-                        else:
-                            # Tạo giá trị `seed` ngẫu nhiên từ các thành phần của đơn hàng bằng cách hash MD5
-                            seed = int(
-                                hashlib.md5(
-                                    # Kết hợp các thành phần của pizza để tạo chuỗi unique cho đơn hàng
-                                    f"{order['sauce']}@{order['cheese']}@{','.join(order['extra_toppings'])}@{order['main_topping']}".encode()
-                                ).hexdigest()[-4:],  # Lấy 4 ký tự cuối của mã hash
-                                16  # Đổi thành số nguyên dạng hệ 16 (hexadecimal)
-                            )
-
-                            # Tính toán thời gian lắp ráp (assembling_time) dựa trên `seed`
-                            assembling_time = seed % 8 + 4  # Kết quả sẽ nằm trong khoảng 4-11 giây
-                            
-                            # Ghi log về thời gian lắp ráp và mã đơn hàng hiện tại
-                            logging.info(
-                                f"Preparing order '{order_id}', assembling time is {assembling_time} second(s)"
-                            )
-
-                            # Dừng chương trình trong thời gian `assembling_time` để giả lập quá trình lắp ráp
-                            time.sleep(assembling_time)
-
-                            # Ghi log xác nhận pizza đã hoàn thành lắp ráp
-                            logging.info(f"Order '{order_id}' is assembled!")
-
-                            # Tính toán thời gian nướng bánh dựa trên `seed`
-                            baking_time = seed % 8 + 8  # Thời gian sẽ nằm trong khoảng 8-15 giây
-                            
-                            # Gửi thông tin hoàn thành lắp ráp vào Kafka qua topic pizza_assembled
-                            pizza_assembled(order_id, baking_time)
-
-                    except Exception:
-                        # Ghi log nếu có lỗi khi xử lý key của sự kiện
-                        log_exception(
-                            f"Error when processing event.key() {event.key()}",
-                            sys.exc_info(),
-                        )
-
-                # Xác nhận sự kiện đã xử lý xong (commit offset) để Kafka không gửi lại
-                CONSUMER.commit(asynchronous=False)
+                    # Đưa đơn hàng vào lò (theo order_id), vòng lặp poll tiếp tục ngay lập tức
+                    OVEN.submit(event)
+
+            # Gửi lại các sự kiện pizza_assembled chưa được gửi thành công, dừng worker nếu hết số lần thử
+            # (offset của đơn hàng không được commit, đơn hàng sẽ được nhận lại sau khi khởi động lại)
+            if not redeliver_failed():
+                GRACEFUL_SHUTDOWN.signal_handler(signal.SIGTERM, None)
+
+            if GRACEFUL_SHUTDOWN.was_signal_set:
+                # Chỉ chờ các đơn hàng đang ở trong lò hoàn tất, các đơn hàng đang chờ được trả lại
+                # (offset không được commit, Kafka sẽ gửi lại sau khi khởi động lại)
+                STOPPING.set()
+                logging.info(f"Waiting for the orders being assembled ({OFFSETS.in_flight()} order(s) in flight)...")
+                handed_back = OVEN.shutdown(wait=True, discard_queued=True)
+                logging.info(f"{handed_back} queued order(s) handed back (offsets not committed)")
+
+            # Xử lý các delivery callback của Producer (không chặn)
+            PRODUCER.poll(0)
+
+            # Commit offset cao nhất liên tiếp đã hoàn tất của mỗi partition để Kafka không gửi lại
+            OFFSETS.commit()
 
 
 
@@ -171,6 +349,12 @@ if __name__ == "__main__":
     # Save PID
     save_pid(SCRIPT)
 
+    # Export metrics
+    start_metrics(SCRIPT, SYS_CONFIG["metrics"])
+
+    # Monitor the consumer group lag
+    start_lag_monitor(kafka_config_file, {GROUP_ID: CONSUME_TOPICS}, SYS_CONFIG["lag-monitor"])
+
     # Start consumer
     receive_orders()
 
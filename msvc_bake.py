@@ -1,9 +1,12 @@
 import sys
-import json
 import time
 import logging
+from functools import partial
 
 from utils import (
+    EventView,
+    AsyncProducer,
+    BatchCommitter,
     GracefulShutdown,
     log_ini,
     save_pid,
@@ -13,27 +16,35 @@ from utils import (
     delivery_report,
     get_script_name,
     get_system_config,
+    get_consumer_group,
     validate_cli_args,
     log_event_received,
     set_producer_consumer,
+    set_event_log_rate,
+    start_metrics,
+    start_lag_monitor,
+    start_dedup,
 )
+from utils.metrics import timed
+from utils.tracing import TraceContext
+from utils.serialization import EventSerializer
 
 
 SCRIPT = get_script_name(__file__)
 HOSTNAME = get_hostname()
 
-log_ini(SCRIPT)
+log_ini(SCRIPT, asynchronous=True)
 kafka_config_file, sys_config_file = validate_cli_args(SCRIPT)
 SYS_CONFIG = get_system_config(sys_config_file)
+set_event_log_rate(SYS_CONFIG["logging"]["event_log_max_per_second"])
 
 
 # Kafka topics and configurations
 PRODUCE_TOPIC_BAKE = SYS_CONFIG['kafka-topics']['pizza_baked']
 PRODUCE_TOPIC_STATUS = SYS_CONFIG['kafka-topics']['pizza_status']
-CONSUME_TOPICS = [
-    SYS_CONFIG['kafka-topics']['pizza_assembled'],
-]
-_,PRODUCER, CONSUMER,_ = set_producer_consumer(
+GROUP_ID, CONSUME_TOPICS = get_consumer_group(SYS_CONFIG, SCRIPT, HOSTNAME)
+SERIALIZER_BAKED = EventSerializer(SYS_CONFIG["kafka-event-format"]["pizza_baked"])
+_,producer, CONSUMER,_ = set_producer_consumer(
                         kafka_config_file,
                         producer_extra_config={
                             "on_delivery": delivery_report,
@@ -41,72 +52,122 @@ _,PRODUCER, CONSUMER,_ = set_producer_consumer(
 
                         },
                         consumer_extra_config={
-                            "group.id": f"""{SYS_CONFIG['kafka-client-id']['microservice_baked']}_{HOSTNAME}""",
+                            "group.id": GROUP_ID,
                             "client.id": f"""{SYS_CONFIG['kafka-client-id']['microservice_baked']}_{HOSTNAME}""", # "auto.offset.reset": 'earliest',
                         },
-                        disable_producer=True
+                        linger_ms=SYS_CONFIG["kafka-producer"]["linger_ms"],
+                        batch_size=SYS_CONFIG["kafka-producer"]["batch_size"],
                     )
+PRODUCER = AsyncProducer(
+    producer,
+    max_in_flight=SYS_CONFIG["kafka-producer"]["max_in_flight"],
+)
+
+# Produced events are flushed right before offsets are committed (once per batch)
+COMMITTER = BatchCommitter(
+    CONSUMER,
+    commit_every_messages=SYS_CONFIG["kafka-consumer-batch"]["commit_every_messages"],
+    commit_interval_seconds=SYS_CONFIG["kafka-consumer-batch"]["commit_interval_seconds"],
+    producer=PRODUCER,
+)
 
-graceful_shutdown = GracefulShutdown(consumer = CONSUMER)
+# Events already baked (pizza_baked delivered), so redelivered events are not baked again
+DEDUP = start_dedup(SCRIPT, SYS_CONFIG["dedup"])
 
+graceful_shutdown = GracefulShutdown(consumer = CONSUMER, committer=COMMITTER, producer=PRODUCER, dedup=DEDUP)
 
 
-def pizza_baked(order_id: str, bake_time: int):
+def pizza_baked(order_id: str, bake_time: int, trace: TraceContext = None, on_delivery=delivery_report):
+    value, headers = SERIALIZER_BAKED.serialize(
+        {
+            "status": SYS_CONFIG["status-id"]["pizza_baked"],
+            "timestamp": timestamp_now(),
+        },
+        headers=None if trace is None else trace.headers(),
+    )
     PRODUCER.produce(
         PRODUCE_TOPIC_BAKE,
         key=order_id,
-        value=json.dumps(
-            {
-                "status": SYS_CONFIG["status-id"]["pizza_baked"],
-                "timestamp": timestamp_now(),
-            }
-        ).encode(),
+        value=value,
+        on_delivery=on_delivery,
+        headers=headers,
     )
-    PRODUCER.flush()
+
+def baked_delivered(dedup_key: tuple, err, msg):
+    """Delivery callback of pizza_baked: remembers the consumed event as handled"""
+    delivery_report(err, msg)
+    if err is None and DEDUP is not None:
+        DEDUP.add(*dedup_key)
+
+def partitions_rebalanced(consumer, partitions):
+    """Shares the events baked with the other workers: published on revoke, read on assign"""
+    if DEDUP is not None:
+        DEDUP.save()
+
+@timed("event_handling", label="handler")
+def bake_pizza(msg):
+    """Bakes the pizza of a pizza_assembled event (offsets are committed by the caller)"""
+    # Key and value decoded once, shared by logging and handling
+    msg = EventView(msg)
+    trace = TraceContext.from_event(msg, origin="assembled").hop("bake_in")
+    time.sleep(0.2)
+    log_event_received(msg)
+    order_id = msg.decoded_key
+    try:
+        order = msg.data
+        baking_time = order.get("baking_time", 0)
+    except Exception as e:
+        logging.error(f"Error parsing event: {e}")
+        time.sleep(0.2)
+        return
+
+    # Skip events already baked (redelivered after a restart or rebalance)
+    dedup_key = (msg.topic(), order_id, order.get("status"))
+    if DEDUP is not None and DEDUP.seen(*dedup_key):
+        logging.info(f"Order {order_id} already baked, redelivered event skipped")
+    elif order["status"] == SYS_CONFIG["status-id"]["pizza_baked"]:
+        logging.info(f"Order {order_id} baked in {baking_time} seconds")
+        pizza_baked(order_id, baking_time, trace=trace.hop("baked"), on_delivery=partial(baked_delivered, dedup_key))
+    elif order["status"] == SYS_CONFIG["status-id"]["pizza_assembled"]:
+        logging.info(f"Order {order_id} assembled in {baking_time} seconds")
+        pizza_baked(order_id, baking_time, trace=trace.hop("baked"), on_delivery=partial(baked_delivered, dedup_key))
 
 def receive_pizza_assembled(order_id: str, baking_time: int):
-    CONSUMER.subscribe(CONSUME_TOPICS)
+    CONSUMER.subscribe(CONSUME_TOPICS, on_assign=partitions_rebalanced, on_revoke=partitions_rebalanced)
     logging.info(f"Subscribed to topics: {CONSUME_TOPICS}")
     while True:
         with graceful_shutdown:
             try:
                 msg = CONSUMER.poll(timeout=1.0)
                 if msg is not None:
+                    COMMITTER.add()
                     if msg.error():
-                        log_exception(msg.error())
+                        logging.error(msg.error())
                     else:
-                        time.sleep(0.2)
-                        log_event_received(msg)
-                        order = json.loads(msg.value().decode("utf-8"))
-                        try:
-                            baking_time = json.loads(msg.value().decode("utf-8")).get(
-                                "baking_time",0
-                            )
-                        except Exception as e:
-                            logging.error(f"Error parsing event: {e}")
-                            time.sleep(0.2)
-                            continue
-
-                        if order["status"] == SYS_CONFIG["status-id"]["pizza_baked"]:
-                            logging.info(f"Order {order_id} baked in {baking_time} seconds")
-                            pizza_baked(order_id, baking_time)
-                        elif order["status"] == SYS_CONFIG["status-id"]["pizza_assembled"]:
-                            logging.info(f"Order {order_id} assembled in {baking_time} seconds")
-                            pizza_baked(order_id, baking_time)
-
-            except Exception as e:
-                log_exception(e)
+                        bake_pizza(msg)
+
+            except Exception:
+                log_exception(
+                    "Error when handling a pizza_assembled event",
+                    sys.exc_info(),
+                )
                 time.sleep(0.2)
                 
             
 
-            CONSUMER.commit(asynchronous=False)
+            COMMITTER.maybe_commit()
 
 
 if __name__ == "__main__":
     # Save PID
     save_pid(SCRIPT)
 
+    # Export metrics
+    start_metrics(SCRIPT, SYS_CONFIG["metrics"])
+
+    # Monitor the consumer group lag
+    start_lag_monitor(kafka_config_file, {GROUP_ID: CONSUME_TOPICS}, SYS_CONFIG["lag-monitor"])
+
     # Start consumer
     receive_pizza_assembled("123", 10)
     
@@ -1,23 +1,40 @@
 import sys
-import json
 import time
 import logging
-from threading import Thread
+from threading import Thread, local
 
 # Import các hàm và lớp tiện ích từ module utils
 from utils import (
+    EventView,                 # Sự kiện được giải mã khóa/nội dung nhiều nhất một lần
+    BatchCommitter,            # Commit offset theo lô sự kiện
+    OffsetTracker,             # Commit offset liên tiếp cao nhất đã xử lý xong (xử lý song song)
+    KeyedDispatcher,           # Xử lý song song theo order_id (giữ thứ tự của mỗi đơn hàng)
     GracefulShutdown,          # Đối tượng quản lý quá trình dừng an toàn
     log_ini,                   # Khởi tạo logging
     save_pid,                  # Lưu ID tiến trình
     get_hostname,              # Lấy tên máy chủ
     log_exception,             # Ghi log ngoại lệ
+    timestamp_now,             # Lấy thời gian hiện tại (ms)
     get_script_name,           # Lấy tên script
     validate_cli_args,         # Xác thực tham số dòng lệnh
-    get_string_status,         # Lấy tên trạng thái đơn hàng dưới dạng chuỗi
     log_event_received,        # Ghi log khi nhận được sự kiện Kafka
     get_system_config,         # Lấy cấu hình hệ thống
+    get_consumer_group,        # Group ID và các topic của consumer của microservice
     set_producer_consumer,     # Thiết lập Kafka Producer và Consumer
+    set_event_log_rate,        # Giới hạn số dòng log cho mỗi sự kiện
     import_state_store_class,  # Import lớp cơ sở dữ liệu để lưu trữ trạng thái đơn hàng
+    start_metrics,             # Xuất số liệu đo lường (JSON/Prometheus)
+    start_lag_monitor,         # Theo dõi độ trễ (lag) của consumer group
+)
+from utils.metrics import timed, REGISTRY  # Đo thời gian xử lý sự kiện, số liệu đo lường
+from utils.tracing import TraceContext, latency_report  # Truy vết độ trễ của đơn hàng qua từng công đoạn
+from utils.scheduler import DeadlineScheduler  # Bộ hẹn giờ (heap) cho các đơn hàng bị kẹt
+from utils.supervisor import get_worker_id  # Số thứ tự của worker (khi chạy nhiều worker qua supervisor.py)
+from utils.status import StatusEngine, ACCEPTED, DUPLICATE, TRANSITION_NAMES  # Máy trạng thái đơn hàng
+from utils.db import (
+    OrderCache,        # Bộ nhớ đệm LRU/TTL cho dữ liệu đơn hàng
+    RetentionJob,      # Dọn dẹp dữ liệu cũ theo từng phần nhỏ
+    CachedStateStore,  # Lớp đệm đọc/ghi trước cơ sở dữ liệu
 )
 
 # Lấy tên tệp script hiện tại và tên máy chủ
@@ -25,7 +42,7 @@ SCRIPT = get_script_name(__file__)
 HOSTNAME = get_hostname()
 
 # Khởi tạo ghi log cho script
-log_ini(SCRIPT)
+log_ini(SCRIPT, asynchronous=True)
 
 # Lấy đường dẫn cấu hình Kafka và hệ thống từ dòng lệnh
 kafka_config_file, sys_config_file = validate_cli_args(SCRIPT)
@@ -33,133 +50,343 @@ kafka_config_file, sys_config_file = validate_cli_args(SCRIPT)
 # Tải cấu hình hệ thống từ tệp
 SYS_CONFIG = get_system_config(sys_config_file)
 
-# Các Kafka topic cần tiêu thụ dữ liệu
-CONSUME_TOPICS = [
-    SYS_CONFIG["kafka-topics"]["pizza_status"],  # Topic trạng thái đơn hàng pizza
-]
+# Giới hạn số dòng log INFO cho mỗi sự kiện mỗi giây (khi tải cao)
+set_event_log_rate(SYS_CONFIG["logging"]["event_log_max_per_second"])
+
+# Group ID của Consumer và các Kafka topic cần tiêu thụ dữ liệu (topic trạng thái đơn hàng pizza)
+GROUP_ID, CONSUME_TOPICS = get_consumer_group(SYS_CONFIG, SCRIPT, HOSTNAME)
 
 # Thiết lập Kafka Consumer
 _, _, CONSUMER, _ = set_producer_consumer(
     kafka_config_file,
     disable_producer=True,  # Không cần Producer trong script này
     consumer_extra_config={
-        "group.id": f"""{SYS_CONFIG["kafka-consumer-group-id"]["microservice_status"]}_{HOSTNAME}""",  # Đặt Group ID cho Consumer
+        "group.id": GROUP_ID,  # Đặt Group ID cho Consumer
         "client.id": f"""{SYS_CONFIG["kafka-client-id"]["microservice_status"]}_{HOSTNAME}""",  # Đặt ID cho Client
     },
 )
 
+# Cấu hình xử lý sự kiện theo lô (số sự kiện mỗi lần consume và tần suất commit)
+CONSUMER_BATCH = SYS_CONFIG["kafka-consumer-batch"]
+
+# Commit offset một lần cho mỗi lô sự kiện thay vì cho từng sự kiện
+COMMITTER = BatchCommitter(
+    CONSUMER,
+    commit_every_messages=CONSUMER_BATCH["commit_every_messages"],
+    commit_interval_seconds=CONSUMER_BATCH["commit_interval_seconds"],
+)
+
 # Khởi tạo GracefulShutdown để quản lý quá trình dừng an toàn của Consumer
-graceful_shutdown = GracefulShutdown(consumer=CONSUMER)
+graceful_shutdown = GracefulShutdown(consumer=CONSUMER, committer=COMMITTER)
 
 # Import lớp lưu trữ trạng thái và xác định tên cơ sở dữ liệu lưu trạng thái đơn hàng
 DB = import_state_store_class(SYS_CONFIG['state-store-orders']['db_module_class'])
 ORDERS_DB = SYS_CONFIG['state-store-orders']['name']
 
+# Bộ nhớ đệm đơn hàng dùng chung cho consumer và watchdog (giữ dữ liệu nhất quán giữa các luồng)
+ORDERS_CACHE = OrderCache(
+    max_size=SYS_CONFIG['state-store-orders']['cache_max_orders'],
+    ttl_seconds=SYS_CONFIG['state-store-orders']['cache_ttl_seconds'],
+)
+
+# Kết nối cơ sở dữ liệu dùng lâu dài cho consumer (mỗi lô sự kiện được ghi trong một transaction)
+STATE_STORE = CachedStateStore(
+    DB(
+        ORDERS_DB,
+        sys_config=SYS_CONFIG,
+        persistent=SYS_CONFIG['state-store-orders']['persistent_connection'],
+        journal_mode=SYS_CONFIG['state-store-orders'].get('journal_mode') or None,
+        synchronous=SYS_CONFIG['state-store-orders'].get('synchronous') or None,
+    ),
+    ORDERS_CACHE,
+)
+
+# Số luồng xử lý song song các sự kiện (0 = xử lý từng lô trong luồng consumer, một transaction mỗi lô)
+DISPATCHER_WORKERS = SYS_CONFIG['microservice-status']['dispatcher_workers']
+
+# Kết nối cơ sở dữ liệu riêng của mỗi luồng xử lý (một kết nối SQLite không dùng chung giữa các luồng)
+WORKER_STATE_STORE = local()
+
+# Máy trạng thái đơn hàng (nhãn, trạng thái kết thúc và bảng chuyển trạng thái được tính sẵn một lần)
+STATUS_ENGINE = StatusEngine.from_config(SYS_CONFIG)
+
+# Bộ hẹn giờ phát hiện đơn hàng bị kẹt: mỗi đơn hàng chưa kết thúc có một hạn chót (giây)
+STUCK_WATCHDOG = DeadlineScheduler()
+STATUS_TIMEOUT_SECONDS = SYS_CONFIG['state-store-orders']['status_invalid_timeout_minutes'] * 60
+STATUS_RETENTION_MS = int(SYS_CONFIG['state-store-orders']['table_status_retention_hours']) * 60 * 60 * 1000
+
+# Chỉ worker #0 (hoặc tiến trình duy nhất khi không chạy qua supervisor.py) thực hiện các công việc
+# trên cơ sở dữ liệu dùng chung: khôi phục hạn chót của các đơn hàng chưa kết thúc, báo cáo độ trễ
+# và dọn dẹp dữ liệu cũ (các worker khác chỉ hẹn giờ các đơn hàng mà chúng xử lý)
+MAIN_WORKER = (get_worker_id() or 0) == 0
+
+# Hàm restore_deadlines hẹn giờ các đơn hàng chưa kết thúc trong bảng trạng thái mà worker chưa theo dõi
+def restore_deadlines(db):
+    # Bỏ qua các bản ghi đã quá thời gian lưu trữ, chúng sẽ bị xóa bởi RETENTION_JOB
+    for order_id, data in db.get_pending_status().items():
+        if order_id not in STUCK_WATCHDOG and data["timestamp"] >= timestamp_now() - STATUS_RETENTION_MS:
+            STUCK_WATCHDOG.schedule(order_id, data["timestamp"] / 1000 + STATUS_TIMEOUT_SECONDS)
+
 # Thiết lập cơ sở dữ liệu và dọn dẹp dữ liệu cũ khi khởi động script
 with graceful_shutdown as _:
     with DB(ORDERS_DB, sys_config=SYS_CONFIG) as db:
         # Tạo bảng lưu trữ đơn hàng nếu chưa tồn tại
         db.create_order_table()
 
-        # Xóa các bản ghi đơn hàng cũ dựa vào thời gian lưu trữ được cấu hình
-        db.delete_past_timestamp(
-            SYS_CONFIG['state-store-orders']['table_orders'],
-            hours=int(SYS_CONFIG['state-store-orders']['table_orders_retention_hours'])
-        )
-
         # Tạo bảng trạng thái đơn hàng nếu chưa tồn tại
         db.create_status_table()
 
-        # Xóa các bản ghi trạng thái cũ dựa vào thời gian lưu trữ được cấu hình
-        db.delete_past_timestamp(
-            SYS_CONFIG['state-store-orders']['table_status'],
-            hours=int(SYS_CONFIG['state-store-orders']['table_status_retention_hours'])
-        )
+        # Tạo bảng lưu ngữ cảnh truy vết (độ trễ từng công đoạn) của đơn hàng nếu chưa tồn tại
+        db.create_trace_table()
+
+        # Ghi log kế hoạch truy vấn (EXPLAIN QUERY PLAN) để kiểm tra các truy vấn có dùng index
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for query_name, query_plan in db.explain_query_plans().items():
+                logging.debug(f"Query plan '{query_name}': {' | '.join(query_plan)}")
+
+        # Khôi phục hạn chót của các đơn hàng chưa kết thúc từ bảng trạng thái
+        if MAIN_WORKER:
+            restore_deadlines(db)
+
+# Xóa các bản ghi cũ dựa vào thời gian lưu trữ được cấu hình, định kỳ và theo từng phần nhỏ
+# (mỗi phần một transaction) để không giữ khóa ghi của cơ sở dữ liệu quá lâu
+RETENTION_JOB = RetentionJob(
+    lambda: DB(ORDERS_DB, sys_config=SYS_CONFIG),
+    {
+        SYS_CONFIG['state-store-orders']['table_orders']: int(SYS_CONFIG['state-store-orders']['table_orders_retention_hours']),
+        SYS_CONFIG['state-store-orders']['table_status']: int(SYS_CONFIG['state-store-orders']['table_status_retention_hours']),
+        SYS_CONFIG['state-store-orders']['table_traces']: int(SYS_CONFIG['state-store-orders']['table_traces_retention_hours']),
+    },
+    interval_seconds=SYS_CONFIG['state-store-orders']['retention_interval_minutes'] * 60,
+    chunk_size=SYS_CONFIG['state-store-orders']['retention_chunk_size'],
+    pause_seconds=SYS_CONFIG['state-store-orders']['retention_chunk_pause_seconds'],
+)
 
 # Hàm thread_status_watchdog dùng để kiểm tra các đơn hàng bị kẹt
 def thread_status_watchdog():
-    # Hàm kiểm tra và cập nhật trạng thái đơn hàng kẹt
+    # Hàm chờ đến đúng hạn chót của các đơn hàng và cập nhật trạng thái đơn hàng kẹt
+    restore_at = time.monotonic() + STATUS_TIMEOUT_SECONDS
     while True:
-        with DB(ORDERS_DB, sys_config=SYS_CONFIG) as db:
-            # Kiểm tra trạng thái đơn hàng bị kẹt
-            stuck_status = db.check_status_stuck()
-            for order_id, data in stuck_status.items():
+        # Chờ đến hạn chót sớm nhất (tối đa `status_watchdog_minutes`)
+        stuck_orders = STUCK_WATCHDOG.wait_due(
+            timeout=SYS_CONFIG['state-store-orders']['status_watchdog_minutes'] * 60
+        )
+
+        # Worker #0 khôi phục lại hạn chót sau mỗi khoảng thời gian chờ trạng thái, để các đơn hàng
+        # của một worker khác vừa khởi động lại (mất hạn chót trong bộ nhớ) vẫn được phát hiện bị kẹt
+        if MAIN_WORKER and time.monotonic() >= restore_at:
+            restore_at = time.monotonic() + STATUS_TIMEOUT_SECONDS
+            try:
+                with DB(ORDERS_DB, sys_config=SYS_CONFIG) as db:
+                    restore_deadlines(db)
+            except Exception:
+                log_exception("Unable to restore the deadlines of the pending orders", sys.exc_info())
+
+        if not stuck_orders:
+            continue
+
+        with CachedStateStore(DB(ORDERS_DB, sys_config=SYS_CONFIG), ORDERS_CACHE) as db, db.transaction():
+            # Kiểm tra lại trong cơ sở dữ liệu (chỉ các đơn hàng đến hạn): trạng thái của đơn hàng có thể
+            # đã được cập nhật bởi một tiến trình worker khác (khi chạy nhiều worker qua supervisor.py)
+            stuck_in_db = db.check_status_stuck(stuck_orders)
+            for order_id in stuck_orders:
+                # Bỏ qua nếu đơn hàng vừa nhận trạng thái mới (đã được hẹn giờ lại)
+                if order_id in STUCK_WATCHDOG or order_id not in stuck_in_db:
+                    continue
                 logging.warning(f"Order {order_id} is stuck")  # Ghi log cảnh báo nếu đơn hàng bị kẹt
                 # Cập nhật trạng thái đơn hàng là 'stuck'
-                db.update_order_status(order_id, SYS_CONFIG['status']['stuck'])
+                db.update_order_status(order_id, SYS_CONFIG['status-id']['stuck'])
                 # Xóa trạng thái bị kẹt khỏi bảng trạng thái
                 db.delete_stuck_status(order_id)
-        # Thời gian giữa các lần kiểm tra là khoảng thời gian cấu hình
-        time.sleep(SYS_CONFIG['state-store-orders']['status_watchdog_minutes'] * 60)
+
+# Hàm thread_trace_report tính phân phối độ trễ của từng công đoạn và tổng thời gian của đơn hàng
+def thread_trace_report():
+    window_seconds = SYS_CONFIG['state-store-orders']['trace_report_minutes'] * 60
+    while True:
+        time.sleep(window_seconds)
+        try:
+            # Các ngữ cảnh truy vết được ghi nhận trong khoảng thời gian vừa qua
+            with DB(ORDERS_DB, sys_config=SYS_CONFIG) as db:
+                traces = db.get_traces(since=timestamp_now() - int(window_seconds * 1000))
+            report = latency_report(list(traces.values()))
+            if not report["traces"]:
+                continue
+
+            # Xuất phân phối độ trễ (ms) ra số liệu đo lường
+            for hop, stats in [*report["hops"].items(), ("total", report["total"])]:
+                for quantile in ("p50", "p99"):
+                    REGISTRY.gauge(
+                        "order_latency_ms",
+                        help="Order latency per hop (and in total) over the last trace report window",
+                        labels={"hop": hop, "quantile": quantile},
+                    ).set(stats[quantile])
+
+            # Ghi log phân phối độ trễ và công đoạn chậm nhất
+            logging.info(
+                f"Order latency over {report['traces']} order(s): total p50={report['total']['p50']} ms, p99={report['total']['p99']} ms; "
+                + ", ".join(
+                    f"{hop} p50={stats['p50']} ms, p99={stats['p99']} ms"
+                    for hop, stats in report["hops"].items()
+                )
+            )
+            slowest = report["hops"][report["slowest"]]
+            logging.info(
+                f"Slowest stage: {report['slowest']} (p50={slowest['p50']} ms, p99={slowest['p99']} ms, mean={slowest['mean']} ms)"
+            )
+        except Exception:
+            log_exception("Unable to compute the order latency report", sys.exc_info())
+
+# Hàm process_status_event cập nhật trạng thái đơn hàng trong cơ sở dữ liệu cho một sự kiện Kafka
+@timed("event_handling", label="handler")
+def process_status_event(db, event):
+    """Xử lý một sự kiện từ topic pizza-status trong transaction hiện tại của `db` (không commit offset)"""
+    if event.error():  # Kiểm tra lỗi từ sự kiện
+        logging.error(event.error())
+        return
+
+    # Khóa và nội dung sự kiện chỉ được giải mã một lần, dùng chung cho ghi log và xử lý
+    event = EventView(event)
+
+    try:
+        log_event_received(event)  # Ghi log khi nhận sự kiện
+
+        order_id = event.decoded_key  # Giải mã khóa đơn hàng từ Kafka event
+
+        # Lấy dữ liệu đơn hàng từ cơ sở dữ liệu
+        order_data = db.get_order_id(order_id)
+
+        if order_data is not None:
+            try:
+                # Giải mã và lấy trạng thái pizza từ nội dung Kafka event
+                pizza_status = event.data.get(
+                    "STATUS",
+                    SYS_CONFIG["status-id"]["unknown"],
+                )
+            except Exception:
+                # Xử lý ngoại lệ khi không lấy được trạng thái
+                pizza_status = SYS_CONFIG["status-id"]["something_wrong"]
+                log_exception(
+                    f"Error when processing event.value() {event.value()}",
+                    sys.exc_info(),
+                )
+
+            # Kiểm tra chuyển trạng thái so với trạng thái hiện tại của đơn hàng (không truy vấn thêm cơ sở dữ liệu):
+            # bỏ qua sự kiện trùng lặp, đến trễ (trạng thái lùi lại) hoặc đến sau khi đơn hàng đã kết thúc
+            transition = STATUS_ENGINE.transition(order_data["status"], pizza_status)
+            if transition != ACCEPTED:
+                logging.log(
+                    logging.INFO if transition == DUPLICATE else logging.WARNING,
+                    f"Order '{order_id}' status {STATUS_ENGINE.describe(pizza_status)} ignored ({TRANSITION_NAMES[transition]}), current status: {STATUS_ENGINE.describe(order_data['status'])}",
+                )
+                return
+
+            # Ghi log trạng thái mới của đơn hàng
+            logging.info(f"Order '{order_id}' status updated: {STATUS_ENGINE.describe(pizza_status)}")
+            # Cập nhật trạng thái đơn hàng trong cơ sở dữ liệu
+            db.update_order_status(order_id, pizza_status)
+            # Thêm trạng thái vào bảng trạng thái
+            db.upsert_status(order_id, pizza_status)
+
+            # Ghi nhận ngữ cảnh truy vết (nếu sự kiện có header `pizza-trace`) kèm thời điểm nhận trạng thái
+            trace = TraceContext.from_event(event)
+            if trace is not None:
+                db.upsert_trace(order_id, trace.hop("status").hops)
+
+            # Xóa trạng thái khỏi bảng trạng thái nếu đơn hàng đã kết thúc, gặp lỗi hoặc bị kẹt
+            if STATUS_ENGINE.is_settled(pizza_status):
+                db.delete_stuck_status(order_id)
+                # Hủy hạn chót của đơn hàng đã kết thúc
+                STUCK_WATCHDOG.cancel(order_id)
+            else:
+                # Đặt (lại) hạn chót phát hiện đơn hàng bị kẹt
+                STUCK_WATCHDOG.schedule(order_id, timestamp_now() / 1000 + STATUS_TIMEOUT_SECONDS)
+        else:
+            logging.error(f"Order '{order_id}' not found")  # Log lỗi nếu không tìm thấy đơn hàng
+    except Exception:
+        # Log ngoại lệ nếu có lỗi trong quá trình xử lý khóa sự kiện
+        log_exception(
+            f"Error when processing event.key() {event.key()}",
+            sys.exc_info(),
+        )
+
+# Hàm handle_status_event xử lý một sự kiện trong luồng của DISPATCHER (một transaction mỗi sự kiện)
+def handle_status_event(event):
+    if not hasattr(WORKER_STATE_STORE, "db"):
+        WORKER_STATE_STORE.db = CachedStateStore(
+            DB(
+                ORDERS_DB,
+                sys_config=SYS_CONFIG,
+                persistent=True,
+                journal_mode=SYS_CONFIG['state-store-orders'].get('journal_mode') or None,
+                synchronous=SYS_CONFIG['state-store-orders'].get('synchronous') or None,
+            ),
+            ORDERS_CACHE,
+        )
+    with WORKER_STATE_STORE.db as db, db.transaction():
+        process_status_event(db, event)
+
+# Xử lý song song theo order_id: các sự kiện của cùng một đơn hàng luôn được xử lý theo thứ tự
+# bởi cùng một luồng, offset chỉ được commit khi mọi sự kiện trước đó của partition đã xử lý xong
+if DISPATCHER_WORKERS > 0:
+    OFFSETS = OffsetTracker(consumer=CONSUMER)
+    DISPATCHER = KeyedDispatcher(
+        handle_status_event,
+        workers=DISPATCHER_WORKERS,
+        offsets=OFFSETS,
+        max_queued=CONSUMER_BATCH["num_messages"],
+        name="status",
+    )
+    graceful_shutdown.committer = OFFSETS
+else:
+    OFFSETS = DISPATCHER = None
+
+# Hàm partitions_revoked xử lý xong các sự kiện đã nhận và commit offset trước khi mất partition
+def partitions_revoked(consumer, partitions):
+    DISPATCHER.drain()
+    OFFSETS.commit()
+    OFFSETS.forget(partitions)
 
 # Hàm get_pizza_status lắng nghe Kafka topic để cập nhật trạng thái đơn hàng trong cơ sở dữ liệu
 def get_pizza_status():
     """Subscribe vào topic pizza-status để cập nhật cơ sở dữ liệu tạm thời (order_ids dict)"""
-    CONSUMER.subscribe(CONSUME_TOPICS)  # Đăng ký vào các Kafka topic cần tiêu thụ
+    # Đăng ký vào các Kafka topic cần tiêu thụ
+    if DISPATCHER is None:
+        CONSUMER.subscribe(CONSUME_TOPICS)
+    else:
+        CONSUMER.subscribe(CONSUME_TOPICS, on_revoke=partitions_revoked)
     logging.info(f"Subscribed to topic(s): {', '.join(CONSUME_TOPICS)}")
 
     # Vòng lặp lắng nghe sự kiện Kafka
     while True:
         with graceful_shutdown as _:
-            event = CONSUMER.poll(1)  # Chờ và nhận sự kiện từ Kafka
-
-            if event is not None:
-                if event.error():  # Kiểm tra lỗi từ sự kiện
-                    logging.error(event.error())
-                else:
-                    try:
-                        log_event_received(event)  # Ghi log khi nhận sự kiện
-
-                        order_id = event.key().decode()  # Giải mã khóa đơn hàng từ Kafka event
-
-                        with DB(ORDERS_DB, sys_config=SYS_CONFIG) as db:
-                            # Lấy dữ liệu đơn hàng từ cơ sở dữ liệu
-                            order_data = db.get_order_id(order_id)
-
-                            if order_data is not None:
-                                try:
-                                    # Giải mã và lấy trạng thái pizza từ nội dung Kafka event
-                                    pizza_status = json.loads(event.value().decode()).get(
-                                        "STATUS",
-                                        SYS_CONFIG["status-id"]["unknown"],
-                                    )
-                                except Exception:
-                                    # Xử lý ngoại lệ khi không lấy được trạng thái
-                                    pizza_status = SYS_CONFIG["status-id"]["something_wrong"]
-                                    log_exception(
-                                        f"Error when processing event.value() {event.value()}",
-                                        sys.exc_info(),
-                                    )
-                                finally:
-                                    # Ghi log trạng thái mới của đơn hàng
-                                    logging.info(
-                                        f"""Order '{order_id}' status updated: {get_string_status(SYS_CONFIG["status"], pizza_status)} ({pizza_status})"""
-                                    )
-                                    # Cập nhật trạng thái đơn hàng trong cơ sở dữ liệu
-                                    db.update_order_status(order_id, pizza_status)
-                                    # Thêm trạng thái vào bảng trạng thái
-                                    db.upsert_status(order_id, pizza_status)
-
-                                    # Xóa trạng thái khỏi bảng trạng thái nếu đơn hàng đã kết thúc hoặc gặp lỗi
-                                    if int(pizza_status) in (
-                                        SYS_CONFIG["status-id"]["stuck"],
-                                        SYS_CONFIG["status-id"]["cancelled"],
-                                        SYS_CONFIG["status-id"]["delivered"],
-                                        SYS_CONFIG["status-id"]["something_wrong"],
-                                        SYS_CONFIG["status-id"]["unknown"],
-                                    ):
-                                        db.delete_stuck_status(order_id)
-                            else:
-                                logging.error(f"Order '{order_id}' not found")  # Log lỗi nếu không tìm thấy đơn hàng
-                    except Exception:
-                        # Log ngoại lệ nếu có lỗi trong quá trình xử lý khóa sự kiện
-                        log_exception(
-                            f"Error when processing event.key() {event.key()}",
-                            sys.exc_info(),
-                        )
-
-                # Commit offset một cách thủ công để Kafka biết sự kiện đã được xử lý
-                CONSUMER.commit(asynchronous=False)
+            # Nhận tối đa `num_messages` sự kiện trong một lần gọi
+            events = CONSUMER.consume(
+                num_messages=CONSUMER_BATCH["num_messages"],
+                timeout=CONSUMER_BATCH["timeout_seconds"],
+            )
+
+            if DISPATCHER is not None:
+                # Phân phối các sự kiện cho các luồng xử lý theo order_id
+                for event in events:
+                    DISPATCHER.submit(event)
+
+                if graceful_shutdown.was_signal_set:
+                    # Chờ các sự kiện đã nhận được xử lý xong trước khi dừng
+                    DISPATCHER.shutdown(wait=True)
+
+                # Commit offset liên tiếp cao nhất đã xử lý xong của mỗi partition
+                OFFSETS.commit()
+                continue
+
+            # Xử lý toàn bộ lô sự kiện trong một transaction (một lần fsync cho cả lô)
+            if events:
+                with STATE_STORE as db, db.transaction():
+                    for event in events:
+                        process_status_event(db, event)
+
+            # Commit offset một lần cho cả lô (hoặc khi đến hạn theo số lượng/thời gian)
+            COMMITTER.add(len(events))
+            COMMITTER.maybe_commit()
 
 ########
 # Main #
@@ -168,8 +395,21 @@ if __name__ == "__main__":
     # Lưu PID của tiến trình hiện tại để dễ dàng theo dõi và quản lý
     save_pid(SCRIPT)
 
+    # Xuất số liệu đo lường (độ trễ, thông lượng, thời gian truy vấn cơ sở dữ liệu)
+    start_metrics(SCRIPT, SYS_CONFIG["metrics"])
+
+    # Theo dõi độ trễ (lag) của consumer group và đề xuất số worker cần thiết
+    start_lag_monitor(kafka_config_file, {GROUP_ID: CONSUME_TOPICS}, SYS_CONFIG["lag-monitor"])
+
     # Khởi động luồng kiểm tra trạng thái bị kẹt của đơn hàng
     Thread(target=thread_status_watchdog, daemon=True).start()
 
+    if MAIN_WORKER:
+        # Khởi động luồng báo cáo độ trễ của đơn hàng qua từng công đoạn
+        Thread(target=thread_trace_report, daemon=True).start()
+
+        # Khởi động luồng dọn dẹp dữ liệu cũ (chạy ngay và sau đó định kỳ)
+        Thread(target=RETENTION_JOB.run, daemon=True).start()
+
     # Bắt đầu quá trình lắng nghe trạng thái đơn hàng
     get_pizza_status()
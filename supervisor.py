@@ -0,0 +1,66 @@
+import os
+import sys
+import logging
+
+from utils import (
+    log_ini,
+    save_pid,
+    get_script_name,
+    bootstrap_topics,
+    get_system_config,
+    validate_cli_args,
+    set_producer_consumer,
+)
+from utils.supervisor import Supervisor
+
+
+SCRIPT = get_script_name(__file__)
+
+log_ini(SCRIPT)
+
+# Usage: supervisor.py {SERVICE} {KAFKA_CONFIG_FILE} {SYS_CONFIG_FILE}, e.g. supervisor.py msvc_bake kafka.ini default.ini
+if len(sys.argv) <= 1 or not os.path.isfile(f"{get_script_name(sys.argv[1])}.py"):
+    logging.error(
+        (
+            f"Missing or invalid service. Usage: {SCRIPT}.py {{SERVICE}} {{KAFKA_CONFIG_FILE}} {{SYS_CONFIG_FILE}}\n"
+            "Where:\n"
+            " - SERVICE: microservice script to run, e.g. 'msvc_assemble'\n"
+        )
+    )
+    sys.exit(0)
+SERVICE = get_script_name(sys.argv.pop(1))
+
+kafka_config_file, sys_config_file = validate_cli_args(SCRIPT)
+SYS_CONFIG = get_system_config(sys_config_file)
+
+# One worker per core, but no more than partitions to be shared among the workers (if not set)
+WORKERS = SYS_CONFIG["supervisor"]["workers"] or min(
+    os.cpu_count() or 1,
+    int(SYS_CONFIG["kafka-topic-config"]["num_partitions"]),
+)
+
+
+if __name__ == "__main__":
+    # Save PID
+    save_pid(f"{SCRIPT}_{SERVICE}")
+
+    # Create the pipeline topics missing from the cluster (single batched request)
+    if SYS_CONFIG["kafka-topic-config"]["bootstrap_topics"]:
+        _, _, _, admin_client = set_producer_consumer(
+            kafka_config_file,
+            disable_producer=True,
+            disable_consumer=True,
+        )
+        for topic, result in bootstrap_topics(admin_client, SYS_CONFIG).items():
+            logging.info(f"Topic '{topic}': {result}")
+
+    logging.info(f"Starting {WORKERS} worker(s) of {SERVICE}")
+    sys.exit(
+        Supervisor(
+            [sys.executable, f"{SERVICE}.py", sys.argv[1], sys.argv[2]],
+            workers=WORKERS,
+            restart_delay_seconds=SYS_CONFIG["supervisor"]["restart_delay_seconds"],
+            max_restart_delay_seconds=SYS_CONFIG["supervisor"]["max_restart_delay_seconds"],
+            shutdown_timeout_seconds=SYS_CONFIG["supervisor"]["shutdown_timeout_seconds"],
+        ).run()
+    )
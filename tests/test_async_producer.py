@@ -0,0 +1,144 @@
+import signal
+
+import pytest
+
+from utils import AsyncProducer, GracefulShutdown, delivery_report
+from utils.metrics import REGISTRY
+
+
+class Message:
+    def __init__(self, topic: str, key, value):
+        self._topic, self._key, self._value = topic, key, value
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return 0
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+
+class Producer:
+    """
+    Stand-in for confluent_kafka.Producer: events await delivery until polled, each
+    blocking poll (timeout > 0) delivering up to `deliver_per_poll` of them (all of
+    them on flush)
+    """
+
+    def __init__(self, max_queued: int = 1000, deliver_per_poll: int = 0):
+        self.max_queued = max_queued
+        self.deliver_per_poll = deliver_per_poll
+        self.pending = list()
+        self.polls = 0
+        self.buffer_errors = 0
+        self.max_pending = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def produce(self, topic: str, key=None, value=None, on_delivery=None, **kwargs):
+        if len(self.pending) >= self.max_queued:
+            self.buffer_errors += 1
+            raise BufferError("Local: Queue full")
+        self.pending.append((on_delivery, Message(topic, key, value)))
+        self.max_pending = max(self.max_pending, len(self.pending))
+
+    def deliver(self, count: int) -> int:
+        delivered, self.pending = self.pending[:count], self.pending[count:]
+        for on_delivery, msg in delivered:
+            if on_delivery is not None:
+                on_delivery(None, msg)
+        return len(delivered)
+
+    def poll(self, timeout: float = None) -> int:
+        self.polls += 1
+        return self.deliver(self.deliver_per_poll if timeout else 0)
+
+    def flush(self, timeout: float = None) -> int:
+        self.deliver(len(self.pending))
+        return len(self.pending)
+
+
+@pytest.fixture
+def restore_signals():
+    handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+    yield
+    for sig, handler in handlers.items():
+        signal.signal(sig, handler)
+
+
+def test_no_flush_per_event():
+    producer = Producer()
+    delivered = list()
+    async_producer = AsyncProducer(producer)
+    for n in range(10):
+        async_producer.produce("pizza-status", key=f"order-{n}", value="{}", on_delivery=lambda err, msg: delivered.append(msg.key()))
+    # Served by poll(0) after each produce, nothing delivered by this producer until flushed
+    assert producer.polls == 10
+    assert len(async_producer) == 10 and delivered == list()
+    assert async_producer.flush() == 0
+    assert delivered == [f"order-{n}" for n in range(10)]
+
+
+def test_flush_on_shutdown(restore_signals):
+    producer = Producer()
+    delivered = list()
+    async_producer = AsyncProducer(producer)
+    shutdown = GracefulShutdown(producer=async_producer)
+    with pytest.raises(SystemExit):
+        with shutdown:
+            for n in range(3):
+                async_producer.produce("pizza-status", key=f"order-{n}", on_delivery=lambda err, msg: delivered.append(err))
+            shutdown.signal_handler(signal.SIGTERM, None)
+    # Delivery callbacks fired before exiting
+    assert delivered == [None, None, None]
+    assert len(async_producer) == 0
+
+
+def test_backpressure_max_in_flight():
+    producer = Producer(deliver_per_poll=1)
+    delivered = list()
+    async_producer = AsyncProducer(producer, max_in_flight=3, backpressure_timeout=0.001)
+    for n in range(20):
+        async_producer.produce("pizza-status", key=f"order-{n}", on_delivery=lambda err, msg: delivered.append(msg.key()))
+    assert producer.max_pending <= 3
+    async_producer.flush()
+    assert delivered == [f"order-{n}" for n in range(20)]
+
+
+def test_backpressure_queue_full():
+    producer = Producer(max_queued=2, deliver_per_poll=1)
+    async_producer = AsyncProducer(producer, backpressure_timeout=0.001)
+    for n in range(10):
+        async_producer.produce("pizza-status", key=f"order-{n}")
+    # librdkafka queue full: polled (deliveries served) until there is room again
+    assert producer.buffer_errors > 0
+    assert producer.max_pending <= 2
+    assert async_producer.flush() == 0
+
+
+def test_events_counted_per_topic():
+    counter = REGISTRY.counter("producer_events_total", labels={"topic": "pizza-test-counted"})
+    before = counter.value
+    async_producer = AsyncProducer(Producer())
+    for _ in range(4):
+        async_producer.produce("pizza-test-counted", key="order-1")
+    assert counter.value == before + 4
+
+
+def test_deliveries_counted_per_topic_and_result():
+    ok = REGISTRY.counter("producer_deliveries_total", labels={"topic": "pizza-test-delivered", "result": "ok"})
+    error = REGISTRY.counter("producer_deliveries_total", labels={"topic": "pizza-test-delivered", "result": "error"})
+    before = ok.value, error.value
+    msg = Message("pizza-test-delivered", b"order-1", b"{}")
+    for err in (None, None, "Broker: Message timed out"):
+        delivery_report(err, msg)
+    assert (ok.value, error.value) == (before[0] + 2, before[1] + 1)
@@ -0,0 +1,107 @@
+import signal
+
+import pytest
+
+from utils import BatchCommitter, GracefulShutdown
+
+
+class Consumer:
+    def __init__(self):
+        self.commits = 0
+        self.fail = False
+        self.closed = False
+
+    def commit(self, asynchronous: bool = True):
+        if self.fail:
+            raise RuntimeError("commit failed")
+        self.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+class Producer:
+    def __init__(self, remaining: int = 0):
+        self.flushes = 0
+        self.remaining = remaining
+
+    def flush(self, timeout: float = None) -> int:
+        self.flushes += 1
+        return self.remaining
+
+
+@pytest.fixture
+def consumer():
+    return Consumer()
+
+
+@pytest.fixture
+def restore_signals():
+    handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+    yield
+    for sig, handler in handlers.items():
+        signal.signal(sig, handler)
+
+
+def test_commit_every_messages(consumer):
+    committer = BatchCommitter(consumer, commit_every_messages=3, commit_interval_seconds=3600)
+    assert not committer.maybe_commit()
+    committer.add()
+    committer.add()
+    assert not committer.maybe_commit()
+    committer.add()
+    assert committer.maybe_commit()
+    assert consumer.commits == 1 and committer.pending == 0
+    committer.add(5)
+    assert committer.maybe_commit()
+    assert consumer.commits == 2
+
+
+def test_commit_interval(consumer):
+    committer = BatchCommitter(consumer, commit_every_messages=100, commit_interval_seconds=5)
+    committer.add()
+    assert not committer.maybe_commit()
+    committer.last_commit -= 5
+    assert committer.maybe_commit()
+    assert consumer.commits == 1
+    # Nothing pending: no commit however long ago the last one was
+    committer.last_commit -= 5
+    assert not committer.maybe_commit()
+    assert consumer.commits == 1
+
+
+def test_flush_before_commit(consumer):
+    producer = Producer(remaining=1)
+    committer = BatchCommitter(consumer, producer=producer)
+    committer.add()
+    # Events produced while handling not delivered: offsets are not committed
+    assert not committer.maybe_commit()
+    assert producer.flushes == 1 and consumer.commits == 0 and committer.pending == 1
+    producer.remaining = 0
+    assert committer.maybe_commit()
+    assert consumer.commits == 1
+
+
+def test_failed_commit_kept_pending(consumer):
+    committer = BatchCommitter(consumer)
+    committer.add()
+    consumer.fail = True
+    assert not committer.maybe_commit()
+    assert committer.pending == 1
+    consumer.fail = False
+    assert committer.maybe_commit()
+
+
+def test_final_commit_on_shutdown(consumer, restore_signals):
+    producer = Producer()
+    committer = BatchCommitter(consumer, commit_every_messages=100, commit_interval_seconds=3600, producer=producer)
+    shutdown = GracefulShutdown(consumer=consumer, committer=committer, producer=producer)
+    with pytest.raises(SystemExit):
+        with shutdown:
+            committer.add()
+            assert not committer.maybe_commit()
+            shutdown.signal_handler(signal.SIGTERM, None)
+    # Pending events committed (after flushing the producer) before the consumer is closed
+    assert consumer.commits == 1 and committer.pending == 0
+    assert producer.flushes >= 1
+    assert consumer.closed
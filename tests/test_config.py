@@ -0,0 +1,29 @@
+import os
+from configparser import ConfigParser
+
+from utils import SYS_CONFIG_DEFAULTS, get_system_config
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_INI = os.path.join(ROOT, "config_sys", "default.ini")
+
+
+def test_config_without_new_sections(tmp_path):
+    # default.ini without the sections and keys added after the first release
+    config_parser = ConfigParser(interpolation=None)
+    config_parser.read(DEFAULT_INI)
+    for section, defaults in SYS_CONFIG_DEFAULTS.items():
+        for key in defaults:
+            config_parser.remove_option(section, key)
+        if not config_parser.options(section):
+            config_parser.remove_section(section)
+    assert not config_parser.has_section("metrics")
+    old_ini = tmp_path / "old.ini"
+    with open(old_ini, "w") as f:
+        config_parser.write(f)
+
+    sys_config = get_system_config(str(old_ini))
+    expected = get_system_config(DEFAULT_INI)
+    for section, defaults in SYS_CONFIG_DEFAULTS.items():
+        for key in defaults:
+            assert sys_config[section][key] == expected[section][key], (section, key)
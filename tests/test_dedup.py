@@ -0,0 +1,67 @@
+import time
+
+from utils.dedup import BloomFilter, DedupWindow
+
+
+def false_positive_rate(contains, lookups: int) -> float:
+    return sum(contains(f"missing-{n}") for n in range(lookups)) / lookups
+
+
+def test_bloom_filter_false_positive_rate():
+    for capacity, error_rate in ((1000, 1e-3), (250, 1e-3), (5000, 1e-2)):
+        bloom = BloomFilter(capacity, error_rate)
+        for n in range(capacity):
+            bloom.add(BloomFilter.digest(f"key-{n}"))
+        assert all(bloom.contains(BloomFilter.digest(f"key-{n}")) for n in range(capacity))
+        rate = false_positive_rate(lambda key: bloom.contains(BloomFilter.digest(key)), 200000)
+        assert rate < error_rate * 1.5, (capacity, error_rate, rate)
+
+
+def test_window_false_positive_rate():
+    window = DedupWindow(3600, 1000, error_rate=1e-3)
+    for n in range(1000):
+        window.add("pizza-ordered", n)
+    assert all(window.seen("pizza-ordered", n) for n in range(1000))
+    rate = false_positive_rate(lambda key: window.seen("pizza-ordered", key), 200000)
+    assert rate < 1e-3 * 1.5, rate
+
+
+def test_window_expires_keys():
+    window = DedupWindow(4, 100, error_rate=1e-3, generations=2)
+    now = time.time()
+    with window.lock:
+        window.rotate(now)
+    window.add("pizza-ordered", "order-1")
+    with window.lock:
+        window.rotate(now + 2)
+    assert window.seen("pizza-ordered", "order-1")
+    with window.lock:
+        window.rotate(now + 7)
+    assert not window.seen("pizza-ordered", "order-1")
+
+
+def test_window_persisted(tmp_path):
+    file = str(tmp_path / "window.dedup")
+    window = DedupWindow(3600, 1000, file=file)
+    window.add("pizza-baked", "order-1", 200)
+    window.save()
+    assert DedupWindow(3600, 1000, file=file).seen("pizza-baked", "order-1", 200)
+    # Saved with other settings: ignored
+    assert not DedupWindow(60, 1000, file=file).seen("pizza-baked", "order-1", 200)
+
+
+def test_window_shared_by_workers(tmp_path):
+    file = str(tmp_path / "msvc_assemble.dedup")
+    worker_0 = DedupWindow(3600, 1000, file=file)
+    worker_1 = DedupWindow(3600, 1000, file=file)
+    worker_0.add("pizza-ordered", "order-1")
+    worker_1.add("pizza-ordered", "order-2")
+    # Partitions revoked from worker 0, assigned to worker 1
+    worker_0.save()
+    worker_1.save()
+    assert worker_1.seen("pizza-ordered", "order-1")
+    worker_0.save()
+    assert worker_0.seen("pizza-ordered", "order-2")
+    assert not worker_0.seen("pizza-ordered", "order-3")
+    restarted = DedupWindow(3600, 1000, file=file)
+    assert restarted.seen("pizza-ordered", "order-1") and restarted.seen("pizza-ordered", "order-2")
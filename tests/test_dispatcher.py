@@ -0,0 +1,198 @@
+import time
+import random
+import threading
+
+import pytest
+
+pytest.importorskip("confluent_kafka")
+
+from utils import OffsetTracker, KeyedDispatcher
+
+
+TOPIC = "pizza-ordered"
+
+
+class Event:
+    def __init__(self, partition: int, offset: int, key: str = None):
+        self._partition = partition
+        self._offset = offset
+        self._key = None if key is None else key.encode()
+
+    def topic(self) -> str:
+        return TOPIC
+
+    def partition(self) -> int:
+        return self._partition
+
+    def offset(self) -> int:
+        return self._offset
+
+    def key(self) -> bytes:
+        return self._key
+
+
+class Consumer:
+    """Records the committed offsets, {partition: offset}"""
+
+    def __init__(self):
+        self.committed = dict()
+        self.fail = False
+
+    def commit(self, offsets: list = None, asynchronous: bool = True):
+        if self.fail:
+            raise RuntimeError("commit failed")
+        for tp in offsets:
+            self.committed[tp.partition] = tp.offset
+
+
+@pytest.fixture
+def consumer():
+    return Consumer()
+
+
+def test_commit_highest_contiguous_offset(consumer):
+    offsets = OffsetTracker(consumer=consumer)
+    for offset in range(10, 15):
+        offsets.track(TOPIC, 0, offset)
+    offsets.track(TOPIC, 1, 7)
+
+    # Completed out of order: nothing committed while offset 10 is in flight
+    for offset in (12, 11, 14):
+        offsets.done(TOPIC, 0, offset)
+    assert not offsets.commit()
+    assert consumer.committed == dict()
+    assert offsets.in_flight() == 6
+
+    offsets.done(TOPIC, 0, 10)
+    offsets.done(TOPIC, 1, 7)
+    assert offsets.commit()
+    # Next offset to consume: 13 is still in flight
+    assert consumer.committed == {0: 13, 1: 8}
+    assert not offsets.commit()
+
+    offsets.done(TOPIC, 0, 13)
+    assert offsets.commit()
+    assert consumer.committed == {0: 15, 1: 8}
+    assert offsets.in_flight() == 0
+
+
+def test_failed_commit_retried(consumer):
+    offsets = OffsetTracker(consumer=consumer)
+    offsets.track(TOPIC, 0, 0)
+    offsets.track(TOPIC, 0, 1)
+    offsets.done(TOPIC, 0, 0)
+    consumer.fail = True
+    assert not offsets.commit()
+    consumer.fail = False
+    offsets.done(TOPIC, 0, 1)
+    assert offsets.commit()
+    assert consumer.committed == {0: 2}
+
+
+def test_forget_revoked_partition(consumer):
+    offsets = OffsetTracker(consumer=consumer)
+    offsets.track(TOPIC, 0, 0)
+    offsets.track(TOPIC, 1, 0)
+    offsets.done(TOPIC, 0, 0)
+
+    class Partition:
+        topic, partition = TOPIC, 0
+
+    offsets.forget([Partition()])
+    # Late completions of a revoked partition are ignored
+    offsets.done(TOPIC, 0, 1)
+    offsets.done(TOPIC, 1, 0)
+    assert offsets.commit()
+    assert consumer.committed == {1: 1}
+
+
+def test_order_kept_per_key(consumer):
+    handled = list()
+    lock = threading.Lock()
+
+    def handler(event):
+        time.sleep(random.random() / 1000)
+        with lock:
+            handled.append((event.key(), event.offset()))
+
+    offsets = OffsetTracker(consumer=consumer)
+    dispatcher = KeyedDispatcher(handler, workers=4, offsets=offsets, max_queued=0)
+    keys = [f"order-{n}" for n in range(8)]
+    for offset in range(200):
+        dispatcher.submit(Event(offset % 2, offset, random.choice(keys)))
+    dispatcher.drain()
+
+    assert len(handled) == 200
+    for key in keys:
+        key_offsets = [offset for k, offset in handled if k == key.encode()]
+        assert key_offsets == sorted(key_offsets)
+    assert offsets.commit()
+    assert consumer.committed == {0: 199, 1: 200}
+
+
+def test_offsets_done_out_of_order(consumer):
+    """Handler flagging offsets itself (e.g. on delivery), completed in reverse order"""
+    received = list()
+    offsets = OffsetTracker(consumer=consumer)
+    dispatcher = KeyedDispatcher(received.append, workers=3, offsets=offsets, complete_on_return=False)
+    for offset in range(6):
+        dispatcher.submit(Event(0, offset, f"order-{offset}"))
+    dispatcher.drain()
+    assert len(received) == 6
+    assert not offsets.commit()
+
+    for offset in (5, 4, 3, 1):
+        offsets.done(TOPIC, 0, offset)
+    assert not offsets.commit()
+    offsets.done(TOPIC, 0, 0)
+    assert offsets.commit()
+    assert consumer.committed == {0: 2}
+    offsets.done(TOPIC, 0, 2)
+    assert offsets.commit()
+    assert consumer.committed == {0: 6}
+
+
+def test_shutdown_drains_queued_events(consumer):
+    handled = list()
+
+    def handler(event):
+        time.sleep(0.01)
+        handled.append(event.offset())
+        if event.offset() == 3:
+            raise RuntimeError("handler failed")
+
+    offsets = OffsetTracker(consumer=consumer)
+    dispatcher = KeyedDispatcher(handler, workers=2, offsets=offsets, max_queued=0)
+    for offset in range(10):
+        dispatcher.submit(Event(0, offset))
+    dispatcher.shutdown(wait=True)
+
+    # Every queued event handled (a failing one too) before the workers stopped
+    assert sorted(handled) == list(range(10))
+    assert not any(thread.is_alive() for thread in dispatcher.threads)
+    assert offsets.commit()
+    assert consumer.committed == {0: 10}
+
+
+def test_shutdown_discards_queued_events(consumer):
+    started = threading.Event()
+    release = threading.Event()
+    handled = list()
+
+    def handler(event):
+        started.set()
+        release.wait(5)
+        handled.append(event.offset())
+
+    offsets = OffsetTracker(consumer=consumer)
+    dispatcher = KeyedDispatcher(handler, workers=1, offsets=offsets, max_queued=0)
+    for offset in range(5):
+        dispatcher.submit(Event(0, offset))
+    started.wait(5)
+    threading.Timer(0.05, release.set).start()
+    # Only the event being handled is finished, the queued ones are not committed
+    assert dispatcher.shutdown(wait=True, discard_queued=True) == 4
+    assert handled == [0]
+    assert offsets.commit()
+    assert consumer.committed == {0: 1}
+    assert offsets.in_flight() == 4
@@ -0,0 +1,203 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+from utils.ksqldb import KsqlDB, KsqlDBError, StreamingQuery
+
+
+HEADER = {
+    "queryId": "transient_PIZZA_STATUS_1",
+    "columnNames": ["ORDER_ID", "STATUS"],
+    "columnTypes": ["STRING", "INTEGER"],
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    ksqlDB stub: `/query-stream` answers according to the query ("rows", "big",
+    "error", "push" or "invalid"), in several HTTP chunks; `/close-query` records
+    the query id
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+        time.sleep(0.01)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/close-query":
+            self.server.closed_queries.append(body["queryId"])
+            data = b"{}"
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        sql = body["sql"]
+        if sql == "invalid":
+            data = json.dumps({"@type": "statement_error", "error_code": 40001, "message": "invalid"}).encode()
+            self.send_response(400)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", StreamingQuery.CONTENT_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.send_chunk(json.dumps(HEADER).encode() + b"\n")
+        if sql == "rows":
+            self.send_chunk(b'["order-1",100]\n["order-2",')
+            self.send_chunk(b"200]\n")
+            self.send_chunk(b'["order-3",300]')
+        elif sql == "big":
+            self.send_chunk(b'["' + b"x" * 4096)
+            self.send_chunk(b"x" * 4096 + b'",1]\n')
+        elif sql == "error":
+            self.send_chunk(b'["order-1",100]\n')
+            self.send_chunk(json.dumps({"@type": "generic_error", "error_code": 50000, "message": "boom"}).encode() + b"\n")
+        elif sql == "push":
+            self.send_chunk(b'["order-1",100]\n')
+            # Push query: never ends, until the client goes away
+            try:
+                while not self.server.stopping.is_set():
+                    time.sleep(0.05)
+                    self.send_chunk(b"\n")
+            except OSError:
+                return
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.closed_queries = list()
+    server.stopping = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.stopping.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def ksql(server):
+    with KsqlDB(end_point=f"http://127.0.0.1:{server.server_address[1]}", retries=0) as ksql:
+        yield ksql
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_header_and_rows(ksql):
+    with ksql.stream_query("rows") as query:
+        rows = list(query)
+    assert query.query_id == HEADER["queryId"]
+    assert query.columns == HEADER["columnNames"]
+    assert query.column_types == HEADER["columnTypes"]
+    assert rows == [
+        {"ORDER_ID": "order-1", "STATUS": 100},
+        {"ORDER_ID": "order-2", "STATUS": 200},
+        {"ORDER_ID": "order-3", "STATUS": 300},
+    ]
+    assert query.completed
+
+
+def test_rows_as_lists(ksql):
+    assert list(ksql.stream_query("rows", as_dict=False)) == [["order-1", 100], ["order-2", 200], ["order-3", 300]]
+
+
+def test_row_split_across_chunks(ksql):
+    # Chunks of a few bytes: every row is received in several pieces
+    query = StreamingQuery(ksql, "rows", chunk_size=5)
+    assert [row["ORDER_ID"] for row in query] == ["order-1", "order-2", "order-3"]
+
+
+def test_max_line_bytes(ksql):
+    with pytest.raises(KsqlDBError):
+        list(ksql.stream_query("big", max_line_bytes=1024))
+    assert len(list(ksql.stream_query("big", max_line_bytes=16384))) == 1
+
+
+def test_error_line(ksql):
+    query = ksql.stream_query("error")
+    rows = iter(query)
+    assert next(rows) == {"ORDER_ID": "order-1", "STATUS": 100}
+    with pytest.raises(KsqlDBError) as err:
+        next(rows)
+    assert err.value.status_code == 50000
+    assert "boom" in str(err.value)
+
+
+def test_http_error(ksql):
+    with pytest.raises(KsqlDBError) as err:
+        list(ksql.stream_query("invalid"))
+    assert err.value.status_code == 400
+
+
+def test_close_sends_close_query(ksql, server):
+    query = ksql.stream_query("push")
+    rows = iter(query)
+    assert next(rows) == {"ORDER_ID": "order-1", "STATUS": 100}
+    # Closed from several threads at once: a single /close-query
+    threads = [threading.Thread(target=query.close) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.closed_queries == [HEADER["queryId"]]
+    assert list(rows) == list()
+
+
+def test_completed_query_not_closed(ksql, server):
+    list(ksql.stream_query("rows"))
+    assert server.closed_queries == list()
+
+
+def test_async_rows(ksql):
+    async def read():
+        return [row async for row in ksql.astream_query("rows")]
+
+    assert [row["STATUS"] for row in asyncio.run(read())] == [100, 200, 300]
+
+
+def test_async_cancel(ksql, server):
+    received = list()
+
+    async def read():
+        async for row in ksql.astream_query("push"):
+            received.append(row)
+
+    async def main():
+        task = asyncio.create_task(read())
+        while not received:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert received == [{"ORDER_ID": "order-1", "STATUS": 100}]
+    assert wait_for(lambda: server.closed_queries == [HEADER["queryId"]])
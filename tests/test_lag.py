@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+pytest.importorskip("confluent_kafka")
+
+from confluent_kafka import TopicPartition
+
+from utils import get_system_config, get_consumer_groups
+from utils.fake_kafka import Broker, Producer, Consumer, AdminClient
+from utils.lag import LagMonitor, recommend_workers
+import utils.lag
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUP = "pizza_bake_test"
+TOPIC = "pizza-assembled"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(utils.lag.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def broker():
+    broker = Broker(num_partitions=2)
+    broker.create_topic(TOPIC)
+    return broker
+
+
+def produce(broker, count: int):
+    producer = Producer({}, broker=broker)
+    for n in range(count):
+        producer.produce(TOPIC, key=f"order-{n}", value="{}", partition=n % 2)
+    producer.flush()
+
+
+def commit(broker, offsets: dict):
+    Consumer({"group.id": GROUP}, broker=broker).commit(
+        offsets=[TopicPartition(TOPIC, partition, offset) for partition, offset in offsets.items()],
+        asynchronous=False,
+    )
+
+
+def monitor(broker, workers: int = 1) -> LagMonitor:
+    return LagMonitor(
+        lambda group: Consumer({"group.id": group}, broker=broker),
+        AdminClient({}, broker=broker),
+        {GROUP: [TOPIC, "pizza-unknown"]},
+        workers={GROUP: workers},
+        target_drain_seconds=10,
+    )
+
+
+def test_lag_and_recommended_workers(broker, clock):
+    produce(broker, 100)  # 50 per partition
+    commit(broker, {0: 10, 1: 20})
+    lag_monitor = monitor(broker)
+
+    group = lag_monitor.sample()["groups"][GROUP]
+    assert group["lag"] == 40 + 30
+    assert group["topics"][TOPIC]["partitions"] == {
+        0: {"committed": 10, "high": 50, "lag": 40},
+        1: {"committed": 20, "high": 50, "lag": 30},
+    }
+    assert "pizza-unknown" not in group["topics"]
+    # Rates need a previous sample
+    assert group["drain_rate"] is None and group["recommended_workers"] is None
+
+    # 10 seconds later: 20 events produced, 10 consumed (1/s per worker)
+    clock.now += 10
+    produce(broker, 20)
+    commit(broker, {0: 15, 1: 25})
+    group = lag_monitor.sample()["groups"][GROUP]
+    assert group["lag"] == 45 + 35
+    assert group["drain_rate"] == 1
+    assert group["produce_rate"] == 2
+    # 2/s produced + 80 lag over 10 s at 1/s per worker, capped by the partitions
+    assert group["recommended_workers"] == 2
+    lag_monitor.stop()
+
+
+def test_no_commit_skipped(broker, clock):
+    produce(broker, 10)
+    group = monitor(broker).sample()["groups"][GROUP]
+    assert group["lag"] == 0 and group["topics"] == dict()
+
+
+def test_recommend_workers():
+    # Keeping up: 10/s produced, 10/s drained by 2 workers, no lag
+    assert recommend_workers(0, 10, 10, 2, 6, 300) == 2
+    # 600 lag to drain in 60 s on top of 10/s produced: 20/s at 5/s per worker
+    assert recommend_workers(600, 10, 10, 2, 6, 60) == 4
+    # Capped by the number of partitions, at least one worker
+    assert recommend_workers(10 ** 6, 10, 10, 2, 6, 60) == 6
+    assert recommend_workers(0, 0, 10, 4, 6, 60) == 1
+    # Nothing consumed since the last sample
+    assert recommend_workers(0, 0, 0, 3, 6, 60) == 3
+    assert recommend_workers(5, 0, 0, 3, 6, 60) == 6
+
+
+def test_consumer_groups_of_services():
+    sys_config = get_system_config(os.path.join(ROOT, "config_sys", "default.ini"))
+    groups = get_consumer_groups(sys_config, "host")
+    topics = sys_config["kafka-topics"]
+    assert groups == {
+        f"{sys_config['kafka-consumer-group-id']['microservice_assembled']}_host": [topics["pizza_ordered"]],
+        f"{sys_config['kafka-client-id']['microservice_baked']}_host": [topics["pizza_assembled"]],
+        f"{sys_config['kafka-consumer-group-id']['microservice_status']}_host": [topics["pizza_status"]],
+    }
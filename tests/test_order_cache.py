@@ -0,0 +1,32 @@
+from utils.db import OrderCache
+from utils.metrics import REGISTRY
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def metric(counter: str, cache: str) -> float:
+    return REGISTRY.counter(f"order_cache_{counter}_total", labels={"cache": cache}).value
+
+
+def test_stats_published_to_registry():
+    clock = Clock()
+    cache = OrderCache(max_size=2, ttl_seconds=10, clock=clock, name="test_stats")
+    cache.put("order-1", {"status": 100})
+    assert cache.get("order-1") == {"status": 100}
+    assert cache.get("order-2") is None
+    cache.put("order-2", {"status": 100})
+    cache.put("order-3", {"status": 100})  # Evicts order-1
+    assert cache.get("order-1") is None
+    clock.now = 11
+    assert cache.get("order-3") is None  # Expired
+
+    stats = cache.stats()
+    assert stats == {"size": 1, "hits": 1, "misses": 3, "evictions": 1, "expirations": 1}
+    for counter in ("hits", "misses", "evictions", "expirations"):
+        assert metric(counter, "test_stats") == stats[counter]
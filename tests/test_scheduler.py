@@ -0,0 +1,87 @@
+import time
+import threading
+
+from utils.scheduler import DeadlineScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_schedule_cancel_reschedule():
+    clock = Clock()
+    scheduler = DeadlineScheduler(clock=clock)
+    scheduler.schedule("order-1", 110)
+    scheduler.schedule("order-2", 105)
+    scheduler.schedule("order-3", 120)
+    assert len(scheduler) == 3 and "order-1" in scheduler
+    assert scheduler.next_deadline() == 105
+
+    # Rescheduled later: its previous deadline is not due any more
+    scheduler.schedule("order-2", 115)
+    assert scheduler.cancel("order-3")
+    assert not scheduler.cancel("order-3")
+    assert "order-3" not in scheduler
+    assert scheduler.next_deadline() == 110
+
+    assert scheduler.pop_due(109) == list()
+    assert scheduler.pop_due(115) == ["order-1", "order-2"]
+    assert scheduler.pop_due(1000) == list()
+    assert len(scheduler) == 0 and scheduler.next_deadline() is None
+
+
+def test_lazy_deletion_and_compaction():
+    scheduler = DeadlineScheduler(clock=Clock())
+    for n in range(10):
+        scheduler.schedule(f"order-{n}", 200 + n)
+    # Replaced entries stay in the heap until compacted
+    for _ in range(20):
+        for n in range(10):
+            scheduler.schedule(f"order-{n}", 300 + n)
+    assert len(scheduler) == 10
+    assert len(scheduler.heap) <= 2 * len(scheduler) + 64 + 1
+
+    # Cancelled entries are discarded once they reach the top of the heap
+    for n in range(5):
+        scheduler.cancel(f"order-{n}")
+    assert scheduler.next_deadline() == 305
+    assert scheduler.heap[0][2] == "order-5"
+    assert scheduler.pop_due(400) == [f"order-{n}" for n in range(5, 10)]
+    assert scheduler.heap == list()
+
+
+def test_wait_due_earliest_first():
+    scheduler = DeadlineScheduler()
+    now = time.time()
+    for n, delay in enumerate((0.06, 0.02, 0.04)):
+        scheduler.schedule(f"order-{n}", now + delay)
+    due = list()
+    while len(due) < 3:
+        due.extend(scheduler.wait_due(timeout=1))
+    assert due == ["order-1", "order-2", "order-0"]
+    assert time.time() - now >= 0.06
+
+
+def test_wait_due_timeout():
+    scheduler = DeadlineScheduler()
+    scheduler.schedule("order-1", time.time() + 10)
+    started = time.monotonic()
+    assert scheduler.wait_due(timeout=0.05) == list()
+    assert 0.04 <= time.monotonic() - started < 1
+
+
+def test_wait_due_woken_by_sooner_deadline():
+    scheduler = DeadlineScheduler()
+    scheduler.schedule("order-1", time.time() + 10)
+    due = list()
+    waiter = threading.Thread(target=lambda: due.extend(scheduler.wait_due(timeout=5)))
+    waiter.start()
+    time.sleep(0.05)
+    scheduler.schedule("order-2", time.time() + 0.02)
+    waiter.join(2)
+    assert due == ["order-2"]
+    assert "order-1" in scheduler
@@ -0,0 +1,199 @@
+import os
+import copy
+
+import pytest
+
+from utils import get_system_config, import_state_store_class
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = ("utils.db.sqlite", "utils.db.memory")
+
+
+def order_details(customer_id: str = "customer-1") -> dict:
+    return {
+        "order": {
+            "username": "alice",
+            "customer_id": customer_id,
+            "sauce": "Pesto",
+            "cheese": "Gouda",
+            "main_topping": "Chicken",
+            "extra_toppings": ["Onion", "Egg"],
+        }
+    }
+
+
+@pytest.fixture
+def sys_config():
+    sys_config = copy.deepcopy(get_system_config(os.path.join(ROOT, "config_sys", "default.ini")))
+    # Every status older than a minute from now is stuck (no waiting in the tests)
+    sys_config["state-store-orders"]["status_invalid_timeout_minutes"] = -1
+    return sys_config
+
+
+@pytest.fixture(params=BACKENDS)
+def db(request, tmp_path, sys_config):
+    DB = import_state_store_class(request.param)
+    with DB(str(tmp_path / "orders.db"), sys_config=sys_config) as db:
+        db.create_order_table()
+        db.create_status_table()
+        db.create_trace_table()
+        db.create_customer_table()
+        yield db
+    db.close()
+
+
+def test_create_tables_twice(db):
+    db.create_order_table()
+    db.create_status_table()
+    db.create_trace_table()
+    db.create_customer_table()
+
+
+def test_add_and_get_order(db, sys_config):
+    db.add_order("order-1", order_details())
+    order = db.get_order_id("order-1")
+    assert order["order_id"] == "order-1"
+    assert order["username"] == "alice"
+    assert order["customer_id"] == "customer-1"
+    assert order["status"] == sys_config["status-id"]["order_placed"]
+    assert order["status_str"] == sys_config["status-label"]["order_placed"]
+    assert (order["sauce"], order["cheese"], order["topping"]) == ("Pesto", "Gouda", "Chicken")
+    assert order["extras"] == "Onion,Egg"
+    assert isinstance(order["timestamp"], int)
+    assert db.get_order_id("order-1", customer_id="customer-1")["order_id"] == "order-1"
+    assert db.get_order_id("order-1", customer_id="customer-2") is None
+    assert db.get_order_id("order-2") is None
+
+
+def test_add_order_twice(db):
+    db.add_order("order-1", order_details())
+    with pytest.raises(Exception):
+        db.add_order("order-1", order_details())
+
+
+def test_get_orders(db):
+    db.add_order("order-1", order_details())
+    db.add_order("order-2", order_details())
+    db.add_order("order-3", order_details("customer-2"))
+    orders = db.get_orders("customer-1")
+    assert set(orders) == {"order-1", "order-2"}
+    assert all(order["timestamp_str"] and order["status_str"] for order in orders.values())
+    assert db.get_orders("customer-3") == dict()
+
+
+def test_update_order_status(db, sys_config):
+    db.add_order("order-1", order_details())
+    db.update_order_status("order-1", sys_config["status-id"]["pizza_baked"])
+    order = db.get_order_id("order-1")
+    assert order["status"] == sys_config["status-id"]["pizza_baked"]
+    assert order["status_str"] == sys_config["status-label"]["pizza_baked"]
+    db.update_order_status("order-2", sys_config["status-id"]["pizza_baked"])
+    assert db.get_order_id("order-2") is None
+
+
+def test_status(db, sys_config):
+    status_id = sys_config["status-id"]
+    db.upsert_status("order-1", status_id["pizza_assembled"])
+    db.upsert_status("order-2", status_id["pizza_baked"])
+    db.upsert_status("order-2", status_id["delivered"])
+    assert {order_id: row["status"] for order_id, row in db.get_pending_status().items()} == {
+        "order-1": status_id["pizza_assembled"],
+    }
+    stuck = db.check_status_stuck()
+    assert set(stuck) == {"order-1"}
+    assert set(stuck["order-1"]) == {"status", "timestamp"}
+    db.delete_stuck_status("order-1")
+    assert db.get_pending_status() == dict()
+    assert db.check_status_stuck() == dict()
+
+
+def test_status_stuck_order_ids(db, sys_config):
+    status_id = sys_config["status-id"]
+    for n in range(3):
+        db.upsert_status(f"order-{n}", status_id["pizza_assembled"])
+    db.upsert_status("order-3", status_id["delivered"])
+    assert set(db.check_status_stuck(["order-0", "order-2", "order-3", "order-4"])) == {"order-0", "order-2"}
+    assert db.check_status_stuck([]) == dict()
+    # More orders than bound parameters in a single query
+    order_ids = [f"order-{n}" for n in range(1200)]
+    assert set(db.check_status_stuck(order_ids)) == {"order-0", "order-1", "order-2"}
+
+
+def test_traces(db):
+    db.upsert_trace("order-1", [["ordered", 1000], ["assemble_in", 1500]])
+    db.upsert_trace("order-1", [["ordered", 1000], ["status", 4000]])
+    db.upsert_trace("order-2", [["ordered", 2000]])
+    assert db.get_traces() == {
+        "order-1": [["ordered", 1000], ["status", 4000]],
+        "order-2": [["ordered", 2000]],
+    }
+    assert db.get_traces(since=2 ** 62) == dict()
+
+
+def test_customers(db):
+    db.add_customer("order-1", "customer-1")
+    customer = db.get_order_id_customer("order-1")
+    assert (customer["order_id"], customer["customer_id"]) == ("order-1", "customer-1")
+    db.update_customer("order-1", "customer-2")
+    assert db.get_order_id_customer("order-1")["customer_id"] == "customer-2"
+    # Only existing orders are updated
+    db.update_customer("order-2", "customer-2")
+    assert db.get_order_id_customer("order-2") is None
+    with pytest.raises(Exception):
+        db.add_customer("order-1", "customer-3")
+
+
+def test_delete_past_timestamp(db, sys_config):
+    for n in range(5):
+        db.add_order(f"order-{n}", order_details())
+    table_orders = sys_config["state-store-orders"]["table_orders"]
+    assert db.delete_past_timestamp(table_orders, hours=1) == 0
+    # Cut-off an hour from now: every row is older
+    assert db.delete_past_timestamp(table_orders, hours=-1, limit=2) == 2
+    assert db.delete_past_timestamp(table_orders, hours=-1) == 3
+    assert db.get_orders("customer-1") == dict()
+
+
+def test_transaction_commit(db, sys_config):
+    with db.transaction():
+        db.add_order("order-1", order_details())
+        with db.transaction():
+            db.upsert_status("order-1", sys_config["status-id"]["pizza_assembled"])
+    assert db.get_order_id("order-1") is not None
+    assert set(db.get_pending_status()) == {"order-1"}
+
+
+def test_transaction_rollback(db, sys_config):
+    status_id = sys_config["status-id"]
+    table_orders = sys_config["state-store-orders"]["table_orders"]
+    db.add_order("order-1", order_details())
+    db.add_order("order-2", order_details())
+    db.upsert_status("order-1", status_id["pizza_assembled"])
+    db.upsert_trace("order-1", [["ordered", 1000]])
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.add_order("order-3", order_details())
+            db.update_order_status("order-1", status_id["pizza_baked"])
+            db.upsert_status("order-1", status_id["pizza_baked"])
+            db.upsert_status("order-3", status_id["order_placed"])
+            db.delete_stuck_status("order-1")
+            db.upsert_trace("order-1", [["ordered", 1000], ["status", 2000]])
+            db.add_customer("order-1", "customer-1")
+            assert db.delete_past_timestamp(table_orders, hours=-1, limit=1) == 1
+            raise RuntimeError("handler failed")
+    assert db.get_order_id("order-3") is None
+    assert db.get_order_id("order-1")["status"] == status_id["order_placed"]
+    assert set(db.get_orders("customer-1")) == {"order-1", "order-2"}
+    assert {order_id: row["status"] for order_id, row in db.get_pending_status().items()} == {
+        "order-1": status_id["pizza_assembled"],
+    }
+    assert db.get_traces() == {"order-1": [["ordered", 1000]]}
+    assert db.get_order_id_customer("order-1") is None
+    # Still usable after the rollback
+    db.add_order("order-3", order_details())
+    assert db.get_order_id("order-3") is not None
+
+
+def test_explain_query_plans(db):
+    assert isinstance(db.explain_query_plans(), dict)
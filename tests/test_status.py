@@ -0,0 +1,52 @@
+import os
+import copy
+
+import pytest
+
+from utils import get_system_config
+from utils.status import StatusEngine, ACCEPTED, DUPLICATE, BACKWARD, FINAL, UNKNOWN
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def sys_config():
+    return copy.deepcopy(get_system_config(os.path.join(ROOT, "config_sys", "default.ini")))
+
+
+def test_transitions(sys_config):
+    engine = StatusEngine.from_config(sys_config)
+    status = sys_config["status-id"]
+    assert engine.transition(None, status["order_placed"]) == ACCEPTED
+    assert engine.transition(status["order_placed"], status["pizza_baked"]) == ACCEPTED
+    assert engine.transition(status["pizza_baked"], status["pizza_baked"]) == DUPLICATE
+    assert engine.transition(status["pizza_baked"], status["pizza_assembled"]) == BACKWARD
+    assert engine.transition(status["delivered"], status["pizza_baked"]) == FINAL
+    assert engine.transition(status["cancelled"], status["delivered"]) == FINAL
+    assert engine.transition(status["pizza_assembled"], 12345) == UNKNOWN
+    # A stuck order still moves forward
+    assert engine.transition(status["stuck"], status["pizza_baked"]) == ACCEPTED
+    assert engine.is_settled(status["stuck"]) and not engine.is_terminal(status["stuck"])
+
+
+def test_terminal_statuses_from_config(sys_config):
+    status = sys_config["status-id"]
+    completed = sys_config["state-store-orders"]["status_completed_when"]
+    engine = StatusEngine.from_config(sys_config)
+    assert {code for code in status.values() if engine.is_terminal(code)} == set(completed)
+
+    sys_config["state-store-orders"]["status_completed_when"] = [status["delivered"]]
+    engine = StatusEngine.from_config(sys_config)
+    assert not engine.is_terminal(status["cancelled"])
+    assert engine.transition(status["cancelled"], status["delivered"]) == ACCEPTED
+
+
+def test_recovers_from_parse_error(sys_config):
+    engine = StatusEngine.from_config(sys_config)
+    status = sys_config["status-id"]
+    # An event which could not be parsed sets something_wrong (or unknown without status)
+    for error_status in (status["something_wrong"], status["unknown"]):
+        assert engine.transition(status["pizza_assembled"], error_status) == ACCEPTED
+        assert not engine.is_terminal(error_status) and engine.is_settled(error_status)
+        assert engine.transition(error_status, status["pizza_baked"]) == ACCEPTED
@@ -0,0 +1,60 @@
+import gc
+import weakref
+
+import pytest
+
+pytest.importorskip("confluent_kafka")
+
+from utils import TOPIC_METADATA, get_topic_metadata, get_topic_partitions
+from utils.fake_kafka import AdminClient, Broker
+
+
+class CountingAdminClient(AdminClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = 0
+
+    def list_topics(self, topic: str = None, timeout: float = -1):
+        self.requests += 1
+        return super().list_topics(topic, timeout=timeout)
+
+
+@pytest.fixture
+def broker():
+    broker = Broker(num_partitions=3)
+    broker.create_topic("pizza-ordered")
+    broker.create_topic("pizza-status", num_partitions=1)
+    return broker
+
+
+def test_one_request_per_ttl(broker):
+    admin_client = CountingAdminClient({}, broker=broker)
+    assert get_topic_partitions(admin_client, "pizza-ordered") == 3
+    assert get_topic_partitions(admin_client, "pizza-status") == 1
+    assert get_topic_partitions(admin_client, "pizza-unknown", default_partition_number=6) == 6
+    assert admin_client.requests == 1
+
+    get_topic_metadata(admin_client).invalidate()
+    assert get_topic_partitions(admin_client, "pizza-ordered") == 3
+    assert admin_client.requests == 2
+
+
+def test_cache_per_client(broker):
+    admin_client = AdminClient({}, broker=broker)
+    other = AdminClient({}, broker=Broker(num_partitions=2))
+    assert get_topic_metadata(admin_client) is get_topic_metadata(admin_client)
+    assert get_topic_metadata(admin_client) is not get_topic_metadata(other)
+    assert get_topic_partitions(other, "pizza-ordered", default_partition_number=0) == 0
+
+
+def test_cache_dropped_with_client(broker):
+    admin_client = AdminClient({}, broker=broker)
+    get_topic_metadata(admin_client).partitions("pizza-ordered")
+    assert admin_client in TOPIC_METADATA
+    cached = len(TOPIC_METADATA)
+    client_ref = weakref.ref(admin_client)
+    del admin_client
+    gc.collect()
+    # The cache does not keep its client alive, and goes with it
+    assert client_ref() is None
+    assert len(TOPIC_METADATA) == cached - 1
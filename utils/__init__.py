@@ -1,17 +1,32 @@
 import os
 import re
 import sys
+import time
+import json
+import queue
+import atexit
 import signal
 import socket
 import logging
+import zlib
+import marshal
+import hashlib
+import weakref
 import datetime
-import requests
+import threading
 import importlib
+import functools
+import concurrent.futures
 
 from configparser import ConfigParser
-from confluent_kafka import Producer, Consumer
-import logging.handlers import TimeRotatingFileHandler
-from confluent_kafka.admin import AdminClient
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from logging.handlers import TimedRotatingFileHandler as TimeRotatingFileHandler
+from utils.metrics import REGISTRY, MetricsExporter, InstrumentedConsumer
+from utils.supervisor import ENV_WORKERS, get_worker_id
+from utils.lag import LagMonitor
+from utils.dedup import DedupWindow
+from utils.serialization import JSON, event_format, deserialize
 
 
 FOLDER_PID = "pid"
@@ -20,6 +35,74 @@ EXTENSION_LOG = ".app_log"
 FOLDER_CONFIG_KAFKA ="config_kafka"
 FOLDER_CONFIG_SYS = "config_sys"
 
+# Defaults of the system configuration sections and keys added after the first
+# release (see `get_system_config`), so older configuration files still load
+SYS_CONFIG_DEFAULTS = {
+    "logging": {
+        "event_log_max_per_second": "100",
+    },
+    "metrics": {
+        "snapshot_interval_seconds": "15",
+        "prometheus_port": "0",
+    },
+    "lag-monitor": {
+        "interval_seconds": "60",
+        "target_drain_seconds": "300",
+    },
+    "dedup": {
+        "window_seconds": "3600",
+        "capacity": "100000",
+        "error_rate": "0.000001",
+        "generations": "4",
+        "persist_interval_seconds": "30",
+    },
+    "kafka-topic-config": {
+        "bootstrap_topics": "yes",
+        "bootstrap_timeout_seconds": "30",
+    },
+    "kafka-producer": {
+        "linger_ms": "5",
+        "batch_size": "65536",
+        "max_in_flight": "100000",
+    },
+    "kafka-event-format": {
+        "pizza_assembled": "json",
+        "pizza_baked": "json",
+    },
+    "kafka-consumer-batch": {
+        "num_messages": "500",
+        "timeout_seconds": "1",
+        "commit_every_messages": "500",
+        "commit_interval_seconds": "5",
+    },
+    "supervisor": {
+        "workers": "0",
+        "restart_delay_seconds": "1",
+        "max_restart_delay_seconds": "60",
+        "shutdown_timeout_seconds": "30",
+    },
+    "microservice-status": {
+        "dispatcher_workers": "0",
+    },
+    "microservice-assemble": {
+        "max_concurrent_orders": "16",
+    },
+    "state-store-orders": {
+        "persistent_connection": "yes",
+        "cache_max_orders": "10000",
+        "cache_ttl_seconds": "60",
+        "table_traces": "traces",
+        "table_traces_retention_hours": "4",
+        "trace_report_minutes": "5",
+        "retention_interval_minutes": "15",
+        "retention_chunk_size": "500",
+        "retention_chunk_pause_seconds": "0.05",
+    },
+}
+
+# Heavy dependencies (confluent_kafka, requests) are imported by the functions using them,
+# so importing utils (and starting a service) only loads what the process actually uses
+
 def get_hostname() -> str:
     """
     Returns the hostname of the current machine.
@@ -90,14 +173,28 @@ def get_system_config(
             for item in data.replace("\r","\n").split("\n")
             if item.strip()
                             ]
+
+    def parse_bool(data: str) -> bool:
+        """Parses a configuration flag such as yes/no, true/false, on/off or 1/0"""
+        return str(data).strip().lower() in ("1", "yes", "true", "on")
+
     try:
+        sys_config = load_config_snapshot(sys_config_file)
+        if sys_config is not None:
+            return sys_config if section is None else sys_config.get(section)
+
         config_parser = ConfigParser(interpolation=None)
-        config_parser.read_file(sys_config_file, "r")
+        config_parser.read_file(open(sys_config_file, "r"))
 
         sys_config = dict()
         for s in config_parser.sections():
             sys_config[s] = dict(config_parser.items(s))
 
+        # Sections and keys missing from older configuration files
+        for s, defaults in SYS_CONFIG_DEFAULTS.items():
+            for k, v in defaults.items():
+                sys_config.setdefault(s, dict()).setdefault(k, v)
+
         for s in ("sauce", "cheese", "main_topping", "extra_toppings"):
             sys_config['pizza'][s] = parse_list(sys_config['pizza'][s])
         
@@ -105,7 +202,7 @@ def get_system_config(
             None: sys_config["status-label"]["else"],
         }
 
-        for k, v in sys_config["status"].items():
+        for k, v in list(sys_config["status-id"].items()):
             sys_config["status-id"][k] = int(v)
             sys_config["status"][int(v)] = sys_config["status-label"].get(k,"???")
         status_completed_when = parse_list(
@@ -124,6 +221,77 @@ def get_system_config(
         sys_config["state-store-orders"]["status_invalid_timeout_minutes"] = float(
             sys_config["state-store-orders"]["status_invalid_timeout_minutes"]
         )
+        sys_config["state-store-orders"]["trace_report_minutes"] = float(
+            sys_config["state-store-orders"]["trace_report_minutes"]
+        )
+        sys_config["state-store-orders"]["retention_interval_minutes"] = float(
+            sys_config["state-store-orders"]["retention_interval_minutes"]
+        )
+        sys_config["state-store-orders"]["retention_chunk_size"] = int(
+            sys_config["state-store-orders"]["retention_chunk_size"]
+        )
+        sys_config["state-store-orders"]["retention_chunk_pause_seconds"] = float(
+            sys_config["state-store-orders"]["retention_chunk_pause_seconds"]
+        )
+        sys_config["state-store-orders"]["cache_max_orders"] = int(
+            sys_config["state-store-orders"]["cache_max_orders"]
+        )
+        sys_config["state-store-orders"]["cache_ttl_seconds"] = float(
+            sys_config["state-store-orders"]["cache_ttl_seconds"]
+        )
+        sys_config["state-store-orders"]["persistent_connection"] = parse_bool(
+            sys_config["state-store-orders"]["persistent_connection"]
+        )
+        sys_config["microservice-status"]["dispatcher_workers"] = int(
+            sys_config["microservice-status"]["dispatcher_workers"]
+        )
+        sys_config["microservice-assemble"]["max_concurrent_orders"] = int(
+            sys_config["microservice-assemble"]["max_concurrent_orders"]
+        )
+        for k in ("linger_ms", "batch_size", "max_in_flight"):
+            sys_config["kafka-producer"][k] = int(sys_config["kafka-producer"][k])
+        sys_config["logging"]["event_log_max_per_second"] = float(
+            sys_config["logging"]["event_log_max_per_second"]
+        )
+        sys_config["supervisor"]["workers"] = int(sys_config["supervisor"]["workers"])
+        for k in ("restart_delay_seconds", "max_restart_delay_seconds", "shutdown_timeout_seconds"):
+            sys_config["supervisor"][k] = float(sys_config["supervisor"][k])
+        sys_config["metrics"]["snapshot_interval_seconds"] = float(
+            sys_config["metrics"]["snapshot_interval_seconds"]
+        )
+        sys_config["metrics"]["prometheus_port"] = int(
+            sys_config["metrics"]["prometheus_port"]
+        )
+        for k in ("interval_seconds", "target_drain_seconds"):
+            sys_config["lag-monitor"][k] = float(sys_config["lag-monitor"][k])
+        sys_config["dedup"]["window_seconds"] = float(sys_config["dedup"]["window_seconds"])
+        sys_config["dedup"]["capacity"] = int(sys_config["dedup"]["capacity"])
+        sys_config["dedup"]["error_rate"] = float(sys_config["dedup"]["error_rate"])
+        sys_config["dedup"]["generations"] = int(sys_config["dedup"]["generations"])
+        sys_config["dedup"]["persist_interval_seconds"] = float(
+            sys_config["dedup"]["persist_interval_seconds"]
+        )
+        sys_config["kafka-topic-config"]["bootstrap_topics"] = parse_bool(
+            sys_config["kafka-topic-config"]["bootstrap_topics"]
+        )
+        sys_config["kafka-topic-config"]["bootstrap_timeout_seconds"] = float(
+            sys_config["kafka-topic-config"]["bootstrap_timeout_seconds"]
+        )
+        sys_config["kafka-consumer-batch"]["num_messages"] = int(
+            sys_config["kafka-consumer-batch"]["num_messages"]
+        )
+        sys_config["kafka-consumer-batch"]["timeout_seconds"] = float(
+            sys_config["kafka-consumer-batch"]["timeout_seconds"]
+        )
+        sys_config["kafka-consumer-batch"]["commit_every_messages"] = int(
+            sys_config["kafka-consumer-batch"]["commit_every_messages"]
+        )
+        sys_config["kafka-consumer-batch"]["commit_interval_seconds"] = float(
+            sys_config["kafka-consumer-batch"]["commit_interval_seconds"]
+        )
+
+        # Snapshot of the processed configuration, reused by the next starts
+        save_config_snapshot(sys_config_file, sys_config)
 
         # Filter by section (if required)
         if section is not None:
@@ -139,20 +307,215 @@ def get_system_config(
     return sys_config
 
 
+def config_snapshot_file(config_file: str) -> str:
+    """Snapshot file of a configuration file, in the `__pycache__` folder next to it"""
+    folder, name = os.path.split(os.path.abspath(config_file))
+    return os.path.join(folder, "__pycache__", f"{name}.snapshot")
+
+
+def config_snapshot_key(config_file: str) -> list:
+    """
+    Identifies a configuration file version and the code processing it: size, mtime
+    and SHA-1 of the file, mtime of this module and Python version (marshal format)
+    """
+    stat = os.stat(config_file)
+    with open(config_file, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return [
+        stat.st_size,
+        stat.st_mtime_ns,
+        digest,
+        os.stat(__file__).st_mtime_ns,
+        sys.version_info[:2],
+    ]
+
+
+def load_config_snapshot(config_file: str) -> dict:
+    """Processed configuration saved by `save_config_snapshot`, None if missing or stale"""
+    try:
+        with open(config_snapshot_file(config_file), "rb") as f:
+            snapshot = marshal.load(f)
+        if snapshot["key"] == config_snapshot_key(config_file):
+            return snapshot["config"]
+    except Exception:
+        pass
+    return None
+
+
+def save_config_snapshot(config_file: str, config: dict):
+    """
+    Saves a processed configuration (marshal, loaded without parsing or running any
+    code), written atomically. Failures are ignored, e.g. read-only folder.
+    """
+    try:
+        snapshot_file = config_snapshot_file(config_file)
+        os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+        tmp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            marshal.dump({"key": config_snapshot_key(config_file), "config": config}, f)
+        os.replace(tmp_file, snapshot_file)
+    except Exception as err:
+        logging.debug(f"Unable to save configuration snapshot of {config_file}: {err}")
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    QueueHandler feeding a QueueListener of the same process: records are queued
+    as they are, so message formatting happens in the listener thread as well as
+    the console/disk I/O.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class EventLogSampler:
+    """
+    Caps the number of per-event INFO lines logged per second (0 means no cap).
+    Lines over the cap are dropped and their number logged once the second is over.
+    """
+
+    def __init__(self, max_per_second: float = 0):
+        self.max_per_second = max_per_second
+        self.lock = threading.Lock()
+        self.window = 0
+        self.logged = 0
+        self.dropped = 0
+
+    def allow(self) -> bool:
+        if not self.max_per_second:
+            return True
+        with self.lock:
+            window = int(time.monotonic())
+            if window != self.window:
+                if self.dropped:
+                    logging.info(f"Sampled out {self.dropped} event log line(s) (over {self.max_per_second}/second)")
+                self.window = window
+                self.logged = self.dropped = 0
+            if self.logged < self.max_per_second:
+                self.logged += 1
+                return True
+            self.dropped += 1
+            return False
+
+
+EVENT_LOG_SAMPLER = EventLogSampler()
+
+
+class LazyDecode:
+    """Decodes bytes (utf-8) only when converted to string, i.e. when the log line is formatted"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self) -> str:
+        if self.data is None:
+            return ""
+        try:
+            return self.data.decode("utf-8")
+        except Exception:
+            return str(self.data)
+
+
+class LazyEventData:
+    """Lazily formats [topic, key, value] of an event for `log_event_received`"""
+
+    __slots__ = ("event",)
+
+    def __init__(self, event):
+        self.event = event
+
+    def __str__(self) -> str:
+        event_data = [
+            self.event.topic(),
+            self.event.key(),
+            self.event.value(),
+        ]
+        for n in range(len(event_data)):
+            try:
+                event_data[n] = event_data[n].decode("utf-8")
+            except Exception:
+                pass
+        if event_format(self.event) != JSON:
+            # Binary encoded value
+            try:
+                event_data[2] = deserialize(self.event)
+            except Exception:
+                pass
+        return str(event_data)
+
+
+class EventView:
+    """
+    Consumed event whose key and value are decoded at most once, on first access, and
+    shared by `log_event_received` and the event handler. Any other attribute (topic(),
+    partition(), offset(), headers(), ...) is the one of the wrapped event, so the view
+    can be used wherever the event is.
+
+    Attributes:
+        decoded_key (str): Key decoded from UTF-8 (e.g. the order id), None if the event has no key.
+        data (dict): Value decoded according to its format (`utils.serialization.deserialize`).
+    """
+
+    __slots__ = ("event", "_decoded_key", "_data")
+
+    def __init__(self, event):
+        self.event = event
+        self._decoded_key = self._data = EventView
+
+    def __getattr__(self, name):
+        return getattr(self.event, name)
+
+    @property
+    def decoded_key(self) -> str:
+        if self._decoded_key is EventView:
+            key = self.event.key()
+            self._decoded_key = key.decode() if isinstance(key, bytes) else key
+        return self._decoded_key
+
+    @property
+    def data(self) -> dict:
+        if self._data is EventView:
+            self._data = deserialize(self.event)
+        return self._data
+
+    def __str__(self) -> str:
+        try:
+            value = self.data
+        except Exception:
+            value = str(LazyDecode(self.event.value()))
+        return str([self.event.topic(), self.decoded_key, value])
+
+
+def set_event_log_rate(max_per_second: float):
+    """Caps the per-event INFO lines (`log_event_received`/`delivery_report`) logged per second (0 = no cap)"""
+    EVENT_LOG_SAMPLER.max_per_second = max_per_second
+
+
 def log_ini(
         script: str,
         level: int = logging.INFO,
         to_disk: bool = True,
+        asynchronous: bool = False,
 ):
     """
     Initialises the logging module for the given script.
 
     Args:
-        script (str): The name of the script to log as.
+        script (str): The name of the script to log as (suffixed with the worker number when
+            started by a Supervisor, so each worker logs to its own file).
         level (int, optional): The logging level to use. Defaults to logging.INFO.
         to_disk (bool, optional): Whether to log to disk as well as the console. Defaults to True.
+        asynchronous (bool, optional): Whether to format and write log records in a background
+            thread (QueueHandler/QueueListener), so logging never blocks the caller on I/O.
+            Queued records are flushed at exit. Defaults to False.
 
     """
+    script = get_process_name(script)
+    log_format = f"\n\x00%(asctime)s.%(msecs)03d [%(levelname)s] {script}: %(message)s"
+    log_datefmt = "%Y-%m-%d %H:%M:%S"
     handlers = [
         logging.StreamHandler(),
     ]
@@ -165,10 +528,19 @@ def log_ini(
                 encoding="utf8",
             )
         )
+    if asynchronous:
+        formatter = logging.Formatter(log_format, datefmt=log_datefmt)
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handlers = [LocalQueueHandler(log_queue)]
     logging.basicConfig(
-       format=f"\n\x00%(asctime)s.%(msecs)03d [%(levelname)s] {script}: %(message)s",
+       format=log_format,
         level=level,
-        datefmt="%Y-%m-%d %H:%M:%S",
+        datefmt=log_datefmt,
         handlers=handlers,
     )
 
@@ -177,22 +549,15 @@ def log_event_received(event) -> None:
     """
     Logs a received event to the console.
 
+    The event is only decoded when the line is formatted, and not at all if the
+    INFO level is disabled or the line is sampled out (see `set_event_log_rate`).
+    With an EventView, the decoded key and value are reused by the event handler.
+
     Args:
-        event (confluent_kafka.Message): The event to log.
+        event (confluent_kafka.Message | EventView): The event to log.
     """
-    event_data = [
-        event.topic(),
-        event.key(),
-        event.value(),
-    ]
-    for n in range(len(event_data)):
-        try:
-            event_data[n] = event_data[n].decode("utf-8")
-        except Exception:
-            pass
-    logging.info(  
-        f"Event received: {event_data}"
-        )
+    if logging.getLogger().isEnabledFor(logging.INFO) and EVENT_LOG_SAMPLER.allow():
+        logging.info("Event received: %s", event if isinstance(event, EventView) else LazyEventData(event))
 
 def log_exception(message: str, sys_exc_info) -> None:
     """
@@ -264,14 +629,97 @@ def validate_cli_args(script: str) -> tuple:
         sys_config_file,
     )
 
+def get_process_name(script: str) -> str:
+    """Name of the script suffixed with the worker number when started by a Supervisor (e.g. `msvc_bake_2`)"""
+    worker_id = get_worker_id()
+    return script if worker_id is None else f"{script}_{worker_id}"
+
+
 def save_pid(script: str):
-    """Save PID to disk"""
+    """Save PID to disk (one file per worker when started by a Supervisor)"""
     if not os.path.isdir(FOLDER_PID):
         os.mkdir(FOLDER_PID)
-    with open(os.path.join(FOLDER_PID, f"{script}.pid"), "w") as f:
+    with open(os.path.join(FOLDER_PID, f"{get_process_name(script)}.pid"), "w") as f:
         f.write(str(os.getpid()))
 
 
+def start_metrics(script: str, metrics_config: dict) -> MetricsExporter:
+    """
+    Starts exporting the process metrics (utils.metrics.REGISTRY), as a JSON snapshot
+    written every `snapshot_interval_seconds` next to the PID file (`pid/<script>.metrics.json`,
+    also written at exit) and/or as a Prometheus endpoint on `prometheus_port` (0 = disabled,
+    worker N of a Supervisor listens on `prometheus_port + N`)
+    """
+    if not os.path.isdir(FOLDER_PID):
+        os.mkdir(FOLDER_PID)
+    prometheus_port = metrics_config["prometheus_port"]
+    if prometheus_port:
+        prometheus_port += get_worker_id() or 0
+    exporter = MetricsExporter(
+        snapshot_file=os.path.join(FOLDER_PID, f"{get_process_name(script)}.metrics.json"),
+        snapshot_interval_seconds=metrics_config["snapshot_interval_seconds"],
+        prometheus_port=prometheus_port,
+    ).start()
+    if metrics_config["snapshot_interval_seconds"] > 0:
+        atexit.register(exporter.write_snapshot)
+    return exporter
+
+
+def start_lag_monitor(kafka_config_file: str, groups: dict, lag_config: dict) -> LagMonitor:
+    """
+    Starts monitoring the lag of consumer groups ({group: [topic, ...]}, see utils.lag.LagMonitor)
+    every `interval_seconds` (0 = disabled) with `target_drain_seconds` for the recommended
+    number of workers. Only worker #0 of a Supervisor runs the monitor.
+    """
+    if lag_config["interval_seconds"] <= 0 or (get_worker_id() or 0) > 0:
+        return None
+    _, _, _, admin_client = set_producer_consumer(
+        kafka_config_file,
+        disable_producer=True,
+        disable_consumer=True,
+    )
+    workers = int(os.environ.get(ENV_WORKERS) or 1)
+    return LagMonitor(
+        lambda group: set_producer_consumer(
+            kafka_config_file,
+            disable_producer=True,
+            consumer_extra_config={"group.id": group},
+            instrument_consumer=False,
+        )[2],
+        admin_client,
+        groups,
+        workers={group: workers for group in groups},
+        interval_seconds=lag_config["interval_seconds"],
+        target_drain_seconds=lag_config["target_drain_seconds"],
+    ).start()
+
+
+def start_dedup(script: str, dedup_config: dict) -> DedupWindow:
+    """
+    Starts the de-duplication window of redelivered events (see utils.dedup.DedupWindow)
+    remembering `capacity` keys for `window_seconds` (0 = disabled) with a false positive
+    rate of `error_rate`, persisted next to the PID file (`pid/<script>.dedup`) every
+    `persist_interval_seconds` and at exit. The file is shared by the workers of a
+    Supervisor: call `save()` from the rebalance callbacks so events redelivered to
+    another worker of the host are detected too.
+    """
+    if dedup_config["window_seconds"] <= 0:
+        return None
+    if not os.path.isdir(FOLDER_PID):
+        os.mkdir(FOLDER_PID)
+    dedup = DedupWindow(
+        dedup_config["window_seconds"],
+        dedup_config["capacity"],
+        error_rate=dedup_config["error_rate"],
+        generations=dedup_config["generations"],
+        file=os.path.join(FOLDER_PID, f"{script}.dedup"),
+        persist_interval_seconds=dedup_config["persist_interval_seconds"],
+        name=script,
+    ).start()
+    atexit.register(dedup.stop)
+    return dedup
+
+
 def get_script_name(file: str) -> str:
     """Gets the name of the given script file, without any path or extension."""
 
@@ -279,6 +727,30 @@ def get_script_name(file: str) -> str:
     return os.path.splitext(os.path.basename(file))[0]
 
 
+# Consumer group of each microservice: (section, key) of its group id in the system
+# configuration (suffixed with the hostname) and the [kafka-topics] keys it consumes
+CONSUMER_GROUPS = {
+    "msvc_assemble": (("kafka-consumer-group-id", "microservice_assembled"), ("pizza_ordered",)),
+    # msvc_bake has always used its client id as group id (kept, so its committed offsets are too)
+    "msvc_bake": (("kafka-client-id", "microservice_baked"), ("pizza_assembled",)),
+    "msvc_status": (("kafka-consumer-group-id", "microservice_status"), ("pizza_status",)),
+}
+
+
+def get_consumer_group(sys_config: dict, script: str, hostname: str) -> tuple:
+    """Consumer group id and topics consumed by a microservice (see CONSUMER_GROUPS)"""
+    (section, key), topics = CONSUMER_GROUPS[script]
+    return (
+        f"{sys_config[section][key]}_{hostname}",
+        [sys_config["kafka-topics"][topic] for topic in topics],
+    )
+
+
+def get_consumer_groups(sys_config: dict, hostname: str) -> dict:
+    """Topics consumed by the consumer group of every microservice, {group: [topic, ...]}"""
+    return dict(get_consumer_group(sys_config, script, hostname) for script in CONSUMER_GROUPS)
+
+
 def get_string_status(status_dict: dict, status: int) -> str:
     """
     Gets a string representation for a given status code, using the provided
@@ -307,8 +779,17 @@ def set_producer_consumer(
     consumer_extra_config: dict = None,
     disable_producer: bool = False,
     disable_consumer: bool = False,
+    linger_ms: int = None,
+    batch_size: int = None,
+    client_module: str = None,
+    instrument_consumer: bool = True,
 ) -> tuple:
     """Generate producer/config kafka objects
+    (`linger_ms`/`batch_size`, if set, tune the producer batching via `linger.ms`/`batch.size`)
+    (`client_module`, or `module` under the section `[kafka-client]` of the Kafka configuration
+    file, selects a module providing the Producer/Consumer/AdminClient classes, e.g.
+    `utils.fake_kafka` for the in-process broker, defaults to confluent_kafka)
+    (`instrument_consumer` wraps the consumer in utils.metrics.InstrumentedConsumer)
     def main():
         kafka_config_file = "kafka.ini"
         producer_extra_config = {"bootstrap.servers": "localhost:9092"}
@@ -350,15 +831,40 @@ def set_producer_consumer(
 
     config_kafka = all_config["kafka"]
 
+    # Kafka client classes (confluent_kafka unless another module is configured)
+    client_module = client_module or all_config.get("kafka-client", dict()).get("module")
+    if client_module:
+        module = importlib.import_module(client_module)
+        producer_class, consumer_class, admin_client_class = (
+            module.Producer,
+            module.Consumer,
+            module.AdminClient,
+        )
+    else:
+        from confluent_kafka import Producer, Consumer
+        from confluent_kafka.admin import AdminClient
+
+        producer_class, consumer_class, admin_client_class = (
+            Producer,
+            Consumer,
+            AdminClient,
+        )
+
     # Set producer config
     if not disable_producer:
         producer_common_config = {
             "partitioner": "murmur2_random",
         }
-        producer = Producer(
+        producer_tuning_config = dict()
+        if linger_ms is not None:
+            producer_tuning_config["linger.ms"] = linger_ms
+        if batch_size is not None:
+            producer_tuning_config["batch.size"] = batch_size
+        producer = producer_class(
             {
                 **producer_common_config,
                 **config_kafka,
+                **producer_tuning_config,
                 **producer_extra_config,
             }
         )
@@ -372,18 +878,20 @@ def set_producer_consumer(
             "auto.offset.reset": "earliest",
             "max.poll.interval.ms": 3000000,
         }
-        consumer = Consumer(
+        consumer = consumer_class(
             {
                 **consumer_common_config,
                 **config_kafka,
                 **consumer_extra_config,
             }
         )
+        if instrument_consumer:
+            consumer = InstrumentedConsumer(consumer)
     else:
         consumer = None
 
     # Set admin client
-    admin_client = AdminClient(config_kafka)
+    admin_client = admin_client_class(config_kafka)
 
     return (
         all_config,
@@ -393,28 +901,184 @@ def set_producer_consumer(
     )
 
 
+class TopicMetadataCache:
+    """
+    Partition counts of the topics of a cluster, from a single metadata request for all
+    topics (`list_topics()`) refreshed at most every `ttl_seconds`, instead of a metadata
+    round-trip per lookup. A failed request invalidates the cache (the next lookup
+    retries it), topics reported with an error are left out.
+
+    Args:
+        admin_client: Admin client (confluent_kafka or utils.fake_kafka).
+        ttl_seconds (float, optional): Seconds the metadata is cached for. Defaults to 60.
+    """
+
+    def __init__(self, admin_client, ttl_seconds: float = 60):
+        self.admin_client = admin_client
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.topics = dict()
+        self.expires_at = 0
+
+    def refresh(self):
+        metadata = self.admin_client.list_topics(timeout=10)
+        topics = {
+            name: len(topic.partitions)
+            for name, topic in metadata.topics.items()
+            if getattr(topic, "error", None) is None
+        }
+        with self.lock:
+            self.topics = topics
+            self.expires_at = time.monotonic() + self.ttl_seconds
+
+    def invalidate(self):
+        with self.lock:
+            self.expires_at = 0
+
+    def partitions(self, topic: str) -> int:
+        """Number of partitions of a topic, None if it does not exist (or the metadata is unavailable)"""
+        if time.monotonic() >= self.expires_at:
+            try:
+                self.refresh()
+            except Exception as err:
+                self.invalidate()
+                logging.error(f"Unable to get the topics metadata: {err}")
+                return None
+        with self.lock:
+            return self.topics.get(topic)
+
+
+# Topic metadata cache of each admin client, dropped with the client
+TOPIC_METADATA = weakref.WeakKeyDictionary()
+TOPIC_METADATA_LOCK = threading.Lock()
+
+
+def get_topic_metadata(admin_client, ttl_seconds: float = 60) -> TopicMetadataCache:
+    """
+    Topic metadata cache shared by the callers of the same admin client. The cache only
+    holds a weak reference to the client, so neither is kept alive by the other. Clients
+    which cannot be weakly referenced get a cache of their own (not shared).
+    """
+    with TOPIC_METADATA_LOCK:
+        try:
+            cache = TOPIC_METADATA.get(admin_client)
+            if cache is None:
+                cache = TOPIC_METADATA[admin_client] = TopicMetadataCache(
+                    weakref.proxy(admin_client),
+                    ttl_seconds=ttl_seconds,
+                )
+        except TypeError:
+            cache = TopicMetadataCache(admin_client, ttl_seconds=ttl_seconds)
+        return cache
+
+
 def get_topic_partitions(
     admin_client,
     topic_name: str,
     default_partition_number: int = 1,
 ) -> int:
-    partitions = admin_client.list_topics(topic_name).topics.get(topic_name)
-    if partitions is not None:
-        partitions = len(partitions.partitions)
-    else:
+    """Number of partitions of a topic (cached metadata, see TopicMetadataCache), `default_partition_number` if unknown"""
+    partitions = get_topic_metadata(admin_client).partitions(topic_name)
+    if partitions is None:
         partitions = default_partition_number
     return partitions
 
 
+def bootstrap_topics(admin_client, sys_config: dict) -> dict:
+    """
+    Creates the pipeline topics (`[kafka-topics]`) missing from the cluster, with the
+    partitions and replication factor of `[kafka-topic-config]`, in a single batched
+    `create_topics` request whose futures are awaited together (up to
+    `bootstrap_timeout_seconds`). Existing topics are validated against the cached
+    metadata (one metadata request for all of them).
+
+    Returns:
+        dict: Result of each topic: "exists", "created", "timeout", or the error/warning.
+    """
+    from confluent_kafka import KafkaError, KafkaException
+    from confluent_kafka.admin import NewTopic
+
+    topic_config = sys_config["kafka-topic-config"]
+    num_partitions = int(topic_config["num_partitions"])
+    replication_factor = int(topic_config["replication_factor"])
+    timeout_seconds = topic_config["bootstrap_timeout_seconds"]
+
+    metadata = get_topic_metadata(admin_client)
+    metadata.invalidate()
+    results, missing = dict(), list()
+    for topic in sorted(set(sys_config["kafka-topics"].values())):
+        partitions = metadata.partitions(topic)
+        if partitions is None:
+            missing.append(topic)
+        elif partitions < num_partitions:
+            results[topic] = f"exists with {partitions} partition(s), {num_partitions} expected"
+            logging.warning(f"Topic '{topic}' {results[topic]}")
+        else:
+            results[topic] = "exists"
+
+    if missing:
+        futures = admin_client.create_topics(
+            [
+                NewTopic(topic, num_partitions=num_partitions, replication_factor=replication_factor)
+                for topic in missing
+            ],
+            operation_timeout=timeout_seconds,
+            request_timeout=timeout_seconds,
+        )
+        done, _ = concurrent.futures.wait(futures.values(), timeout=timeout_seconds)
+        for topic, future in futures.items():
+            if future not in done:
+                results[topic] = "timeout"
+                continue
+            err = future.exception()
+            if err is None:
+                results[topic] = "created"
+            elif (
+                isinstance(err, KafkaException)
+                and isinstance(err.args[0], KafkaError)
+                and err.args[0].code() == KafkaError.TOPIC_ALREADY_EXISTS
+            ) or "already exists" in str(err):
+                results[topic] = "exists"
+            else:
+                results[topic] = f"error: {err}"
+                logging.error(f"Unable to create topic '{topic}': {err}")
+        metadata.invalidate()
+
+    return results
+
+
+PRODUCER_DELIVERY_SECONDS = REGISTRY.histogram(
+    "producer_delivery_seconds",
+    help="Time from an event being produced until its delivery is reported",
+)
+# `producer_deliveries_total` counter of each (topic, result), looked up once
+PRODUCER_DELIVERIES = dict()
+
+
 def delivery_report(err, msg):
-    """Reports the failure or success of an event delivery"""
-    msg_key = "" if msg.key() is None else msg.key().decode()
+    """Reports the failure or success of an event delivery (success lines are lazy and sampled)"""
+    key = (msg.topic(), "ok" if err is None else "error")
+    counter = PRODUCER_DELIVERIES.get(key)
+    if counter is None:
+        counter = PRODUCER_DELIVERIES[key] = REGISTRY.counter(
+            "producer_deliveries_total",
+            help="Number of events delivered (or failed to be)",
+            labels={"topic": key[0], "result": key[1]},
+        )
+    counter.inc()
+    latency = msg.latency() if hasattr(msg, "latency") else None
+    if latency is not None:
+        PRODUCER_DELIVERY_SECONDS.observe(latency)
     if err is not None:
-        logging.error(f"Delivery failed for key '{msg_key}': {err}")
-    else:
-        msg_value = "" if msg.value() is None else msg.value().decode()
+        logging.error("Delivery failed for key '%s': %s", LazyDecode(msg.key()), err)
+    elif logging.getLogger().isEnabledFor(logging.INFO) and EVENT_LOG_SAMPLER.allow():
         logging.info(
-            f"Event successfully produced\n- Topic: {msg.topic()}, partition #{msg.partition()}, Offset #{msg.offset()}\n- Key: {msg_key}\n- Value: {msg_value}"
+            "Event successfully produced\n- Topic: %s, partition #%s, Offset #%s\n- Key: %s\n- Value: %s",
+            msg.topic(),
+            msg.partition(),
+            msg.offset(),
+            LazyDecode(msg.key()),
+            LazyDecode(msg.value()),
         )
 
 
@@ -422,6 +1086,21 @@ def timestamp_now() -> int:
     return int(datetime.datetime.now().timestamp() * 1000)
 
 
+# Keep-alive connections shared by every `http_request` call of the process (created on first use)
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+
+def get_http_session():
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            import requests
+
+            HTTP_SESSION = requests.Session()
+        return HTTP_SESSION
+
+
 def http_request(
     url: str,
     headers: dict = None,
@@ -429,38 +1108,80 @@ def http_request(
     method: str = "POST",
     username: str = None,
     password: str = None,
+    timeout: tuple = (3.05, 30),
+    data: bytes = None,
 ) -> tuple:
-    """Generic HTTP request"""
-    session = requests.Session()
+    """Generic HTTP request (pooled keep-alive session, `timeout` as (connect, read) seconds, `data` as an already encoded body)"""
+    import requests
+
+    auth = None
     if username and password:
-        session.auth = (username, password)
-
-    if method == "GET":
-        session = session.get
-    elif method == "PUT":
-        session = session.put
-    elif method == "PATCH":
-        session = session.patch
-    elif method == "DELETE":
-        session = session.delete
-    else:
-        session = session.post
+        auth = (username, password)
+
+    if method not in ("GET", "PUT", "PATCH", "DELETE"):
+        method = "POST"
     try:
-        response = session(
+        response = get_http_session().request(
+            method,
             url,
             headers=headers,
-            json=payload,
+            json=payload if data is None else None,
+            data=data,
+            auth=auth,
+            timeout=timeout,
         )
         return (response.status_code, response.text)
-    except requests.exceptions.Timeout:
+    except requests.exceptions.Timeout as err:
         logging.error(f"Unable to send request to '{url}': timeout")
-        return (408, {err})
-    except requests.exceptions.TooManyRedirects:
+        return (408, str(err))
+    except requests.exceptions.TooManyRedirects as err:
         logging.error(f"Unable to send request to '{url}': too many redirects")
-        return (302, {err})
+        return (302, str(err))
     except Exception as err:
         logging.error(f"Unable to send request to '{url}': {err}")
-        return (500, {err})
+        return (500, str(err))
+
+
+# Runs of whitespace (CR, tab, LF, space) collapsed into a single space in ksqlDB statements
+KSQLDB_WHITESPACE = re.compile(r"[\r\t\n ]+")
+KSQLDB_HEADERS = {
+    "Accept": "application/vnd.ksql.v1+json",
+    "Content-Type": "application/vnd.ksql.v1+json; charset=utf-8",
+}
+
+
+def normalize_statement(statement: str) -> str:
+    """Collapses CR, tab, LF and consecutive spaces of a ksqlDB statement into single spaces (linear time)"""
+    return KSQLDB_WHITESPACE.sub(" ", statement)
+
+
+@functools.lru_cache(maxsize=1024)
+def prepare_ksqldb_statement(statement: str, offset_reset_earliest: bool = True) -> tuple:
+    """
+    Normalized statement and encoded `/ksql` request body, cached by raw statement so
+    statements issued repeatedly (health checks, table lookups) are prepared only once.
+
+    Returns:
+        tuple: (normalized statement, request body as bytes)
+    """
+    statement = normalize_statement(statement)
+    body = json.dumps(
+        {
+            "ksql": statement,
+            "streamsProperties": {
+                "ksql.streams.auto.offset.reset": "earliest"
+                if offset_reset_earliest
+                else "latest",
+                "ksql.streams.cache.max.bytes.buffering": "0",
+            },
+        }
+    ).encode()
+    return statement, body
+
+
+@functools.lru_cache(maxsize=64)
+def ksqldb_url(end_point: str) -> str:
+    return f"{end_point.strip('/')}/ksql"
 
 
 def ksqldb(
@@ -478,30 +1199,15 @@ def ksqldb(
     )
     DEBUG: ksqlDB (200): CREATE STREAM my_stream (id INT, name VARCHAR) WITH (kafka_topic='my_topic', value_format='json');
     """
+    url = ksqldb_url(end_point)
     try:
-        # Clean-up statement
-        statement = statement.replace("\r", " ")
-        statement = statement.replace("\t", " ")
-        statement = statement.replace("\n", " ")
-        while statement.find("  ") > -1:
-            statement = statement.replace("  ", " ")
-
-        url = f"{end_point.strip('/')}/ksql"
+        # Clean-up statement and encode the request body (cached)
+        statement, body = prepare_ksqldb_statement(statement, offset_reset_earliest)
+
         status_code, response = http_request(
             url,
-            headers={
-                "Accept": "application/vnd.ksql.v1+json",
-                "Content-Type": "application/vnd.ksql.v1+json; charset=utf-8",
-            },
-            payload={
-                "ksql": statement,
-                "streamsProperties": {
-                    "ksql.streams.auto.offset.reset": "earliest"
-                    if offset_reset_earliest
-                    else "latest",
-                    "ksql.streams.cache.max.bytes.buffering": "0",
-                },
-            },
+            headers=KSQLDB_HEADERS,
+            data=body,
             username=username,
             password=password,
         )
@@ -512,13 +1218,382 @@ def ksqldb(
     except Exception as err:
         logging.error(f"Unable to send request to '{url}': {err}")
 
+class AsyncProducer:
+    """
+    Produces events asynchronously, without flushing after every event.
+
+    Delivery callbacks are served by `poll(0)` after each `produce` (and by any
+    explicit `poll`/`flush`). When the number of events awaiting delivery reaches
+    `max_in_flight`, or librdkafka's local queue is full (BufferError), `produce`
+    blocks serving delivery callbacks until there is room again (backpressure).
+    Call `flush` only at shutdown or before committing consumer offsets.
+
+    Args:
+        producer (confluent_kafka.Producer): The producer to wrap.
+        max_in_flight (int, optional): Maximum number of events awaiting delivery. Defaults to 100000.
+        backpressure_timeout (float, optional): Seconds to poll for each backpressure wait. Defaults to 0.1.
+    """
+
+    def __init__(
+        self,
+        producer,
+        max_in_flight: int = 100000,
+        backpressure_timeout: float = 0.1,
+    ):
+        self.producer = producer
+        self.max_in_flight = max(1, max_in_flight)
+        self.backpressure_timeout = backpressure_timeout
+        self.produce_seconds = REGISTRY.histogram(
+            "producer_produce_seconds",
+            help="Duration of the produce calls (including any backpressure wait)",
+        )
+        # `producer_events_total` counter of each topic, looked up once
+        self.events_produced = dict()
+
+    def __len__(self) -> int:
+        """Number of events awaiting delivery"""
+        return len(self.producer)
+
+    def produce(
+        self,
+        topic: str,
+        key=None,
+        value=None,
+        on_delivery=None,
+        **kwargs,
+    ):
+        started = time.perf_counter()
+        if on_delivery is not None:
+            kwargs["on_delivery"] = on_delivery
+        while len(self.producer) >= self.max_in_flight:
+            self.producer.poll(self.backpressure_timeout)
+        while True:
+            try:
+                self.producer.produce(topic, key=key, value=value, **kwargs)
+                break
+            except BufferError:
+                logging.debug(
+                    f"Producer queue is full ({len(self.producer)} event(s) awaiting delivery), backing off..."
+                )
+                self.producer.poll(self.backpressure_timeout)
+        self.producer.poll(0)
+        self.produce_seconds.observe(time.perf_counter() - started)
+        counter = self.events_produced.get(topic)
+        if counter is None:
+            counter = self.events_produced[topic] = REGISTRY.counter(
+                "producer_events_total",
+                help="Number of events produced",
+                labels={"topic": topic},
+            )
+        counter.inc()
+
+    def poll(self, timeout: float = 0) -> int:
+        """Serves delivery callbacks"""
+        return self.producer.poll(timeout)
+
+    def flush(self, timeout: float = None) -> int:
+        """
+        Waits for all events to be delivered.
+
+        Returns:
+            int: Number of events still awaiting delivery (0 if all were delivered).
+        """
+        if timeout is None:
+            remaining = self.producer.flush()
+        else:
+            remaining = self.producer.flush(timeout)
+        if remaining > 0:
+            logging.warning(f"Unable to flush producer, {remaining} event(s) awaiting delivery")
+        return remaining
+
+
+class BatchCommitter:
+    """
+    Commits consumer offsets once per batch of events instead of once per event.
+
+    Offsets are committed synchronously when at least `commit_every_messages`
+    events were handled since the last commit, or when `commit_interval_seconds`
+    have elapsed and there is anything pending. As events are only added after
+    being handled, the consumer position always points past processed events.
+
+    Args:
+        consumer (confluent_kafka.Consumer): The consumer to commit offsets for.
+        commit_every_messages (int, optional): Commit once this many events are pending. Defaults to 1.
+        commit_interval_seconds (float, optional): Commit pending events at least this often. Defaults to 0.
+        producer (AsyncProducer, optional): Producer to flush before committing, so offsets
+            are never committed ahead of the events produced while handling them.
+    """
+
+    def __init__(
+        self,
+        consumer,
+        commit_every_messages: int = 1,
+        commit_interval_seconds: float = 0,
+        producer: AsyncProducer = None,
+    ):
+        self.consumer = consumer
+        self.producer = producer
+        self.commit_every_messages = max(1, commit_every_messages)
+        self.commit_interval_seconds = commit_interval_seconds
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def add(self, count: int = 1):
+        """Flags `count` handled events as pending to be committed"""
+        self.pending += count
+
+    def is_due(self) -> bool:
+        if self.pending == 0:
+            return False
+        if self.pending >= self.commit_every_messages:
+            return True
+        return time.monotonic() - self.last_commit >= self.commit_interval_seconds
+
+    def maybe_commit(self) -> bool:
+        """Commits offsets if the count or interval threshold was reached"""
+        if self.is_due():
+            return self.commit()
+        return False
+
+    def commit(self) -> bool:
+        """
+        Commits the current consumer position, if there is anything pending.
+
+        Returns:
+            bool: True if the offsets were committed, False otherwise (pending
+                  events are kept so the next call retries the commit).
+        """
+        if self.pending == 0:
+            return False
+        if self.producer is not None and self.producer.flush() > 0:
+            return False
+        try:
+            self.consumer.commit(asynchronous=False)
+        except Exception:
+            log_exception(
+                f"Unable to commit offsets ({self.pending} event(s) pending)",
+                sys.exc_info(),
+            )
+            return False
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        return True
+
+
+class OffsetTracker:
+    """
+    Tracks in-flight offsets per partition when events are processed out of order
+    (e.g. by a worker pool) and commits only the highest contiguous completed offset.
+
+    Offsets must be tracked in the order they are consumed (`track`), and flagged as
+    completed (`done`) from any thread once the event is fully processed. An offset
+    is only committed when every offset before it on the same partition is done,
+    which preserves at-least-once semantics.
+
+    Args:
+        consumer (confluent_kafka.Consumer, optional): The consumer to commit offsets for.
+    """
+
+    def __init__(self, consumer=None):
+        self.consumer = consumer
+        self.lock = threading.Lock()
+        # (topic, partition) -> [deque of in-flight offsets in consume order, set of completed offsets]
+        self.partitions = dict()
+        self.to_commit = dict()
+
+    def track(self, topic: str, partition: int, offset: int):
+        with self.lock:
+            self.partitions.setdefault((topic, partition), [deque(), set()])[0].append(offset)
+
+    def done(self, topic: str, partition: int, offset: int):
+        with self.lock:
+            tracked = self.partitions.get((topic, partition))
+            if tracked is None:
+                # Partition was revoked meanwhile
+                return
+            pending, completed = tracked
+            completed.add(offset)
+            last_offset = None
+            while pending and pending[0] in completed:
+                last_offset = pending.popleft()
+                completed.discard(last_offset)
+            if last_offset is not None:
+                self.to_commit[(topic, partition)] = last_offset + 1
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return sum(len(pending) for pending, _ in self.partitions.values())
+
+    def committable(self) -> list:
+        """Returns (and resets) the offsets that can be committed, as a list of TopicPartition"""
+        from confluent_kafka import TopicPartition
+
+        with self.lock:
+            offsets = [
+                TopicPartition(topic, partition, offset)
+                for (topic, partition), offset in self.to_commit.items()
+            ]
+            self.to_commit = dict()
+        return offsets
+
+    def forget(self, partitions: list):
+        """Stops tracking the given partitions (e.g. on rebalance revoke)"""
+        with self.lock:
+            for p in partitions:
+                self.partitions.pop((p.topic, p.partition), None)
+                self.to_commit.pop((p.topic, p.partition), None)
+
+    def commit(self) -> bool:
+        """
+        Synchronously commits the highest contiguous completed offset of each partition.
+
+        Returns:
+            bool: True if any offset was committed, False otherwise.
+        """
+        offsets = self.committable()
+        if not offsets:
+            return False
+        try:
+            self.consumer.commit(offsets=offsets, asynchronous=False)
+        except Exception:
+            with self.lock:
+                # Keep them so the next call retries, unless a newer offset is already there
+                for p in offsets:
+                    self.to_commit.setdefault((p.topic, p.partition), p.offset)
+            log_exception(
+                f"Unable to commit offsets {offsets}",
+                sys.exc_info(),
+            )
+            return False
+        return True
+
+
+class KeyedDispatcher:
+    """
+    Processes the events of a single consumer concurrently while keeping the order
+    of the events with the same key (e.g. order_id).
+
+    Each event is routed to one of `workers` threads by a hash of its key (events
+    without a key are spread round-robin), each thread handling its queue in order.
+    If an OffsetTracker is given, offsets are tracked on `submit` and flagged as
+    done once handled, so only the highest contiguous completed offset of each
+    partition is committed (at-least-once).
+
+    Args:
+        handler (callable): Called with each event, from the worker threads.
+        workers (int, optional): Number of worker threads. Defaults to 4.
+        offsets (OffsetTracker, optional): Offset tracker of the consumer.
+        complete_on_return (bool, optional): Flag the offset as done once `handler` returns
+            (or raises). Set to False if the handler flags it itself (e.g. on delivery of
+            the event it produces). Defaults to True.
+        max_queued (int, optional): Maximum number of events queued per worker, `submit`
+            blocks when the queue of the target worker is full (0 = unbounded). Defaults to 100.
+        name (str, optional): Prefix of the worker thread names. Defaults to "dispatcher".
+    """
+
+    def __init__(
+        self,
+        handler,
+        workers: int = 4,
+        offsets: OffsetTracker = None,
+        complete_on_return: bool = True,
+        max_queued: int = 100,
+        name: str = "dispatcher",
+    ):
+        self.handler = handler
+        self.offsets = offsets
+        self.complete_on_return = complete_on_return
+        self.queues = [queue.Queue(maxsize=max_queued) for _ in range(max(1, workers))]
+        self.round_robin = 0
+        self.threads = [
+            threading.Thread(
+                target=self.worker,
+                args=(q,),
+                name=f"{name}_{n}",
+                daemon=True,
+            )
+            for n, q in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def route(self, key) -> int:
+        if key is None:
+            self.round_robin = (self.round_robin + 1) % len(self.queues)
+            return self.round_robin
+        if isinstance(key, str):
+            key = key.encode()
+        return zlib.crc32(key) % len(self.queues)
+
+    def submit(self, event):
+        """Queues an event to the worker of its key (blocks while that worker's queue is full)"""
+        if self.offsets is not None:
+            self.offsets.track(event.topic(), event.partition(), event.offset())
+        self.queues[self.route(event.key())].put(event)
+
+    def pending(self) -> int:
+        """Number of events queued (not yet picked up by a worker)"""
+        return sum(q.qsize() for q in self.queues)
+
+    def drain(self):
+        """Blocks until every event submitted so far is handled (e.g. before a rebalance commit)"""
+        for q in self.queues:
+            q.join()
+
+    def shutdown(self, wait: bool = True, discard_queued: bool = False) -> int:
+        """
+        Stops the workers once they have handled the events already queued, or only
+        the events they are handling if `discard_queued` (the offsets of the events
+        discarded are never done, so they are not committed and are consumed again).
+
+        Returns:
+            int: Number of events discarded.
+        """
+        discarded = 0
+        for q in self.queues:
+            while discard_queued:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+                q.task_done()
+                discarded += 1
+            q.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        return discarded
+
+    def worker(self, events: queue.Queue):
+        while True:
+            event = events.get()
+            try:
+                if event is None:
+                    return
+                try:
+                    self.handler(event)
+                except Exception:
+                    log_exception(
+                        f"Error when handling event {event.topic()} #{event.partition()} @{event.offset()}",
+                        sys.exc_info(),
+                    )
+                finally:
+                    if self.complete_on_return and self.offsets is not None:
+                        self.offsets.done(event.topic(), event.partition(), event.offset())
+            finally:
+                events.task_done()
+
+
 class GracefulShutdown:
     """Class/context manager to manage graceful shutdown"""
 
-    def __init__(self, consumer=None):
+    def __init__(self, consumer=None, committer=None, producer=None, dedup=None):
         self.was_signal_set = False
         self.safe_to_terminate = True
         self.consumer = consumer
+        self.committer = committer
+        self.producer = producer
+        self.dedup = dedup
         # Set signal handlers
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -530,6 +1605,17 @@ class GracefulShutdown:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.safe_to_terminate = True
         if self.was_signal_set:
+            if self.producer is not None:
+                # Deliver any event still queued before committing offsets
+                logging.info("Flushing producer...")
+                self.producer.flush()
+            if self.dedup is not None:
+                # Save the keys of the events handled (delivered) so far
+                self.dedup.save()
+            if self.committer is not None:
+                # Commit offsets of events handled since the last batch commit
+                logging.info("Committing pending offsets...")
+                self.committer.commit()
             if self.consumer is not None:
                 try:
                     # Close down consumer to commit final offsets.
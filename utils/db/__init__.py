@@ -1,6 +1,29 @@
+import sys
+import time
+import logging
+import threading
+
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils import log_exception, get_string_status
+from utils.metrics import REGISTRY
 
 class BaseStateStore(ABC):
+    @contextmanager
+    def transaction(self):
+        """Unit of work grouping several mutations (no-op unless overridden)"""
+        yield self
+
+    def close(self):
+        """Releases any resource held by a persistent state store"""
+        pass
+
+    def explain_query_plans(self) -> dict:
+        """Query plan of each state store query, {query name: [plan lines]} (if supported)"""
+        return dict()
+
     @abstractmethod
     def create_customer_table(
         self,
@@ -26,14 +49,31 @@ class BaseStateStore(ABC):
     ):
         pass
     
+    @abstractmethod
+    def create_trace_table(
+        self,
+        *args,
+        **kwargs
+    ):
+        pass
+
     @abstractmethod
     def check_status_stuck(
         self,
+        order_ids: list = None,
         *args,
         **kwargs
     ):
         pass
 
+    @abstractmethod
+    def get_pending_status(
+        self,
+        *args,
+        **kwargs
+    ) -> dict:
+        pass
+
     @abstractmethod
     def delete_stuck_status(
         self,
@@ -50,8 +90,9 @@ class BaseStateStore(ABC):
         *args,
         timestamp_field:str = "timestamp",
         hours:int = 1,
+        limit:int = None,
         **kwargs
-    ):
+    ) -> int:
         pass
 
     @abstractmethod
@@ -96,6 +137,27 @@ class BaseStateStore(ABC):
         pass
 
 
+    @abstractmethod
+    def upsert_trace(
+        self,
+        order_id:str,
+        hops:list,
+        *args,
+        **kwargs
+    ):
+        pass
+
+
+    @abstractmethod
+    def get_traces(
+        self,
+        *args,
+        since:int = None,
+        **kwargs
+    ) -> dict:
+        pass
+
+
     @abstractmethod
     def update_customer(
         self,
@@ -127,3 +189,257 @@ class BaseStateStore(ABC):
         **kwargs
     ):
         pass
+
+
+class RetentionJob:
+    """
+    Purges rows past their retention period in bounded chunks, pausing between
+    chunks so other writers can grab the database lock, and reports the rows
+    purged and time spent on each run.
+
+    Args:
+        state_store (callable): Returns a new state store instance (context manager), e.g.
+            `lambda: DB(db_name, sys_config=sys_config)`.
+        tables (dict): Retention period, in hours, of each table to purge ({table_name: hours}).
+        interval_seconds (float, optional): Time between runs. Defaults to 900.
+        chunk_size (int, optional): Maximum number of rows deleted per chunk/transaction. Defaults to 500.
+        pause_seconds (float, optional): Pause between chunks. Defaults to 0.05.
+        timestamp_field (str, optional): Column holding the row timestamp. Defaults to "timestamp".
+    """
+
+    def __init__(
+        self,
+        state_store,
+        tables: dict,
+        interval_seconds: float = 900,
+        chunk_size: int = 500,
+        pause_seconds: float = 0.05,
+        timestamp_field: str = "timestamp",
+    ):
+        self.state_store = state_store
+        self.tables = tables
+        self.interval_seconds = interval_seconds
+        self.chunk_size = max(1, chunk_size)
+        self.pause_seconds = pause_seconds
+        self.timestamp_field = timestamp_field
+
+    def run_once(self) -> dict:
+        """
+        Purges every table once.
+
+        Returns:
+            dict: {table_name: {"rows": rows purged, "chunks": chunks run, "seconds": time spent}}
+        """
+        report = dict()
+        with self.state_store() as db:
+            for table_name, hours in self.tables.items():
+                started = time.monotonic()
+                rows = chunks = 0
+                while True:
+                    deleted = db.delete_past_timestamp(
+                        table_name,
+                        timestamp_field=self.timestamp_field,
+                        hours=hours,
+                        limit=self.chunk_size,
+                    )
+                    rows += deleted
+                    chunks += 1
+                    if deleted < self.chunk_size:
+                        break
+                    time.sleep(self.pause_seconds)
+                report[table_name] = {
+                    "rows": rows,
+                    "chunks": chunks,
+                    "seconds": time.monotonic() - started,
+                }
+                logging.info(
+                    f"Retention purge '{table_name}': {rows} row(s) older than {hours} hour(s) deleted in {chunks} chunk(s), {report[table_name]['seconds']:.3f} second(s)"
+                )
+        return report
+
+    def run(self):
+        """Runs forever (e.g. as a daemon thread), starting straight away"""
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                log_exception(
+                    "Retention purge failed",
+                    sys.exc_info(),
+                )
+            time.sleep(self.interval_seconds)
+
+
+class OrderCache:
+    """
+    Bounded LRU cache with a TTL, shared by the `CachedStateStore` instances of a process.
+
+    Counters (see `stats`): hits, misses, evictions (least recently used entries dropped
+    to stay within `max_size`) and expirations (entries older than `ttl_seconds`), also
+    published as `order_cache_<counter>_total{cache}` of utils.metrics.REGISTRY.
+
+    Args:
+        max_size (int, optional): Maximum number of entries. Defaults to 10000.
+        ttl_seconds (float, optional): Time to live of each entry. Defaults to 60.
+        name (str, optional): Name of the cache (metrics). Defaults to "orders".
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl_seconds: float = 60,
+        clock=time.monotonic,
+        name: str = "orders",
+    ):
+        self.max_size = max(1, max_size)
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.metrics = {
+            counter: REGISTRY.counter(
+                f"order_cache_{counter}_total",
+                help=f"Number of order cache {counter}",
+                labels={"cache": name},
+            )
+            for counter in ("hits", "misses", "evictions", "expirations")
+        }
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns a copy of the cached value (None if missing or expired)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if self.clock() - entry[0] <= self.ttl_seconds:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    self.metrics["hits"].inc()
+                    return dict(entry[1])
+                del self.entries[key]
+                self.expirations += 1
+                self.metrics["expirations"].inc()
+            self.misses += 1
+            self.metrics["misses"].inc()
+            return None
+
+    def put(self, key, value: dict):
+        with self.lock:
+            self.entries[key] = (self.clock(), dict(value))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+                self.metrics["evictions"].inc()
+
+    def update(self, key, **fields) -> bool:
+        """Updates fields of a cached value in place (write-through), returns False if not cached"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            entry[1].update(fields)
+            return True
+
+    def invalidate(self, key=None):
+        """Drops `key` from the cache, or every entry if `key` is None"""
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class CachedStateStore:
+    """
+    Read-through/write-through cache in front of a state store (BaseStateStore).
+
+    `get_order_id` is served from the `OrderCache` when possible, `update_order_status`
+    updates the cached order as well as the state store, and `add_order` invalidates
+    it. Any other attribute is delegated to the wrapped state store. If a transaction
+    is rolled back the cache is cleared, as it may hold writes that were not persisted.
+
+    Args:
+        state_store (BaseStateStore): The state store to wrap.
+        cache (OrderCache): The cache (share it across instances to keep them coherent).
+    """
+
+    def __init__(
+        self,
+        state_store: BaseStateStore,
+        cache: OrderCache,
+    ):
+        self.state_store = state_store
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.state_store, name)
+
+    def __enter__(self):
+        self.state_store.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.state_store.__exit__(exc_type, exc_val, exc_tb)
+
+    @contextmanager
+    def transaction(self):
+        try:
+            with self.state_store.transaction():
+                yield self
+        except BaseException:
+            self.cache.invalidate()
+            raise
+
+    def get_order_id(
+        self,
+        order_id: str,
+        customer_id: str = None,
+    ) -> dict:
+        data = self.cache.get(order_id)
+        if data is None:
+            data = self.state_store.get_order_id(order_id)
+            if data is None:
+                # Not cached, the order might be added by another process at any time
+                return None
+            self.cache.put(order_id, data)
+        if customer_id is not None and data.get("customer_id") != customer_id:
+            return None
+        return data
+
+    def update_order_status(
+        self,
+        order_id: str,
+        status: int,
+    ):
+        self.state_store.update_order_status(order_id, status)
+        self.cache.update(
+            order_id,
+            status=status,
+            status_str=get_string_status(self.state_store.sys_config["status"], status),
+        )
+
+    def add_order(
+        self,
+        order_id: str,
+        order_details: dict,
+    ):
+        self.state_store.add_order(order_id, order_details)
+        self.cache.invalidate(order_id)
@@ -0,0 +1,386 @@
+import heapq
+import bisect
+import datetime
+import itertools
+import threading
+from contextlib import contextmanager
+from utils import timestamp_now, get_string_status
+from utils.db import BaseStateStore
+from utils.metrics import timed_methods
+
+
+# Databases are shared by every DB instance of the process with the same name,
+# the same way every sqlite3 connection to a file sees the same tables
+DATABASES = dict()
+DATABASES_LOCK = threading.Lock()
+
+# Undo journal entry of a row which did not exist before the transaction
+MISSING = object()
+
+
+class Table:
+    """
+    In-memory table: rows by primary key (O(1) lookup) plus a min-heap of
+    (timestamp, key) for time-ordered retention eviction. Heap entries of
+    rows deleted or re-timestamped since are discarded lazily.
+    """
+
+    def __init__(self):
+        self.rows = dict()
+        self.timestamps = list()
+        self.counter = itertools.count()
+
+    def put(self, key, row: dict):
+        self.rows[key] = row
+        heapq.heappush(self.timestamps, (row["timestamp"], next(self.counter), key))
+        if len(self.timestamps) > 2 * len(self.rows) + 64:
+            self.timestamps = [
+                (row["timestamp"], next(self.counter), key)
+                for key, row in self.rows.items()
+            ]
+            heapq.heapify(self.timestamps)
+
+    def pop_older_than(self, timestamp: int, limit: int = None) -> list:
+        """Removes and returns the rows (key, row) older than `timestamp`, oldest first"""
+        popped = list()
+        while self.timestamps and self.timestamps[0][0] < timestamp:
+            if limit is not None and len(popped) >= limit:
+                break
+            row_timestamp, _, key = heapq.heappop(self.timestamps)
+            row = self.rows.get(key)
+            if row is not None and row["timestamp"] == row_timestamp:
+                del self.rows[key]
+                popped.append((key, row))
+        return popped
+
+
+class Database:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tables = dict()
+        # customer_id -> sorted list of (timestamp, order_id)
+        self.orders_by_customer = dict()
+        # Rows changed by the current transaction as they were before it,
+        # {(table_name, key): row copy or MISSING}, None outside transactions
+        self.undo = None
+
+
+@timed_methods("state_store")
+class DB(BaseStateStore):
+    """
+    Pure in-memory state store, a drop-in replacement for `utils.db.sqlite.DB`
+    (select it with `db_module_class = utils.db.memory`), e.g. for load testing or
+    for ephemeral replicas rebuilding their state from Kafka. Data lives as long
+    as the process does.
+
+    Transactions hold the database lock (mutations are atomic towards other
+    threads). The rows they change are copied before their first change, and
+    restored if an exception is raised (rollback), as with SQLite.
+    """
+
+    def __init__ (
+            self,
+            db_name:str,
+            sys_config: dict = None,
+            **kwargs,
+    ):
+        self.db_name = db_name
+        self.sys_config = sys_config
+        with DATABASES_LOCK:
+            self.db = DATABASES.setdefault(db_name, Database())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: mutations executed inside the block are rolled back if an
+        exception is raised. Nested blocks join the outermost transaction.
+        """
+        with self.db.lock:
+            if self.db.undo is not None:
+                yield self
+                return
+            self.db.undo = dict()
+            try:
+                yield self
+            except BaseException:
+                self._rollback(self.db.undo)
+                raise
+            finally:
+                self.db.undo = None
+
+    def _journal(self, table_name: str, key, row=MISSING):
+        """Records a row before its first change in the current transaction (`row` if already removed)"""
+        undo = self.db.undo
+        if undo is not None and (table_name, key) not in undo:
+            if row is MISSING:
+                row = self.table(table_name).rows.get(key, MISSING)
+            undo[(table_name, key)] = row if row is MISSING else dict(row)
+
+    def _rollback(self, undo: dict):
+        for (table_name, key), row in undo.items():
+            table = self.table(table_name)
+            current = table.rows.pop(key, None)
+            if table_name == self.table_orders and current is not None:
+                self._unindex_order(key, current)
+            if row is not MISSING:
+                table.put(key, row)
+                if table_name == self.table_orders:
+                    bisect.insort(
+                        self.db.orders_by_customer.setdefault(row["customer_id"], list()),
+                        (row["timestamp"], key),
+                    )
+
+    def table(self, table_name: str) -> Table:
+        return self.db.tables.setdefault(table_name, Table())
+
+    @property
+    def table_orders(self) -> str:
+        return self.sys_config["state-store-orders"]["table_orders"]
+
+    @property
+    def table_status(self) -> str:
+        return self.sys_config["state-store-orders"]["table_status"]
+
+    @property
+    def table_traces(self) -> str:
+        return self.sys_config["state-store-orders"]["table_traces"]
+
+    @property
+    def table_customers(self) -> str:
+        return self.sys_config["state-store-delivery"]["table_customers"]
+
+    def create_customer_table(self):
+        with self.db.lock:
+            self.table(self.table_customers)
+
+    def create_order_table(self):
+        with self.db.lock:
+            self.table(self.table_orders)
+
+    def create_status_table(self):
+        with self.db.lock:
+            self.table(self.table_status)
+
+    def create_trace_table(self):
+        with self.db.lock:
+            self.table(self.table_traces)
+
+    def check_status_stuck(self, order_ids: list = None, *args, **kwargs) -> dict:
+        timeout = timestamp_now() - self.sys_config["state-store-orders"]["status_invalid_timeout_minutes"]*60*1000
+        completed = self.sys_config["state-store-orders"]["status_completed_when"]
+        with self.db.lock:
+            rows = self.table(self.table_status).rows
+            if order_ids is not None:
+                rows = {order_id: rows[order_id] for order_id in order_ids if order_id in rows}
+            return {
+                order_id: dict(row)
+                for order_id, row in rows.items()
+                if row["timestamp"] < timeout and row["status"] not in completed
+            }
+
+    def get_pending_status(self, *args, **kwargs) -> dict:
+        completed = self.sys_config["state-store-orders"]["status_completed_when"]
+        with self.db.lock:
+            return {
+                order_id: dict(row)
+                for order_id, row in self.table(self.table_status).rows.items()
+                if row["status"] not in completed
+            }
+
+    def delete_stuck_status(self, order_id:str, *args, **kwargs):
+        with self.db.lock:
+            self._journal(self.table_status, order_id)
+            self.table(self.table_status).rows.pop(order_id, None)
+
+    def delete_past_timestamp(
+            self,
+            table_name:str,
+            timestamp_field:str = "timestamp",
+            hours:int = 1,
+            limit:int = None,
+    ) -> int:
+        cutoff = timestamp_now() - hours*60*60*1000
+        with self.db.lock:
+            table = self.table(table_name)
+            if timestamp_field == "timestamp":
+                deleted = table.pop_older_than(cutoff, limit=limit)
+            else:
+                deleted = [
+                    (key, row)
+                    for key, row in table.rows.items()
+                    if row.get(timestamp_field) is not None and row[timestamp_field] < cutoff
+                ][:limit]
+                for key, _ in deleted:
+                    del table.rows[key]
+            for key, row in deleted:
+                self._journal(table_name, key, row)
+            if table_name == self.table_orders:
+                for order_id, row in deleted:
+                    self._unindex_order(order_id, row)
+            return len(deleted)
+
+    def get_order_id_customer(
+            self,
+            order_id:str,
+    ) -> dict:
+        with self.db.lock:
+            data = self.table(self.table_customers).rows.get(order_id)
+            if data is not None:
+                data = {"order_id": order_id, **data}
+            return data
+
+    def get_order_id(
+            self,
+            order_id:str,
+            customer_id:str = None,
+    ) -> dict:
+        with self.db.lock:
+            data = self.table(self.table_orders).rows.get(order_id)
+            if data is None or (customer_id is not None and data["customer_id"] != customer_id):
+                return None
+            data = {"order_id": order_id, **data}
+        data["extras"] = ",".join(data["extras"].split("|"))
+        data["status_str"] = get_string_status(
+            self.sys_config["status"], data["status"])
+        return data
+
+    def get_orders(
+            self,
+            customer_id:str,
+    ) -> dict:
+        with self.db.lock:
+            rows = self.table(self.table_orders).rows
+            items = [
+                {"order_id": order_id, **rows[order_id]}
+                for _, order_id in reversed(self.db.orders_by_customer.get(customer_id, list()))
+            ]
+        data_all = dict()
+        for item in items:
+            data_all[item['order_id']] = item
+            item['extras'] = ",".join(item['extras'].split("|"))
+            item['status_str'] = get_string_status(
+                self.sys_config["status"],
+                item["status"],
+            )
+            item['timestamp_str'] = datetime.datetime.fromtimestamp(
+                item["timestamp"]/1000
+            ).strftime("%Y-%m-%d %H:%M:%S")
+        return data_all
+
+    def update_order_status(
+            self,
+            order_id:str,
+            status: int,
+    ):
+        with self.db.lock:
+            row = self.table(self.table_orders).rows.get(order_id)
+            if row is not None:
+                self._journal(self.table_orders, order_id)
+                row["status"] = status
+
+    def upsert_status(self, order_id, status, *args, **kwargs):
+        with self.db.lock:
+            self._journal(self.table_status, order_id)
+            self.table(self.table_status).put(
+                order_id,
+                {
+                    "timestamp": timestamp_now(),
+                    "status": status,
+                },
+            )
+
+    def upsert_trace(self, order_id: str, hops: list, *args, **kwargs):
+        with self.db.lock:
+            self._journal(self.table_traces, order_id)
+            self.table(self.table_traces).put(
+                order_id,
+                {
+                    "timestamp": timestamp_now(),
+                    "total_ms": hops[-1][1] - hops[0][1] if hops else 0,
+                    "hops": [list(hop) for hop in hops],
+                },
+            )
+
+    def get_traces(self, *args, since: int = None, **kwargs) -> dict:
+        with self.db.lock:
+            return {
+                order_id: [list(hop) for hop in row["hops"]]
+                for order_id, row in self.table(self.table_traces).rows.items()
+                if row["timestamp"] >= (since or 0)
+            }
+
+    def update_customer(
+        self,
+        order_id: str,
+        customer_id: dict,
+    ):
+        with self.db.lock:
+            table = self.table(self.table_customers)
+            if order_id in table.rows:
+                self._journal(self.table_customers, order_id)
+                table.put(
+                    order_id,
+                    {
+                        "timestamp": timestamp_now(),
+                        "customer_id": customer_id,
+                    },
+                )
+
+    def add_customer(
+        self,
+        order_id: str,
+        customer_id: dict,
+    ):
+        with self.db.lock:
+            table = self.table(self.table_customers)
+            if order_id in table.rows:
+                raise KeyError(f"Order '{order_id}' already exists in '{self.table_customers}'")
+            self._journal(self.table_customers, order_id)
+            table.put(
+                order_id,
+                {
+                    "timestamp": timestamp_now(),
+                    "customer_id": customer_id,
+                },
+            )
+
+    def add_order(
+        self,
+        order_id: str,
+        order_details: dict,
+    ):
+        row = {
+            "timestamp": timestamp_now(),
+            "username": order_details["order"]["username"],
+            "customer_id": order_details["order"]["customer_id"],
+            "status": self.sys_config["status-id"]["order_placed"],
+            "sauce": order_details["order"]["sauce"],
+            "cheese": order_details["order"]["cheese"],
+            "topping": order_details["order"]["main_topping"],
+            "extras": ",".join(order_details["order"]["extra_toppings"]),
+        }
+        with self.db.lock:
+            table = self.table(self.table_orders)
+            if order_id in table.rows:
+                raise KeyError(f"Order '{order_id}' already exists in '{self.table_orders}'")
+            self._journal(self.table_orders, order_id)
+            table.put(order_id, row)
+            bisect.insort(
+                self.db.orders_by_customer.setdefault(row["customer_id"], list()),
+                (row["timestamp"], order_id),
+            )
+
+    def _unindex_order(self, order_id: str, row: dict):
+        orders = self.db.orders_by_customer.get(row["customer_id"])
+        if orders is not None:
+            i = bisect.bisect_left(orders, (row["timestamp"], order_id))
+            if i < len(orders) and orders[i] == (row["timestamp"], order_id):
+                del orders[i]
+            if not orders:
+                del self.db.orders_by_customer[row["customer_id"]]
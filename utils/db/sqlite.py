@@ -1,50 +1,137 @@
+import json
 import sqlite3
 import datetime
+from contextlib import contextmanager
 from utils import timestamp_now, get_string_status
 from utils.db import BaseStateStore
+from utils.metrics import timed_methods
 
 
 
+@timed_methods("state_store")
 class DB(BaseStateStore):
 
+    # Bound parameters per query (SQLite's default limit is 999 before 3.32)
+    MAX_PARAMETERS = 500
+
     def __init__ (
             self,
             db_name:str,
             sys_config: dict = None,
+            persistent: bool = False,
+            journal_mode: str = None,
+            synchronous: str = None,
     ):
+        """
+        SQLite state store.
+
+        Args:
+            db_name (str): Path to the SQLite database file.
+            sys_config (dict, optional): System configuration (see `get_system_config`).
+            persistent (bool, optional): Keep the connection open across `with` blocks,
+                so it is only opened once and closed on `close()`. Defaults to False.
+            journal_mode (str, optional): SQLite journal mode, e.g. "WAL". Defaults to SQLite's default.
+            synchronous (str, optional): SQLite synchronous setting, e.g. "NORMAL". Defaults to SQLite's default.
+        """
 
         self.db_name = db_name
         self.sys_config = sys_config
+        self.persistent = persistent
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.in_transaction = False
+        self.query_plans = None
         self.conn = None
         self.cur = None
     
     def __enter__(self):
-        self.conn = sqlite3.connect(self.db_name)
-        self.cur = self.conn.cursor()
-        return self
+        return self.connect()
     
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.persistent:
+            self.close()
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_name)
+            self.cur = self.conn.cursor()
+            if self.journal_mode:
+                self.cur.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+            if self.synchronous:
+                self.cur.execute(f"PRAGMA synchronous = {self.synchronous}")
+        return self
+
+    def close(self):
         if  self.conn is not None:
             try:
                 self.conn.close()
             except:
                 pass
+            self.conn = None
+            self.cur = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: all mutations executed inside the block are committed
+        together (single fsync) or rolled back if an exception is raised.
+        Nested blocks join the outermost transaction.
+        """
+        if self.in_transaction:
+            yield self
+            return
+        self.in_transaction = True
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self.in_transaction = False
 
     
     def execute(self, 
                 expression:str,
                 parameters: list = None,
                 commit: bool = False,):
+        if self.query_plans is not None:
+            # Dry run (see `explain_query_plans`): only record the query plan
+            self.query_plans.extend(
+                row[-1]
+                for row in self.cur.execute(
+                    f"EXPLAIN QUERY PLAN {expression}",
+                    parameters or list(),
+                ).fetchall()
+            )
+            return self.cur.execute("SELECT NULL WHERE 0")
+
         result = self.cur.execute(expression, parameters or list(),
                 )
 
-        if commit:
+        if commit and not self.in_transaction:
             self.conn.commit()
 
         return result
 
 
     def create_customer_table(self):
+        self.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.sys_config["state-store-delivery"]["table_customers"]} (
+                order_id TEXT PRIMARY KEY,
+                timestamp INTEGER,
+                customer_id TEXT
+            )""",
+            commit=True,
+        )
+        # Created on existing databases as well (schema migration)
+        self.create_index(
+            self.sys_config["state-store-delivery"]["table_customers"],
+            ["timestamp"],
+        )
+
+    def create_order_table(self):
         self.execute(
             f"""CREATE TABLE IF NOT EXISTS {self.sys_config["state-store-orders"]["table_orders"]} (
                 order_id TEXT PRIMARY KEY,
@@ -59,6 +146,15 @@ class DB(BaseStateStore):
             )""",
             commit=True,
         )
+        # Created on existing databases as well (schema migration)
+        self.create_index(
+            self.sys_config["state-store-orders"]["table_orders"],
+            ["customer_id", "timestamp"],
+        )
+        self.create_index(
+            self.sys_config["state-store-orders"]["table_orders"],
+            ["timestamp"],
+        )
     
     def create_status_table(self):
         self.execute(
@@ -69,13 +165,94 @@ class DB(BaseStateStore):
             )""",
             commit=True,
         )
+        # Created on existing databases as well (schema migration)
+        self.create_index(
+            self.sys_config["state-store-orders"]["table_status"],
+            ["timestamp"],
+        )
+
+    def create_trace_table(self):
+        self.execute(
+             f"""CREATE TABLE IF NOT EXISTS {self.sys_config["state-store-orders"]["table_traces"]} (
+                order_id TEXT PRIMARY KEY,
+                timestamp INTEGER,
+                total_ms INTEGER,
+                hops TEXT
+            )""",
+            commit=True,
+        )
+        self.create_index(
+            self.sys_config["state-store-orders"]["table_traces"],
+            ["timestamp"],
+        )
+
+    def create_index(
+            self,
+            table_name: str,
+            columns: list,
+    ):
+        self.execute(
+            f"""CREATE INDEX IF NOT EXISTS idx_{table_name}_{"_".join(columns)}
+            ON {table_name} ({", ".join(columns)})""",
+            commit=True,
+        )
+
+    def explain_query_plans(self) -> dict:
+        """
+        Dry runs each state store query through `EXPLAIN QUERY PLAN` (nothing is
+        read or written), so it can be verified they are index-backed.
+
+        Returns:
+            dict: {query name: [query plan detail lines]}
+        """
+        queries = {
+            "get_order_id": lambda: self.get_order_id(""),
+            "get_orders": lambda: self.get_orders(""),
+            "check_status_stuck": lambda: self.check_status_stuck(),
+            "check_status_stuck_order_ids": lambda: self.check_status_stuck(["", ""]),
+            "get_pending_status": lambda: self.get_pending_status(),
+            "update_order_status": lambda: self.update_order_status("", 0),
+            "upsert_status": lambda: self.upsert_status("", 0),
+            "delete_stuck_status": lambda: self.delete_stuck_status(""),
+            "upsert_trace": lambda: self.upsert_trace("", [["", 0]]),
+            "get_traces": lambda: self.get_traces(since=0),
+            "delete_past_timestamp_orders": lambda: self.delete_past_timestamp(
+                self.sys_config["state-store-orders"]["table_orders"],
+            ),
+            "delete_past_timestamp_status": lambda: self.delete_past_timestamp(
+                self.sys_config["state-store-orders"]["table_status"],
+            ),
+        }
+        plans = dict()
+        try:
+            for name, query in queries.items():
+                self.query_plans = list()
+                query()
+                plans[name] = self.query_plans
+        finally:
+            self.query_plans = None
+        return plans
     
-    def check_status_stuck(self, *args, **kwargs):
+    def check_status_stuck(self, order_ids: list = None, *args, **kwargs):
+        """
+        Returns {order_id: {"status", "timestamp"}} of the orders stuck, only among
+        `order_ids` if set (primary key lookups instead of a scan of the table)
+        """
+        if order_ids is not None:
+            order_ids = list(order_ids)
+            data_all = dict()
+            for n in range(0, len(order_ids), self.MAX_PARAMETERS):
+                data_all.update(self._check_status_stuck(order_ids[n:n + self.MAX_PARAMETERS]))
+            return data_all
+        return self._check_status_stuck(None)
+
+    def _check_status_stuck(self, order_ids: list) -> dict:
         self.execute(
             f"""SELECT * FROM {self.sys_config["state-store-orders"]["table_status"]} WHERE timestamp < {timestamp_now() -self.sys_config["state-store-orders"]["status_invalid_timeout_minutes"]*60*1000}
-            AND status NOT IN {",".join([str(s) for s in self.sys_config["state-store-orders"]["status_completed_when"]])}
-            
+            AND status NOT IN ({",".join([str(s) for s in self.sys_config["state-store-orders"]["status_completed_when"]])})
+            {"" if order_ids is None else f"AND order_id IN ({','.join('?' * len(order_ids))})"}
             """,
+            order_ids,
             commit=False,
         )
         data = self.cur.fetchall()
@@ -92,6 +269,22 @@ class DB(BaseStateStore):
 
 
 
+    def get_pending_status(self, *args, **kwargs) -> dict:
+        """Returns {order_id: {"status", "timestamp"}} of every order not yet completed"""
+        self.execute(
+            f"""SELECT order_id, status, timestamp FROM {self.sys_config["state-store-orders"]["table_status"]}
+            WHERE status NOT IN ({",".join([str(s) for s in self.sys_config["state-store-orders"]["status_completed_when"]])})
+            """,
+            commit=False,
+        )
+        return {
+            order_id: {
+                "status": status,
+                "timestamp": timestamp,
+            }
+            for order_id, status, timestamp in self.cur.fetchall()
+        }
+
     def delete_stuck_status(self, order_id:str, *args, **kwargs):
         self.execute(
             f"""DELETE FROM {self.sys_config["state-store-orders"]["table_status"]} WHERE order_id = ?""",
@@ -104,12 +297,23 @@ class DB(BaseStateStore):
             self,
             table_name:str,
             timestamp_field:str = "timestamp",
-            hours:int = 1
-    ):
-        self.execute(
-            f"""DELETE FROM {table_name} WHERE {timestamp_field} < {timestamp_now() - hours*60*60*1000}""",
+            hours:int = 1,
+            limit:int = None,
+    ) -> int:
+        """Deletes rows older than `hours` (at most `limit` rows, if set) and returns how many were deleted"""
+        if limit is None:
+            where_clause = f"{timestamp_field} < {timestamp_now() - hours*60*60*1000}"
+        else:
+            where_clause = f"""rowid IN (
+                SELECT rowid FROM {table_name}
+                WHERE {timestamp_field} < {timestamp_now() - hours*60*60*1000}
+                LIMIT {int(limit)}
+            )"""
+        result = self.execute(
+            f"""DELETE FROM {table_name} WHERE {where_clause}""",
             commit=True,
         )
+        return result.rowcount
     
     def get_order_id_customer(
             self,
@@ -192,7 +396,7 @@ class DB(BaseStateStore):
             status: int,
     ):
         self.execute(
-            f"""UPDATE {self.sys_config["state-store-orders"]["table_status"]} SET status = ? WHERE order_id = ?""",
+            f"""UPDATE {self.sys_config["state-store-orders"]["table_orders"]} SET status = ? WHERE order_id = ?""",
             parameters= [status, order_id],
             commit=True,
         )
@@ -202,7 +406,7 @@ class DB(BaseStateStore):
         self.execute(
             f""" INSERT INTO {self.sys_config["state-store-orders"]["table_status"]}(
                 order_id, status, timestamp) VALUES (
-                ?, {timestamp},{status}) ON CONFLICT(order_id) DO UPDATE SET
+                ?, {status},{timestamp}) ON CONFLICT(order_id) DO UPDATE SET
                 timestamp = {timestamp}, status = {status}
             WHERE order_id = ?
 
@@ -211,6 +415,36 @@ class DB(BaseStateStore):
             commit=True,
         )
     
+    def upsert_trace(self, order_id: str, hops: list, *args, **kwargs):
+        """Records the latest trace of an order (hops: [[stage, timestamp_ms], ...])"""
+        self.execute(
+            f"""INSERT INTO {self.sys_config["state-store-orders"]["table_traces"]}(
+                order_id, timestamp, total_ms, hops) VALUES (?, ?, ?, ?)
+            ON CONFLICT(order_id) DO UPDATE SET
+                timestamp = excluded.timestamp, total_ms = excluded.total_ms, hops = excluded.hops
+            """,
+            parameters=[
+                order_id,
+                timestamp_now(),
+                hops[-1][1] - hops[0][1] if hops else 0,
+                json.dumps(hops, separators=(",", ":")),
+            ],
+            commit=True,
+        )
+
+    def get_traces(self, *args, since: int = None, **kwargs) -> dict:
+        """Returns {order_id: hops} of the traces recorded since `since` (timestamp in ms, all if None)"""
+        self.execute(
+            f"""SELECT order_id, hops FROM {self.sys_config["state-store-orders"]["table_traces"]}
+            WHERE timestamp >= ?""",
+            parameters=[since or 0],
+            commit=False,
+        )
+        return {
+            order_id: json.loads(hops)
+            for order_id, hops in self.cur.fetchall()
+        }
+
     def update_customer(
         self,
         order_id: str,
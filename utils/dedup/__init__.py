@@ -0,0 +1,332 @@
+import os
+import math
+import time
+import marshal
+import hashlib
+import logging
+import threading
+
+from utils.metrics import REGISTRY
+
+
+# Version of the persisted file, bumped whenever its layout changes
+FILE_VERSION = 2
+# Separator of the parts of a key, e.g. (topic, order_id, status)
+KEY_SEPARATOR = "\x1f"
+
+
+def next_prime(n: int) -> int:
+    """Smallest prime >= n (trial division, only called when a filter is created)"""
+    n |= 1
+    while any(n % d == 0 for d in range(3, math.isqrt(n) + 1, 2)):
+        n += 2
+    return n
+
+
+class FileLock:
+    """Exclusive lock of a file shared by processes (fcntl, no locking where unavailable)"""
+
+    def __init__(self, file: str):
+        self.file = file
+        self.fd = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self.fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.fd is not None:
+            os.close(self.fd)  # Releases the lock
+            self.fd = None
+
+
+class BloomFilter:
+    """
+    Bloom filter of `capacity` keys with a false positive rate of `error_rate`
+    (once `capacity` keys are added). Keys are hashed once (BLAKE2b, 128 bits) and
+    the `hashes` bit positions derived from the two 64-bit halves with enhanced double
+    hashing (the step grows by `i` at probe `i`, so probes do not fall on the same
+    cycle when the step shares a factor with the size). A lookup stops at the first
+    bit not set (most lookups of keys never added).
+
+    Args:
+        capacity (int): Number of keys the filter is sized for.
+        error_rate (float): False positive rate at `capacity` keys.
+        bits (bytes, optional): Content of a saved filter (same capacity and error rate).
+        count (int, optional): Number of keys added to the saved filter.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, bits: bytes = None, count: int = 0):
+        self.capacity = max(1, int(capacity))
+        self.size = next_prime(max(11, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        nbytes = (self.size + 7) // 8
+        self.bits = bytearray(bits) if bits is not None and len(bits) == nbytes else bytearray(nbytes)
+        self.count = count if bits is not None else 0
+
+    @staticmethod
+    def digest(key: str) -> tuple:
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+        return h & 0xFFFFFFFFFFFFFFFF, h >> 64 | 1
+
+    def contains(self, digest: tuple) -> bool:
+        bits = self.bits
+        size = self.size
+        h1, h2 = digest
+        p, step = h1 % size, h2 % size
+        for i in range(self.hashes):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+            p += step
+            if p >= size:
+                p -= size
+            step += i
+            if step >= size:
+                step -= size
+        return True
+
+    def add(self, digest: tuple):
+        bits = self.bits
+        size = self.size
+        h1, h2 = digest
+        p, step = h1 % size, h2 % size
+        for i in range(self.hashes):
+            bits[p >> 3] |= 1 << (p & 7)
+            p += step
+            if p >= size:
+                p -= size
+            step += i
+            if step >= size:
+                step -= size
+        self.count += 1
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+
+class DedupWindow:
+    """
+    Remembers the keys of the events already handled during the last `window_seconds`,
+    so consumers can skip the work of events Kafka delivers again (at-least-once: any
+    crash or rebalance before the offsets are committed redelivers them).
+
+    Memory is bounded whatever the throughput: the window is split in `generations`
+    time buckets, each one a Bloom filter sized for its share of `capacity` keys.
+    Keys are added to the current bucket and looked up in all of them, the oldest
+    bucket is dropped once it leaves the window (a key is remembered between
+    `window_seconds` and `window_seconds` plus one bucket). The per bucket false
+    positive rate is chosen so a lookup across all buckets stays under `error_rate`.
+    Should more than `capacity` keys be added within a window, buckets rotate early
+    (keeping the false positive rate, shortening the window).
+
+    A false positive skips an event which was never handled, so only add a key once
+    its work is durable (event produced, state store written) and size `error_rate`
+    accordingly.
+
+    The filters are saved to `file` (every `persist_interval_seconds` from `start()`
+    and on `save()`) and loaded back when created, so redeliveries after a restart are
+    detected too. Several processes can share the file (e.g. the workers of a service
+    on a host): each save merges the keys saved by the others into the window before
+    writing it, so call `save()` when partitions are revoked (publishing the keys of
+    the events handled) and assigned (reading the keys of the previous owner), and
+    events redelivered to another worker after a rebalance are detected as well.
+    A file written with other settings is ignored.
+
+    The number of events skipped is counted by `dedup_skipped_events{name}` of
+    utils.metrics.REGISTRY.
+
+    Args:
+        window_seconds (float): How long keys are remembered.
+        capacity (int): Number of keys expected within a window.
+        error_rate (float, optional): False positive rate of a lookup. Defaults to 1e-6.
+        generations (int, optional): Number of time buckets of the window. Defaults to 4.
+        file (str, optional): File the filters are persisted to. Defaults to None (not persisted).
+        persist_interval_seconds (float, optional): Seconds between two saves (thread). Defaults to 30.
+        name (str, optional): Name of the window (metrics and logs). Defaults to "dedup".
+    """
+
+    def __init__(
+        self,
+        window_seconds: float,
+        capacity: int,
+        error_rate: float = 1e-6,
+        generations: int = 4,
+        file: str = None,
+        persist_interval_seconds: float = 30,
+        name: str = "dedup",
+    ):
+        self.window_seconds = float(window_seconds)
+        self.generations = max(1, int(generations))
+        self.span = self.window_seconds / self.generations
+        self.capacity = max(1, int(capacity))
+        self.error_rate = float(error_rate)
+        self.bucket_capacity = math.ceil(self.capacity / self.generations)
+        # Current bucket plus `generations` previous ones are looked up
+        self.bucket_error_rate = self.error_rate / (self.generations + 1)
+        self.file = file
+        self.persist_interval_seconds = persist_interval_seconds
+        self.name = name
+        self.lock = threading.Lock()
+        self.buckets = list()  # [(bucket number, BloomFilter)], oldest first
+        self.rotate_at = 0  # Start of the next bucket (time.time())
+        self.dirty = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.skipped = REGISTRY.counter(
+            "dedup_skipped_events",
+            help="Redelivered events skipped by the de-duplication window",
+            labels={"name": name},
+        )
+        if file is not None:
+            self.load()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Key of an event from its parts, e.g. `key(topic, order_id, status)`"""
+        return KEY_SEPARATOR.join(map(str, parts))
+
+    def settings(self) -> tuple:
+        return (self.window_seconds, self.generations, self.capacity, self.error_rate)
+
+    def rotate(self, now: float = None):
+        """Drops the buckets out of the window and starts the bucket of `now` (call with the lock held)"""
+        number = int((time.time() if now is None else now) // self.span) if self.span > 0 else 0
+        self.rotate_at = (number + 1) * self.span if self.span > 0 else float("inf")
+        oldest = number - self.generations
+        if self.buckets and self.buckets[0][0] < oldest:
+            self.buckets = [(n, bloom) for n, bloom in self.buckets if n >= oldest]
+            self.dirty = True
+        if not self.buckets or self.buckets[-1][0] < number:
+            self.buckets.append((number, BloomFilter(self.bucket_capacity, self.bucket_error_rate)))
+            self.dirty = True
+        elif self.buckets[-1][1].full:
+            # More keys than expected: start a new bucket ahead of time
+            self.buckets.append((self.buckets[-1][0] + 1, BloomFilter(self.bucket_capacity, self.bucket_error_rate)))
+            self.buckets = self.buckets[-(self.generations + 1):]
+            self.dirty = True
+
+    def seen(self, *parts) -> bool:
+        """
+        Whether the event of key `parts` (see `key`) was handled within the window
+        (counted as skipped if so)
+        """
+        digest = BloomFilter.digest(self.key(*parts))
+        with self.lock:
+            if time.time() >= self.rotate_at:
+                self.rotate()
+            for _, bloom in reversed(self.buckets):
+                if bloom.contains(digest):
+                    self.skipped.inc()
+                    return True
+        return False
+
+    def add(self, *parts):
+        """Remembers the event of key `parts` (see `key`), once its work is durable"""
+        digest = BloomFilter.digest(self.key(*parts))
+        with self.lock:
+            if time.time() >= self.rotate_at or self.buckets[-1][1].full:
+                self.rotate()
+            self.buckets[-1][1].add(digest)
+            self.dirty = True
+
+    @staticmethod
+    def estimated_count(bloom: BloomFilter) -> int:
+        """Number of keys of a filter estimated from its bits set (merged filters)"""
+        ones = int.from_bytes(bloom.bits, "little").bit_count()
+        if ones >= bloom.size:
+            return bloom.capacity
+        return round(-bloom.size / bloom.hashes * math.log(1 - ones / bloom.size))
+
+    def merge(self, saved: dict):
+        """Adds the buckets of a saved window to this one, bits ORed bucket by bucket (call with the lock held)"""
+        buckets = dict(self.buckets)
+        for number, count, bits in saved["buckets"]:
+            bloom = buckets.get(number)
+            if bloom is None:
+                buckets[number] = BloomFilter(self.bucket_capacity, self.bucket_error_rate, bits=bits, count=count)
+            elif bloom.bits != bits:
+                merged = int.from_bytes(bloom.bits, "little") | int.from_bytes(bits, "little")
+                bloom.bits = bytearray(merged.to_bytes(len(bloom.bits), "little"))
+                bloom.count = self.estimated_count(bloom)
+        self.buckets = sorted(buckets.items())[-(self.generations + 1):]
+        # Dropping the buckets out of the window is not a change to save
+        dirty = self.dirty
+        self.rotate()
+        self.dirty = dirty
+
+    def read(self) -> dict:
+        try:
+            with open(self.file, "rb") as f:
+                saved = marshal.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logging.warning(f"Unable to load the de-duplication window '{self.name}' from {self.file}: {err}")
+            return None
+        if saved.get("version") != FILE_VERSION or tuple(saved.get("settings", ())) != self.settings():
+            logging.info(f"De-duplication window '{self.name}' saved with other settings, ignored")
+            return None
+        return saved
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return
+        self.save()
+        logging.info(
+            f"De-duplication window '{self.name}' loaded from {self.file}: "
+            f"{sum(bloom.count for _, bloom in self.buckets)} key(s) in {len(self.buckets)} bucket(s)"
+        )
+
+    def save(self):
+        """
+        Synchronizes with `file`: the keys saved by the other processes sharing it are
+        merged into this window, then the merged window is written (atomically, under
+        an exclusive lock of `<file>.lock`) if it has keys the file does not have
+        """
+        if self.file is None:
+            return
+        with FileLock(f"{self.file}.lock"):
+            saved = self.read()
+            with self.lock:
+                if saved is not None:
+                    self.merge(saved)
+                if not self.dirty:
+                    return
+                saved = {
+                    "version": FILE_VERSION,
+                    "settings": self.settings(),
+                    "buckets": [(number, bloom.count, bytes(bloom.bits)) for number, bloom in self.buckets],
+                }
+                self.dirty = False
+            tmp_file = f"{self.file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_file, "wb") as f:
+                    marshal.dump(saved, f)
+                os.replace(tmp_file, self.file)
+            except Exception as err:
+                self.dirty = True
+                logging.error(f"Unable to save the de-duplication window '{self.name}' to {self.file}: {err}")
+
+    def run(self):
+        while not self.stopped.wait(self.persist_interval_seconds):
+            self.save()
+
+    def start(self):
+        """Saves (synchronizes) every `persist_interval_seconds` from a daemon thread"""
+        if self.file is not None and self.persist_interval_seconds > 0:
+            self.thread = threading.Thread(target=self.run, name=f"{self.name}_save", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the thread and saves the filters"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(5)
+        self.save()
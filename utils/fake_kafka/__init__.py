@@ -0,0 +1,439 @@
+import time
+import zlib
+import threading
+import itertools
+
+from concurrent.futures import Future
+from confluent_kafka import TopicPartition, KafkaException
+
+
+OFFSET_INVALID = -1001
+DEFAULT_NUM_PARTITIONS = 6
+
+# In-process brokers, by `bootstrap.servers`
+BROKERS = dict()
+BROKERS_LOCK = threading.Lock()
+
+
+def get_broker(config: dict):
+    """Returns the in-process broker for the `bootstrap.servers` of a client configuration"""
+    name = config.get("bootstrap.servers", "localhost")
+    with BROKERS_LOCK:
+        if name not in BROKERS:
+            BROKERS[name] = Broker(
+                num_partitions=int(config.get("num.partitions", DEFAULT_NUM_PARTITIONS)),
+            )
+        return BROKERS[name]
+
+
+class Message:
+    """Stand-in for confluent_kafka.Message"""
+
+    def __init__(
+        self,
+        topic: str,
+        partition: int,
+        offset: int,
+        key: bytes,
+        value: bytes,
+        headers: list = None,
+    ):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._headers = headers
+        self._timestamp = int(time.time() * 1000)
+        self.appended_at = time.monotonic()
+        self._latency = None
+
+    def topic(self) -> str:
+        return self._topic
+
+    def partition(self) -> int:
+        return self._partition
+
+    def offset(self) -> int:
+        return self._offset
+
+    def key(self) -> bytes:
+        return self._key
+
+    def value(self) -> bytes:
+        return self._value
+
+    def headers(self) -> list:
+        return self._headers
+
+    def timestamp(self) -> tuple:
+        return (1, self._timestamp)
+
+    def error(self):
+        return None
+
+    def latency(self) -> float:
+        return self._latency
+
+    def __len__(self) -> int:
+        return 0 if self._value is None else len(self._value)
+
+
+class PartitionMetadata:
+    def __init__(self, id: int):
+        self.id = id
+        self.leader = 0
+        self.replicas = [0]
+        self.isrs = [0]
+        self.error = None
+
+
+class TopicMetadata:
+    def __init__(self, topic: str, num_partitions: int):
+        self.topic = topic
+        self.partitions = {p: PartitionMetadata(p) for p in range(num_partitions)}
+        self.error = None
+
+
+class ClusterMetadata:
+    def __init__(self, topics: dict):
+        self.cluster_id = "fake-kafka"
+        self.controller_id = 0
+        self.brokers = dict()
+        self.topics = topics
+        self.orig_broker_name = "fake-kafka"
+
+
+class Broker:
+    """
+    Partitioned in-memory topics with consumer group offsets/assignments.
+
+    Topics are created on first use with `num_partitions` partitions. Consumers of
+    the same group split the partitions of their topics (partition index modulo the
+    number of members), rebalancing when a member joins or leaves.
+
+    Commit hooks, `hook(group, topic, partition, messages)`, are called whenever a
+    group commit moves past messages, e.g. to measure per-stage latency.
+    """
+
+    def __init__(self, num_partitions: int = DEFAULT_NUM_PARTITIONS):
+        self.num_partitions = num_partitions
+        self.condition = threading.Condition()
+        self.topics = dict()
+        self.committed = dict()
+        self.groups = dict()
+        self.generations = dict()
+        self.commit_hooks = list()
+        self.member_ids = itertools.count()
+
+    def create_topic(self, topic: str, num_partitions: int = None) -> bool:
+        with self.condition:
+            if topic in self.topics:
+                return False
+            self.topics[topic] = [list() for _ in range(num_partitions or self.num_partitions)]
+            return True
+
+    def partitions(self, topic: str) -> list:
+        with self.condition:
+            if topic not in self.topics:
+                self.create_topic(topic)
+            return self.topics[topic]
+
+    def append(
+        self,
+        topic: str,
+        partition: int,
+        key: bytes,
+        value: bytes,
+        headers: list = None,
+    ) -> Message:
+        with self.condition:
+            partitions = self.partitions(topic)
+            if partition is None or partition < 0:
+                if key is None:
+                    partition = sum(len(p) for p in partitions) % len(partitions)
+                else:
+                    partition = zlib.crc32(key) % len(partitions)
+            msg = Message(topic, partition, len(partitions[partition]), key, value, headers)
+            partitions[partition].append(msg)
+            self.condition.notify_all()
+            return msg
+
+    def watermarks(self, topic: str, partition: int) -> tuple:
+        with self.condition:
+            return (0, len(self.partitions(topic)[partition]))
+
+    def commit(self, group: str, topic: str, partition: int, offset: int):
+        with self.condition:
+            key = (group, topic, partition)
+            previous = self.committed.get(key, 0)
+            self.committed[key] = offset
+            messages = self.partitions(topic)[partition][previous:offset]
+        if messages:
+            for hook in self.commit_hooks:
+                hook(group, topic, partition, messages)
+
+    def committed_offset(self, group: str, topic: str, partition: int) -> int:
+        with self.condition:
+            return self.committed.get((group, topic, partition), OFFSET_INVALID)
+
+    def join(self, group: str, consumer):
+        with self.condition:
+            members = self.groups.setdefault(group, list())
+            if consumer not in members:
+                members.append(consumer)
+            self.generations[group] = self.generations.get(group, 0) + 1
+            self.condition.notify_all()
+
+    def leave(self, group: str, consumer):
+        with self.condition:
+            members = self.groups.get(group, list())
+            if consumer in members:
+                members.remove(consumer)
+                self.generations[group] = self.generations.get(group, 0) + 1
+                self.condition.notify_all()
+
+    def assignment(self, group: str, consumer) -> list:
+        """Partitions assigned to `consumer`: the ones whose index, modulo the number of members, is its own"""
+        with self.condition:
+            members = self.groups.get(group, list())
+            if consumer not in members:
+                return list()
+            index = members.index(consumer)
+            topics = sorted({t for m in members for t in m.topics})
+            all_partitions = [
+                (topic, partition)
+                for topic in topics
+                for partition in range(len(self.partitions(topic)))
+            ]
+            return [tp for i, tp in enumerate(all_partitions) if i % len(members) == index]
+
+    def metadata(self, topic: str = None) -> ClusterMetadata:
+        with self.condition:
+            names = list(self.topics) if topic is None else [t for t in (topic,) if t in self.topics]
+            return ClusterMetadata({
+                name: TopicMetadata(name, len(self.topics[name]))
+                for name in names
+            })
+
+
+class Producer:
+    """
+    Stand-in for confluent_kafka.Producer: events are appended to the broker straight
+    away, delivery callbacks are served by `poll`/`flush` like librdkafka does.
+    """
+
+    def __init__(self, config: dict, broker: Broker = None):
+        self.config = dict(config)
+        self.broker = broker or get_broker(config)
+        self.on_delivery = config.get("on_delivery")
+        self.max_queued = int(config.get("queue.buffering.max.messages", 100000))
+        self.lock = threading.Lock()
+        self.pending = list()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.pending)
+
+    def produce(
+        self,
+        topic: str,
+        value=None,
+        key=None,
+        partition: int = -1,
+        on_delivery=None,
+        callback=None,
+        timestamp: int = 0,
+        headers=None,
+    ):
+        with self.lock:
+            if len(self.pending) >= self.max_queued:
+                raise BufferError("Local: Queue full")
+        if isinstance(key, str):
+            key = key.encode()
+        if isinstance(value, str):
+            value = value.encode()
+        if isinstance(headers, dict):
+            headers = list(headers.items())
+        msg = self.broker.append(topic, partition, key, value, headers)
+        with self.lock:
+            self.pending.append((on_delivery or callback or self.on_delivery, msg))
+
+    def poll(self, timeout: float = None) -> int:
+        with self.lock:
+            pending, self.pending = self.pending, list()
+        for on_delivery, msg in pending:
+            msg._latency = time.monotonic() - msg.appended_at
+            if on_delivery is not None:
+                on_delivery(None, msg)
+        if not pending and timeout:
+            time.sleep(min(timeout, 0.01) if timeout > 0 else 0.01)
+        return len(pending)
+
+    def flush(self, timeout: float = None) -> int:
+        self.poll(0)
+        return len(self)
+
+    def list_topics(self, topic: str = None, timeout: float = -1) -> ClusterMetadata:
+        return self.broker.metadata(topic)
+
+
+class Consumer:
+    """
+    Stand-in for confluent_kafka.Consumer (subscribe/poll/consume/commit, committed
+    offsets, watermarks and rebalance callbacks).
+    """
+
+    def __init__(self, config: dict, broker: Broker = None):
+        self.config = dict(config)
+        self.broker = broker or get_broker(config)
+        self.group = config.get("group.id", "")
+        self.offset_reset = config.get("auto.offset.reset", "latest")
+        self.member_id = next(self.broker.member_ids)
+        self.topics = list()
+        self.on_assign = None
+        self.on_revoke = None
+        self.generation = None
+        self.assigned = list()
+        self.positions = dict()
+        self.next_partition = 0
+        self.closed = False
+
+    def subscribe(self, topics: list, on_assign=None, on_revoke=None, on_lost=None):
+        self.topics = list(topics)
+        self.on_assign = on_assign
+        self.on_revoke = on_revoke
+        for topic in self.topics:
+            self.broker.partitions(topic)
+        self.broker.join(self.group, self)
+
+    def unsubscribe(self):
+        self.broker.leave(self.group, self)
+        self.topics = list()
+
+    def assignment(self) -> list:
+        return [TopicPartition(t, p) for t, p in self.assigned]
+
+    def _rebalance(self):
+        generation = self.broker.generations.get(self.group)
+        if generation == self.generation:
+            return
+        self.generation = generation
+        assigned = self.broker.assignment(self.group, self)
+        if self.on_revoke is not None and self.assigned:
+            self.on_revoke(self, [TopicPartition(t, p) for t, p in self.assigned])
+        self.assigned = assigned
+        self.positions = dict()
+        for topic, partition in assigned:
+            offset = self.broker.committed_offset(self.group, topic, partition)
+            if offset == OFFSET_INVALID:
+                offset = 0 if self.offset_reset == "earliest" else self.broker.watermarks(topic, partition)[1]
+            self.positions[(topic, partition)] = offset
+        if self.on_assign is not None:
+            self.on_assign(self, [TopicPartition(t, p, self.positions[(t, p)]) for t, p in assigned])
+
+    def _next_message(self) -> Message:
+        for i in range(len(self.assigned)):
+            topic, partition = self.assigned[(self.next_partition + i) % len(self.assigned)]
+            messages = self.broker.topics[topic][partition]
+            position = self.positions[(topic, partition)]
+            if position < len(messages):
+                self.positions[(topic, partition)] = position + 1
+                self.next_partition = (self.next_partition + i + 1) % len(self.assigned)
+                return messages[position]
+        return None
+
+    def poll(self, timeout: float = None) -> Message:
+        messages = self.consume(1, -1 if timeout is None else timeout)
+        return messages[0] if messages else None
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> list:
+        if self.closed:
+            raise RuntimeError("Consumer closed")
+        end = None if timeout is None or timeout < 0 else time.monotonic() + timeout
+        messages = list()
+        with self.broker.condition:
+            while True:
+                self._rebalance()
+                while len(messages) < num_messages:
+                    msg = self._next_message()
+                    if msg is None:
+                        break
+                    messages.append(msg)
+                if messages:
+                    return messages
+                wait = None if end is None else end - time.monotonic()
+                if wait is not None and wait <= 0:
+                    return messages
+                self.broker.condition.wait(wait)
+
+    def commit(self, message=None, offsets: list = None, asynchronous: bool = True):
+        if message is not None:
+            offsets = [TopicPartition(message.topic(), message.partition(), message.offset() + 1)]
+        elif offsets is None:
+            with self.broker.condition:
+                offsets = [
+                    TopicPartition(topic, partition, offset)
+                    for (topic, partition), offset in self.positions.items()
+                ]
+        if not offsets:
+            raise KafkaException("Local: No offset stored")
+        for tp in offsets:
+            self.broker.commit(self.group, tp.topic, tp.partition, tp.offset)
+        return None if asynchronous else offsets
+
+    def committed(self, partitions: list, timeout: float = None) -> list:
+        return [
+            TopicPartition(
+                tp.topic,
+                tp.partition,
+                self.broker.committed_offset(self.group, tp.topic, tp.partition),
+            )
+            for tp in partitions
+        ]
+
+    def position(self, partitions: list) -> list:
+        with self.broker.condition:
+            return [
+                TopicPartition(
+                    tp.topic,
+                    tp.partition,
+                    self.positions.get((tp.topic, tp.partition), OFFSET_INVALID),
+                )
+                for tp in partitions
+            ]
+
+    def get_watermark_offsets(self, partition, timeout: float = None, cached: bool = False) -> tuple:
+        return self.broker.watermarks(partition.topic, partition.partition)
+
+    def list_topics(self, topic: str = None, timeout: float = -1) -> ClusterMetadata:
+        return self.broker.metadata(topic)
+
+    def close(self):
+        if not self.closed:
+            self.broker.leave(self.group, self)
+            self.closed = True
+
+
+class AdminClient:
+    """Stand-in for confluent_kafka.admin.AdminClient (topic metadata and creation)"""
+
+    def __init__(self, config: dict, broker: Broker = None):
+        self.config = dict(config)
+        self.broker = broker or get_broker(config)
+
+    def list_topics(self, topic: str = None, timeout: float = -1) -> ClusterMetadata:
+        return self.broker.metadata(topic)
+
+    def create_topics(self, new_topics: list, **kwargs) -> dict:
+        futures = dict()
+        for new_topic in new_topics:
+            future = Future()
+            if self.broker.create_topic(new_topic.topic, new_topic.num_partitions):
+                future.set_result(None)
+            else:
+                future.set_exception(
+                    KafkaException(f"Topic '{new_topic.topic}' already exists")
+                )
+            futures[new_topic.topic] = future
+        return futures
@@ -1,84 +1,454 @@
 import sys
+import json
+import time
+import asyncio
+import logging
 import requests
+import threading
 
 from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 from utils import log_exception
 
+
+class KsqlDBError(Exception):
+    """Error reported by ksqlDB (or the HTTP layer) while streaming a query"""
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StreamingQuery:
+    """
+    Rows of a `/query-stream` query (push or pull), parsed incrementally from the
+    line-delimited response (`application/vnd.ksqlapi.delimited.v1`): the first
+    line is the header (query id, column names/types), each following line a row.
+
+    Only the current chunk and one partial line are held in memory (a line longer
+    than `max_line_bytes` raises KsqlDBError). Iterating sends the request; `close()`
+    (from any thread, or when the generator is closed) cancels the query: the
+    connection is closed and, for push queries, ksqlDB is asked to terminate it
+    (`/close-query`).
+
+    Attributes:
+        query_id (str): Query id (push queries), set once the header is received.
+        columns (list): Column names, set once the header is received.
+        column_types (list): Column types, set once the header is received.
+    """
+
+    CONTENT_TYPE = "application/vnd.ksqlapi.delimited.v1"
+
+    def __init__(
+            self,
+            client,
+            sql: str,
+            properties: dict = None,
+            as_dict: bool = True,
+            read_timeout: float = None,
+            chunk_size: int = 8192,
+            max_line_bytes: int = 1024 * 1024,
+    ):
+        self.client = client
+        self.sql = sql
+        self.properties = properties or dict()
+        self.as_dict = as_dict
+        self.read_timeout = read_timeout
+        self.chunk_size = chunk_size
+        self.max_line_bytes = max_line_bytes
+        self.query_id = None
+        self.columns = None
+        self.column_types = None
+        self.response = None
+        self.closed = False
+        self.completed = False
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self.rows()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def rows(self):
+        if self.closed:
+            return
+        self.response = self.client.session.post(
+            f"{self.client.end_point}/query-stream",
+            data=json.dumps({"sql": self.sql, "properties": self.properties}),
+            headers={"Accept": self.CONTENT_TYPE, "Content-Type": self.CONTENT_TYPE},
+            stream=True,
+            timeout=(self.client.timeout[0], self.read_timeout),
+        )
+        try:
+            if self.response.status_code != 200:
+                raise KsqlDBError(
+                    f"Unable to stream query ({self.response.status_code}): {self.response.text}",
+                    self.response.status_code,
+                )
+            for line in self.lines():
+                row = self.parse(line)
+                if row is not None:
+                    yield row
+            self.completed = True
+        except Exception:
+            if self.closed:
+                # Connection closed by `close()` (cancellation)
+                return
+            raise
+        finally:
+            self.close()
+
+    def lines(self):
+        buffer = b""
+        for chunk in self.response.iter_content(chunk_size=self.chunk_size):
+            if self.closed:
+                return
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            if len(buffer) > self.max_line_bytes:
+                raise KsqlDBError(f"Row larger than {self.max_line_bytes} bytes")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+
+    def parse(self, line: bytes):
+        data = json.loads(line)
+        if isinstance(data, dict):
+            if "columnNames" in data:
+                self.query_id = data.get("queryId")
+                self.columns = data["columnNames"]
+                self.column_types = data.get("columnTypes")
+                return None
+            if data.get("@type") in ("generic_error", "statement_error") or "error_code" in data:
+                raise KsqlDBError(data.get("message", str(data)), data.get("error_code"))
+            return data
+        if self.as_dict and self.columns is not None:
+            return dict(zip(self.columns, data))
+        return data
+
+    def close(self):
+        """Cancels the query (idempotent, thread safe)"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.response is not None:
+            try:
+                self.response.close()
+            except Exception:
+                pass
+        if self.query_id is not None and not self.completed:
+            status_code, response = self.client._request(
+                method="POST",
+                path="close-query",
+                json={"queryId": self.query_id},
+            )
+            if status_code != 200:
+                logging.warning(f"Unable to close ksqlDB query '{self.query_id}' ({status_code}): {response}")
+
+
 class KsqlDB:
+    """
+    ksqlDB REST client holding a pooled keep-alive session (TCP/TLS connections are
+    reused across statements).
+
+    Connection errors, as well as HTTP 429/503 responses (statement not executed),
+    are retried with an exponential backoff (`backoff_factor` * 2^(retry - 1) seconds,
+    honouring any Retry-After header). Requests which may have reached ksqlDB (read
+    timeouts) are not retried, so a statement is never executed twice.
+
+    Args:
+        end_point (str, optional): ksqlDB endpoint. Defaults to "http://localhost:8088".
+        username (str, optional): Basic auth username. Defaults to "admin".
+        password (str, optional): Basic auth password. Defaults to "admin".
+        pool_size (int, optional): Maximum number of keep-alive connections. Defaults to 10.
+        connect_timeout (float, optional): Seconds to establish a connection. Defaults to 3.05.
+        read_timeout (float, optional): Seconds to wait for the server to respond. Defaults to 30.
+        retries (int, optional): Maximum number of retries. Defaults to 3.
+        backoff_factor (float, optional): Base of the retry backoff, in seconds. Defaults to 0.5.
+    """
+
+    RETRY_STATUS = (429, 503)
+
     def __init__(
             self,
             end_point:str = "http://localhost:8088",
             username:str = "admin",
-            password:str = "admin"
-           
+            password:str = "admin",
+            pool_size: int = 10,
+            connect_timeout: float = 3.05,
+            read_timeout: float = 30,
+            retries: int = 3,
+            backoff_factor: float = 0.5,
     ):
         self.end_point = end_point.strip("/")
         if None not in (username, password):
             self.auth = HTTPBasicAuth(username, password)
         else:
             self.auth = None
-    
+        self.timeout = (connect_timeout, read_timeout)
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=retries,
+                status_forcelist=self.RETRY_STATUS,
+                allowed_methods=frozenset(("GET", "POST")),
+                backoff_factor=backoff_factor,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        )
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers.update(
+            {
+                "Content-Type": "application/vnd.ksql.v1+json",
+                "Accept": "application/vnd.ksql.v1+json",
+            }
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """
+        Creates a client from the `[ksqldb]` section of a Kafka configuration file
+        (`endpoint`, `username`, `password` and, optionally, `pool_size`, `connect_timeout`,
+        `read_timeout`, `retries` and `backoff_factor`).
+        """
+        kwargs = dict()
+        for key, cast in (
+            ("pool_size", int),
+            ("connect_timeout", float),
+            ("read_timeout", float),
+            ("retries", int),
+            ("backoff_factor", float),
+        ):
+            if config.get(key) not in (None, ""):
+                kwargs[key] = cast(config[key])
+        return cls(
+            end_point=config["endpoint"],
+            username=config.get("username"),
+            password=config.get("password"),
+            **kwargs,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Closes the pooled connections"""
+        self.session.close()
+
     def _request(
             self,
             method:str = "GET",
             path: str = "",
             query: dict = None,
             headers: dict = None,
-            json: dict = None
+            json: dict = None,
+            timeout: tuple = None,
     ) -> tuple:
-        if not isinstance(headers, dict):
-            headers = dict()
-        headers_request = {
-            "Content-Type": "application/vnd.ksql.v1+json",
-            "Accept": "application/vnd.ksql.v1+json",
-        }
-        headers_request.update(headers)
         if isinstance(query, dict):
             query_string = f"?{urlencode(query)}"
         else:
-            quaery_string = ""
+            query_string = ""
         url = f"""{self.end_point}/{path.lstrip("/")}{query_string}"""
+        status_code, response = None, None
         try:
-            if method == "GET":
-                response = requests.get(
-                    url,
-                    auth=self.auth,
-                    headers=headers_request
-                )
-            elif method == "POST":
-                response = requests.post(
-                    url,
-                    auth=self.auth,
-                    headers=headers_request,
-                    json=json
-                )
-            else:
+            if method not in ("GET", "POST"):
                 raise ValueError(f"Method {method} not supported")
-            return response.status_code, response.json()
+            r = self.session.request(
+                method,
+                url,
+                headers=headers,
+                json=json,
+                timeout=timeout or self.timeout,
+            )
+            status_code = r.status_code
+            response = r.json()
+
         except requests.exceptions.Timeout:
-            response = None
             status_code = 408
+            logging.error(f"Unable to send {method} request ({status_code}): {url}")
 
         except Exception:
-            response = None
-            try:
-                status_code = r.status_code
-            except Exception:
-                status_code = 502
+            status_code = status_code or 502
             log_exception(
                 f"Unable to send {method} request ({status_code}): {url}",
                 sys.exc_info(),
             )
 
-        finally:
-            return status_code, response
+        return status_code, response
 
     def query(self, query: dict) -> tuple:
         return self._request(
+            method="POST",
             path="ksql",
             json=query,
         )
-            
 
+    def bulk(
+            self,
+            statements: list,
+            streams_properties: dict = None,
+            stop_on_error: bool = True,
+    ) -> list:
+        """
+        Submits statements one after the other over the pooled connection (e.g. the
+        stream/table bootstrap DDL). Each request carries the command sequence number
+        of the previous statement, so ksqlDB only runs a statement once the ones it
+        depends on are executed.
+
+        Args:
+            statements (list): ksqlDB statements, in execution order.
+            streams_properties (dict, optional): `streamsProperties` sent with each statement.
+            stop_on_error (bool, optional): Stop at the first failed statement. Defaults to True.
+
+        Returns:
+            list: One dict per statement submitted: {"statement", "status_code", "response", "seconds"}.
+        """
+        results = list()
+        command_sequence_number = None
+        started = time.perf_counter()
+        for statement in statements:
+            payload = {
+                "ksql": statement,
+                "streamsProperties": streams_properties or dict(),
+            }
+            if command_sequence_number is not None:
+                payload["commandSequenceNumber"] = command_sequence_number
+            statement_started = time.perf_counter()
+            status_code, response = self.query(payload)
+            results.append(
+                {
+                    "statement": statement,
+                    "status_code": status_code,
+                    "response": response,
+                    "seconds": round(time.perf_counter() - statement_started, 6),
+                }
+            )
+            if isinstance(response, list):
+                for item in response:
+                    if isinstance(item, dict) and item.get("commandSequenceNumber") is not None:
+                        command_sequence_number = item["commandSequenceNumber"]
+            if status_code == 200:
+                logging.debug(f"ksqlDB ({status_code}, {results[-1]['seconds']:.3f}s): {statement}")
+            else:
+                logging.error(f"ksqlDB ({status_code}, {results[-1]['seconds']:.3f}s): {statement} -> {response}")
+                if stop_on_error:
+                    break
+        logging.info(
+            f"ksqlDB: {sum(1 for r in results if r['status_code'] == 200)}/{len(statements)} statement(s) executed in {time.perf_counter() - started:.3f}s"
+        )
+        return results
+
+    def stream_query(
+            self,
+            sql: str,
+            properties: dict = None,
+            as_dict: bool = True,
+            read_timeout: float = None,
+            max_line_bytes: int = 1024 * 1024,
+    ) -> StreamingQuery:
+        """
+        Streams the rows of a push or pull query (`/query-stream`) as they arrive.
+
+        Example:
+            with ksql.stream_query("SELECT * FROM PIZZA_STATUS EMIT CHANGES;") as query:
+                for row in query:
+                    ...
+
+        Args:
+            sql (str): The query.
+            properties (dict, optional): Query properties, e.g. {"auto.offset.reset": "earliest"}.
+            as_dict (bool, optional): Yield rows as {column: value} instead of lists. Defaults to True.
+            read_timeout (float, optional): Maximum seconds between two chunks. Defaults to None (wait forever).
+            max_line_bytes (int, optional): Maximum size of a row. Defaults to 1 MiB.
+
+        Returns:
+            StreamingQuery: Iterable of the rows, `close()` cancels the query.
+        """
+        return StreamingQuery(
+            self,
+            sql,
+            properties=properties,
+            as_dict=as_dict,
+            read_timeout=read_timeout,
+            max_line_bytes=max_line_bytes,
+        )
+
+    async def astream_query(
+            self,
+            sql: str,
+            properties: dict = None,
+            as_dict: bool = True,
+            read_timeout: float = None,
+            max_line_bytes: int = 1024 * 1024,
+            max_queued: int = 100,
+    ):
+        """
+        Asyncio variant of `stream_query` (async generator). The response is read
+        by a helper thread over the pooled session, at most `max_queued` rows ahead
+        of the consumer. Cancelling the task (or closing the generator) cancels the
+        query.
+
+        Example:
+            async for row in ksql.astream_query("SELECT * FROM PIZZA_STATUS EMIT CHANGES;"):
+                ...
+        """
+        query = self.stream_query(
+            sql,
+            properties=properties,
+            as_dict=as_dict,
+            read_timeout=read_timeout,
+            max_line_bytes=max_line_bytes,
+        )
+        loop = asyncio.get_running_loop()
+        rows = asyncio.Queue()
+        slots = threading.Semaphore(max(1, max_queued))
+        end = object()
+
+        def pump():
+            try:
+                for row in query:
+                    while not slots.acquire(timeout=0.5):
+                        if query.closed:
+                            return
+                    loop.call_soon_threadsafe(rows.put_nowait, (row, None))
+                loop.call_soon_threadsafe(rows.put_nowait, (end, None))
+            except Exception as err:
+                loop.call_soon_threadsafe(rows.put_nowait, (end, err))
+            except BaseException:
+                pass
+
+        thread = threading.Thread(target=pump, name="ksqldb_stream", daemon=True)
+        thread.start()
+        try:
+            while True:
+                row, err = await rows.get()
+                if row is end:
+                    if err is not None:
+                        raise err
+                    return
+                slots.release()
+                yield row
+        finally:
+            await loop.run_in_executor(None, query.close)
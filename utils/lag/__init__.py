@@ -0,0 +1,232 @@
+import math
+import time
+import logging
+import threading
+
+from utils.metrics import REGISTRY
+
+
+def recommend_workers(
+    lag: int,
+    produce_rate: float,
+    drain_rate: float,
+    workers: int,
+    partitions: int,
+    target_drain_seconds: float,
+) -> int:
+    """
+    Number of workers needed for a consumer group to keep up with the producers and
+    drain its current lag within `target_drain_seconds`, assuming each worker consumes
+    as fast as the current ones (`drain_rate / workers`). The result is between 1 and
+    the number of partitions (extra workers of a group would be idle).
+
+    When the group consumed nothing since the last sample, the current number of
+    workers is kept if there is no lag, else the maximum is recommended.
+    """
+    partitions = max(1, partitions)
+    workers = max(1, workers)
+    if drain_rate <= 0:
+        return min(workers, partitions) if lag <= 0 else partitions
+    required_rate = max(0, produce_rate) + max(0, lag) / max(1, target_drain_seconds)
+    return max(1, min(partitions, math.ceil(required_rate / (drain_rate / workers))))
+
+
+class LagMonitor:
+    """
+    Measures how far behind consumer groups are: every `interval_seconds` the committed
+    offset of each group and the high watermark of each partition of its topics are
+    collected, giving per partition the lag (high watermark - committed offset) and,
+    from the previous sample, the drain rate (offsets committed per second) and
+    produce rate (offsets appended per second). Per group, the number of workers
+    needed to drain the lag within `target_drain_seconds` is recommended.
+
+    Offsets are read by a probe consumer per group (created with the group's
+    `group.id` but never subscribed, so it does not join the group) and partition
+    counts from the cached topic metadata of the admin client (see
+    utils.get_topic_metadata), so this works with confluent_kafka as well as with
+    utils.fake_kafka. Topics which do not exist (yet) and partitions the group
+    never committed are skipped.
+
+    The last report is exported as gauges of utils.metrics.REGISTRY:
+    `consumer_group_lag{group,topic,partition}`, `consumer_group_drain_rate{group,topic}`
+    and `consumer_group_recommended_workers{group}`.
+
+    Args:
+        consumer_factory (callable): Returns a consumer for a group id, `consumer_factory(group)`.
+        admin_client: Admin client (topic metadata).
+        groups (dict): Topics of each consumer group, {group: [topic, ...]}.
+        workers (dict, optional): Current number of workers of each group. Defaults to 1.
+        interval_seconds (float, optional): Seconds between two samples (thread). Defaults to 60.
+        target_drain_seconds (float, optional): Time to drain the lag used for the recommendation. Defaults to 300.
+    """
+
+    def __init__(
+        self,
+        consumer_factory,
+        admin_client,
+        groups: dict,
+        workers: dict = None,
+        interval_seconds: float = 60,
+        target_drain_seconds: float = 300,
+    ):
+        from utils import get_topic_metadata
+
+        self.consumer_factory = consumer_factory
+        self.admin_client = admin_client
+        self.topic_metadata = get_topic_metadata(admin_client)
+        self.groups = {group: list(topics) for group, topics in groups.items()}
+        self.workers = workers or dict()
+        self.interval_seconds = interval_seconds
+        self.target_drain_seconds = target_drain_seconds
+        self.consumers = dict()
+        self.previous = dict()
+        self.report = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def partitions(self, topic: str) -> int:
+        return self.topic_metadata.partitions(topic) or 0
+
+    def consumer(self, group: str):
+        if group not in self.consumers:
+            self.consumers[group] = self.consumer_factory(group)
+        return self.consumers[group]
+
+    def sample(self) -> dict:
+        """
+        Collects the offsets of every group once.
+
+        Returns:
+            dict: {
+                "timestamp": seconds since the epoch,
+                "groups": {group: {
+                    "lag": total lag,
+                    "drain_rate": offsets committed per second (None on the first sample),
+                    "produce_rate": offsets appended per second (None on the first sample),
+                    "partitions": number of partitions of the group's topics,
+                    "workers": current number of workers,
+                    "recommended_workers": recommended number of workers (None on the first sample),
+                    "topics": {topic: {"lag", "drain_rate", "produce_rate", "partitions": {partition: {"committed", "high", "lag"}}}},
+                }},
+            }
+        """
+        from confluent_kafka import TopicPartition
+
+        now = time.time()
+        report = {"timestamp": now, "groups": dict()}
+        topic_partitions = {
+            topic: self.partitions(topic)
+            for topic in {t for topics in self.groups.values() for t in topics}
+        }
+
+        for group, topics in self.groups.items():
+            consumer = self.consumer(group)
+            group_report = {
+                "lag": 0,
+                "drain_rate": None,
+                "produce_rate": None,
+                "partitions": 0,
+                "workers": self.workers.get(group, 1),
+                "recommended_workers": None,
+                "topics": dict(),
+            }
+            for topic in topics:
+                if not topic_partitions[topic]:
+                    continue
+                partitions = [TopicPartition(topic, n) for n in range(topic_partitions[topic])]
+                topic_report = {"lag": 0, "drain_rate": None, "produce_rate": None, "partitions": dict()}
+                committed_total = high_total = 0
+                for tp in consumer.committed(partitions, timeout=10):
+                    if tp.offset < 0:
+                        # Nothing committed by the group on this partition
+                        continue
+                    _, high = consumer.get_watermark_offsets(tp, timeout=10)
+                    lag = max(0, high - tp.offset)
+                    topic_report["partitions"][tp.partition] = {"committed": tp.offset, "high": high, "lag": lag}
+                    topic_report["lag"] += lag
+                    committed_total += tp.offset
+                    high_total += high
+                if not topic_report["partitions"]:
+                    continue
+
+                previous = self.previous.get((group, topic))
+                self.previous[(group, topic)] = (now, committed_total, high_total, set(topic_report["partitions"]))
+                if previous is not None and previous[3] == set(topic_report["partitions"]) and now > previous[0]:
+                    topic_report["drain_rate"] = round((committed_total - previous[1]) / (now - previous[0]), 3)
+                    topic_report["produce_rate"] = round((high_total - previous[2]) / (now - previous[0]), 3)
+                    for k in ("drain_rate", "produce_rate"):
+                        group_report[k] = (group_report[k] or 0) + topic_report[k]
+
+                group_report["topics"][topic] = topic_report
+                group_report["lag"] += topic_report["lag"]
+                group_report["partitions"] = max(group_report["partitions"], topic_partitions[topic])
+
+            if group_report["drain_rate"] is not None:
+                group_report["recommended_workers"] = recommend_workers(
+                    group_report["lag"],
+                    group_report["produce_rate"],
+                    group_report["drain_rate"],
+                    group_report["workers"],
+                    group_report["partitions"],
+                    self.target_drain_seconds,
+                )
+            report["groups"][group] = group_report
+
+        self.report = report
+        self.export(report)
+        return report
+
+    def export(self, report: dict):
+        for group, group_report in report["groups"].items():
+            for topic, topic_report in group_report["topics"].items():
+                for partition, partition_report in topic_report["partitions"].items():
+                    REGISTRY.gauge(
+                        "consumer_group_lag",
+                        help="Committed offset lag of a consumer group (lag monitor)",
+                        labels={"group": group, "topic": topic, "partition": str(partition)},
+                    ).set(partition_report["lag"])
+                if topic_report["drain_rate"] is not None:
+                    REGISTRY.gauge(
+                        "consumer_group_drain_rate",
+                        help="Offsets committed per second by a consumer group (lag monitor)",
+                        labels={"group": group, "topic": topic},
+                    ).set(topic_report["drain_rate"])
+            if group_report["recommended_workers"] is not None:
+                REGISTRY.gauge(
+                    "consumer_group_recommended_workers",
+                    help="Workers needed by a consumer group to drain its lag (lag monitor)",
+                    labels={"group": group},
+                ).set(group_report["recommended_workers"])
+
+    def log(self, report: dict):
+        for group, group_report in report["groups"].items():
+            logging.info(
+                f"Consumer group '{group}': lag={group_report['lag']}, drain_rate={group_report['drain_rate']}/s, "
+                f"produce_rate={group_report['produce_rate']}/s, workers={group_report['workers']}, "
+                f"recommended_workers={group_report['recommended_workers']}"
+            )
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.log(self.sample())
+            except Exception as err:
+                logging.error(f"Unable to collect consumer group lag: {err}")
+            self.stopped.wait(self.interval_seconds)
+
+    def start(self):
+        """Samples every `interval_seconds` from a daemon thread"""
+        self.thread = threading.Thread(target=self.run, name="lag_monitor", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout: float = 30):
+        """Stops the thread (waiting up to `timeout` seconds for the current sample) and closes the probe consumers"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        for consumer in self.consumers.values():
+            try:
+                consumer.close()
+            except Exception:
+                pass
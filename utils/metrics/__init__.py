@@ -0,0 +1,403 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import functools
+import collections
+
+
+# Latency buckets (seconds), from 0.5 ms up to 1 minute
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+
+def labels_key(labels: dict) -> tuple:
+    return tuple(sorted((labels or dict()).items()))
+
+
+def labels_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter"""
+
+    kind = "counter"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Value that can go up and down (last value set wins)"""
+
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets (upper bounds, Prometheus style). Observing a
+    value is a binary search plus an increment, so it is cheap enough to time
+    every event/DB call in production.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the seconds spent in its block"""
+        return Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """Estimated quantile (upper bound of the bucket it falls in)"""
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank, cumulative = q * count, 0
+        for i, c in enumerate(counts):
+            cumulative += c
+            if cumulative >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, buckets = 0, dict()
+        for bound, c in zip((*self.buckets, "+Inf"), counts):
+            cumulative += c
+            buckets[str(bound)] = cumulative
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Registry:
+    """
+    Process wide set of metrics, identified by name and labels. Metrics are
+    created on first use and can be exported as Prometheus text or as a JSON
+    snapshot.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = dict()
+        self.help = dict()
+
+    def get(self, metric_class, name: str, help: str = None, labels: dict = None, **kwargs):
+        key = (name, labels_key(labels))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = metric_class(**kwargs)
+                    if help:
+                        self.help.setdefault(name, help)
+        return metric
+
+    def counter(self, name: str, help: str = None, labels: dict = None) -> Counter:
+        return self.get(Counter, name, help=help, labels=labels)
+
+    def gauge(self, name: str, help: str = None, labels: dict = None) -> Gauge:
+        return self.get(Gauge, name, help=help, labels=labels)
+
+    def histogram(self, name: str, help: str = None, labels: dict = None, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.get(Histogram, name, help=help, labels=labels, buckets=buckets)
+
+    def items(self) -> list:
+        with self.lock:
+            return sorted(self.metrics.items(), key=lambda item: (item[0][0], str(item[0][1])))
+
+    def snapshot(self) -> dict:
+        """JSON-serialisable snapshot: {name: {labels: value}}"""
+        data = dict()
+        for (name, labels), metric in self.items():
+            data.setdefault(name, dict())[labels_text(labels) or "{}"] = metric.snapshot()
+        return {"timestamp": int(time.time() * 1000), "metrics": data}
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines, described = list(), set()
+        for (name, labels), metric in self.items():
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == "histogram":
+                data = metric.snapshot()
+                for bound, cumulative in data["buckets"].items():
+                    lines.append(f"{name}_bucket{labels_text((*labels, ('le', bound)))} {cumulative}")
+                lines.append(f"{name}_sum{labels_text(labels)} {data['sum']}")
+                lines.append(f"{name}_count{labels_text(labels)} {data['count']}")
+            else:
+                lines.append(f"{name}{labels_text(labels)} {metric.snapshot()}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def timed_methods(prefix: str, registry: Registry = REGISTRY):
+    """
+    Class decorator timing every public method of a class, see `timed`
+    (context managers, e.g. `transaction`, are left as they are).
+    """
+
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith("_") or not callable(method) or isinstance(method, (staticmethod, classmethod, type)):
+                continue
+            if getattr(method, "__wrapped__", None) is not None:
+                continue
+            setattr(cls, name, timed(prefix, name=name, registry=registry)(method))
+        return cls
+
+    return decorate
+
+
+def timed(prefix: str, name: str = None, label: str = "method", registry: Registry = REGISTRY):
+    """
+    Function decorator measuring its duration (histogram `<prefix>_seconds`) and
+    counting the calls raising an exception (`<prefix>_errors_total`), both
+    labelled `<label>=<name>` (defaults to the function name).
+    """
+
+    def decorate(function):
+        labels = {label: name or function.__name__}
+        histogram = registry.histogram(
+            f"{prefix}_seconds",
+            help=f"Duration of the {prefix.replace('_', ' ')} calls",
+            labels=labels,
+        )
+        errors = registry.counter(
+            f"{prefix}_errors_total",
+            help=f"Number of {prefix.replace('_', ' ')} calls raising an exception",
+            labels=labels,
+        )
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorate
+
+
+class InstrumentedConsumer:
+    """
+    Wraps a Kafka consumer measuring:
+    - `consumer_poll_seconds`: duration of `poll`/`consume` calls returning events
+    - `consumer_events_total`: events received (per topic)
+    - `consumer_lag`: events behind the high watermark (per topic/partition, from
+      the client's cached watermarks so no broker round trip is made)
+    - `consumer_poll_to_commit_seconds`: time from the oldest uncommitted event
+      being received until its offset is committed
+
+    Any other attribute is the wrapped consumer's.
+    """
+
+    def __init__(self, consumer, registry: Registry = REGISTRY):
+        self.consumer = consumer
+        self.registry = registry
+        self.poll_seconds = registry.histogram(
+            "consumer_poll_seconds",
+            help="Duration of the consumer poll/consume calls returning events",
+        )
+        self.poll_to_commit_seconds = registry.histogram(
+            "consumer_poll_to_commit_seconds",
+            help="Time from an event being received until its offset is committed",
+        )
+        self.lock = threading.Lock()
+        self.uncommitted_since = None
+
+    def __getattr__(self, name):
+        return getattr(self.consumer, name)
+
+    def poll(self, *args, **kwargs):
+        started = time.perf_counter()
+        msg = self.consumer.poll(*args, **kwargs)
+        if msg is not None:
+            self.received(started, [msg])
+        return msg
+
+    def consume(self, *args, **kwargs) -> list:
+        started = time.perf_counter()
+        messages = self.consumer.consume(*args, **kwargs)
+        if messages:
+            self.received(started, messages)
+        return messages
+
+    def commit(self, *args, **kwargs):
+        result = self.consumer.commit(*args, **kwargs)
+        with self.lock:
+            since, self.uncommitted_since = self.uncommitted_since, None
+        if since is not None:
+            self.poll_to_commit_seconds.observe(time.perf_counter() - since)
+        return result
+
+    def received(self, started: float, messages: list):
+        now = time.perf_counter()
+        self.poll_seconds.observe(now - started)
+        with self.lock:
+            if self.uncommitted_since is None:
+                self.uncommitted_since = now
+        counts, last = collections.Counter(), dict()
+        for msg in messages:
+            if msg.error() is None:
+                counts[msg.topic()] += 1
+                last[(msg.topic(), msg.partition())] = msg
+        for topic, count in counts.items():
+            self.registry.counter(
+                "consumer_events_total",
+                help="Number of events received",
+                labels={"topic": topic},
+            ).inc(count)
+        if last:
+            from confluent_kafka import TopicPartition
+        for (topic, partition), msg in last.items():
+            try:
+                _, high = self.consumer.get_watermark_offsets(
+                    TopicPartition(topic, partition),
+                    cached=True,
+                )
+            except Exception:
+                continue
+            if high is not None and high >= 0:
+                self.registry.gauge(
+                    "consumer_lag",
+                    help="Number of events behind the high watermark",
+                    labels={"topic": topic, "partition": partition},
+                ).set(max(0, high - msg.offset() - 1))
+
+
+class MetricsExporter:
+    """
+    Exports a registry periodically as a JSON snapshot file and/or on demand on
+    a Prometheus text endpoint (`GET /metrics`), from daemon threads.
+
+    Args:
+        snapshot_file (str, optional): Path of the JSON snapshot (written atomically). Defaults to None (disabled).
+        snapshot_interval_seconds (float, optional): Seconds between snapshots. Defaults to 15.
+        prometheus_port (int, optional): Port of the Prometheus endpoint. Defaults to 0 (disabled).
+        registry (Registry, optional): Defaults to the process registry.
+    """
+
+    def __init__(
+        self,
+        snapshot_file: str = None,
+        snapshot_interval_seconds: float = 15,
+        prometheus_port: int = 0,
+        registry: Registry = REGISTRY,
+    ):
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval_seconds = snapshot_interval_seconds
+        self.prometheus_port = prometheus_port
+        self.registry = registry
+        self.server = None
+
+    def start(self):
+        if self.snapshot_file and self.snapshot_interval_seconds > 0:
+            threading.Thread(target=self.run_snapshots, daemon=True).start()
+        if self.prometheus_port:
+            from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = registry.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("", self.prometheus_port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logging.info(f"Prometheus metrics endpoint: http://0.0.0.0:{self.prometheus_port}/metrics")
+        return self
+
+    def write_snapshot(self):
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_file, self.snapshot_file)
+
+    def run_snapshots(self):
+        while True:
+            time.sleep(self.snapshot_interval_seconds)
+            try:
+                self.write_snapshot()
+            except Exception as err:
+                logging.error(f"Unable to write metrics snapshot '{self.snapshot_file}': {err}")
@@ -0,0 +1,109 @@
+import time
+import heapq
+import itertools
+import threading
+
+
+class DeadlineScheduler:
+    """
+    In-process deadline scheduler (binary heap keyed by an id, e.g. order_id).
+
+    Each key has at most one active deadline: scheduling a key again replaces its
+    previous deadline and cancelling it drops it. Replaced/cancelled heap entries
+    are discarded lazily when they reach the top of the heap (or when the heap is
+    compacted), so `schedule` is O(log n), `cancel` is O(1) and popping each due
+    key is O(log n).
+
+    Thread safe: `schedule`/`cancel` can be called from the consumer thread while
+    a watchdog thread blocks on `wait_due`, which wakes up exactly at the earliest
+    deadline (or earlier if a sooner deadline is scheduled meanwhile).
+
+    Args:
+        clock (callable, optional): Returns the current time, in the same unit as the
+            deadlines (seconds as used by `wait_due`). Defaults to time.time.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = list()
+        self.deadlines = dict()
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.deadlines)
+
+    def __contains__(self, key) -> bool:
+        with self.condition:
+            return key in self.deadlines
+
+    def schedule(self, key, deadline: float):
+        """Sets (or replaces) the deadline of `key`"""
+        with self.condition:
+            entry = (deadline, next(self.counter), key)
+            self.deadlines[key] = entry
+            heapq.heappush(self.heap, entry)
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self._compact()
+            if self.heap[0] is entry:
+                # Earliest deadline changed, wake up any waiter to re-arm its timer
+                self.condition.notify_all()
+
+    def cancel(self, key) -> bool:
+        """
+        Cancels the deadline of `key`.
+
+        Returns:
+            bool: True if `key` had an active deadline, False otherwise.
+        """
+        with self.condition:
+            return self.deadlines.pop(key, None) is not None
+
+    def next_deadline(self) -> float:
+        """Returns the earliest active deadline (None if nothing is scheduled)"""
+        with self.condition:
+            self._discard_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float = None) -> list:
+        """Removes and returns the keys whose deadline is due, earliest first"""
+        with self.condition:
+            return self._pop_due(self.clock() if now is None else now)
+
+    def wait_due(self, timeout: float = None) -> list:
+        """
+        Blocks until at least one deadline is due and returns the due keys
+        (earliest first), or returns an empty list after `timeout` seconds.
+        """
+        with self.condition:
+            end = None if timeout is None else self.clock() + timeout
+            while True:
+                now = self.clock()
+                due = self._pop_due(now)
+                if due:
+                    return due
+                if end is not None and now >= end:
+                    return list()
+                self._discard_stale()
+                wait = None if end is None else end - now
+                if self.heap:
+                    wait = self.heap[0][0] - now if wait is None else min(wait, self.heap[0][0] - now)
+                self.condition.wait(wait)
+
+    def _pop_due(self, now: float) -> list:
+        due = list()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self.deadlines.get(entry[2]) is entry:
+                del self.deadlines[entry[2]]
+                due.append(entry[2])
+        return due
+
+    def _discard_stale(self):
+        while self.heap and self.deadlines.get(self.heap[0][2]) is not self.heap[0]:
+            heapq.heappop(self.heap)
+
+    def _compact(self):
+        self.heap = list(self.deadlines.values())
+        heapq.heapify(self.heap)
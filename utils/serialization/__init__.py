@@ -0,0 +1,128 @@
+import json
+import struct
+
+
+# Kafka header naming the encoding of an event value (absent = JSON)
+FORMAT_HEADER = "pizza-format"
+JSON = "json"
+STATUS_V1 = "status-v1"
+
+
+class JsonSerializer:
+    """UTF-8 JSON, readable by every consumer (and by ksqlDB streams declared with VALUE_FORMAT='JSON')"""
+
+    name = JSON
+    ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+    @classmethod
+    def encode(cls, value: dict) -> bytes:
+        return cls.ENCODER.encode(value).encode()
+
+    @staticmethod
+    def decode(data: bytes) -> dict:
+        return json.loads(data.decode())
+
+
+class StatusSerializer:
+    """
+    Compact binary encoding of status events {"status", "baking_time" (optional), "timestamp"},
+    12 bytes: status (uint16), baking_time (uint16, 0xFFFF if absent) and timestamp in
+    milliseconds (int64), network byte order. Raises ValueError for any other event.
+    """
+
+    name = STATUS_V1
+    STRUCT = struct.Struct("!HHq")
+    FIELDS = frozenset(("status", "baking_time", "timestamp"))
+    NO_BAKING_TIME = 0xFFFF
+
+    @classmethod
+    def encode(cls, value: dict) -> bytes:
+        if not cls.FIELDS.issuperset(value) or "status" not in value or "timestamp" not in value:
+            raise ValueError(f"Not a status event: {value}")
+        baking_time = value.get("baking_time")
+        try:
+            return cls.STRUCT.pack(
+                value["status"],
+                cls.NO_BAKING_TIME if baking_time is None else baking_time,
+                value["timestamp"],
+            )
+        except struct.error as err:
+            raise ValueError(f"Unable to encode status event {value}: {err}")
+
+    @classmethod
+    def decode(cls, data: bytes) -> dict:
+        status, baking_time, timestamp = cls.STRUCT.unpack(data)
+        if baking_time == cls.NO_BAKING_TIME:
+            return {"status": status, "timestamp": timestamp}
+        return {"status": status, "baking_time": baking_time, "timestamp": timestamp}
+
+
+SERIALIZERS = {
+    serializer.name: serializer
+    for serializer in (JsonSerializer, StatusSerializer)
+}
+
+
+def event_format(event) -> str:
+    """Encoding of an event value, from its `pizza-format` header (JSON if absent)"""
+    for key, value in event.headers() or list():
+        if key == FORMAT_HEADER:
+            return value.decode() if isinstance(value, bytes) else value
+    return JSON
+
+
+def deserialize(event) -> dict:
+    """
+    Decodes the value of an event according to its `pizza-format` header, so consumers
+    read events of producers using any of the formats (events without the header are JSON).
+
+    Raises:
+        ValueError: The format is unknown or the value cannot be decoded.
+    """
+    headers = event.headers()
+    if not headers:
+        return json.loads(event.value().decode())
+    name = event_format(event)
+    serializer = SERIALIZERS.get(name)
+    if serializer is None:
+        raise ValueError(f"Unknown event format '{name}'")
+    try:
+        return serializer.decode(event.value())
+    except ValueError:
+        raise
+    except Exception as err:
+        raise ValueError(f"Unable to decode {name} event: {err}")
+
+
+class EventSerializer:
+    """
+    Encodes the events produced to a topic.
+
+    With the `json` format values are plain JSON and carry no header (as before, so
+    consumers not aware of the header keep working). Other formats add the header
+    `pizza-format` and fall back to JSON for events they cannot encode. Only switch a
+    topic to a binary format once all of its consumers use `deserialize`; ksqlDB
+    streams reading the topic need JSON.
+
+    Args:
+        format (str, optional): One of SERIALIZERS ("json", "status-v1"). Defaults to "json".
+    """
+
+    def __init__(self, format: str = JSON):
+        if format not in SERIALIZERS:
+            raise ValueError(f"Unknown event format '{format}', expected one of {list(SERIALIZERS)}")
+        self.format = format
+        self.serializer = SERIALIZERS[format]
+        self.header = (FORMAT_HEADER, format.encode())
+
+    def serialize(self, value: dict, headers: list = None) -> tuple:
+        """
+        Returns:
+            tuple: (value as bytes, headers to produce the event with, None if there are none)
+        """
+        if self.serializer is not JsonSerializer:
+            try:
+                return self.serializer.encode(value), (headers or list()) + [self.header]
+            except ValueError:
+                pass
+        return JsonSerializer.encode(value), headers
@@ -0,0 +1,142 @@
+# Results of StatusEngine.transition
+ACCEPTED = 0
+DUPLICATE = 1  # Same status again (redelivered event)
+BACKWARD = 2  # Status preceding the current one (late event)
+FINAL = 3  # The order already reached a terminal status
+UNKNOWN = 4  # Status not in [status-id]
+
+TRANSITION_NAMES = ("accepted", "duplicate", "backward", "final", "unknown")
+
+
+class StatusEngine:
+    """
+    Order status state machine, compiled once from `[status-id]`/`[status-label]` and
+    `[state-store-orders] status_completed_when`.
+
+    Statuses are mapped to small indexes (a list indexed by status code gives the
+    index), and the result of every transition is precomputed in a table indexed by
+    [current][new], so checking an event against the order's current status (as
+    read with the order, e.g. from the OrderCache) is two list lookups and no
+    state store round-trip. Labels ("<label> (<code>)") are precomputed too.
+
+    Rules:
+        - The progress statuses only move forward: order_placed -> pending ->
+          pizza_assembled -> pizza_baked -> delivered (steps may be skipped).
+        - stuck, cancelled, something_wrong and unknown can be reached from any
+          non-terminal status.
+        - The completed statuses (`status_completed_when`, the ones the state store
+          queries consider finished, delivered and cancelled by default) are terminal.
+        - stuck, something_wrong and unknown are not terminal (unless completed): the
+          order still moves forward when its next valid status arrives, e.g. after
+          an event which could not be parsed.
+        - An order without status accepts any known status.
+
+    Args:
+        status_ids (dict): `[status-id]` ({name: code}).
+        status_labels (dict): `[status-label]` ({name: label}, "else" for unknown codes).
+        completed (list, optional): Codes of the terminal statuses. Defaults to delivered and cancelled.
+    """
+
+    PROGRESS = ("order_placed", "pending", "pizza_assembled", "pizza_baked", "delivered")
+    INTERRUPTS = ("stuck", "cancelled", "something_wrong", "unknown")
+    COMPLETED = ("delivered", "cancelled")
+    # Statuses without a stuck order deadline besides the terminal ones (the watchdog does not track them)
+    UNTRACKED = ("stuck", "something_wrong", "unknown")
+
+    def __init__(self, status_ids: dict, status_labels: dict, completed: list = None):
+        self.status_ids = {name: int(code) for name, code in status_ids.items()}
+        self.names = list(self.status_ids)
+        self.codes = [self.status_ids[name] for name in self.names]
+        self.unknown_label = status_labels.get("else", "Oops! Unknown status")
+
+        # Status code -> index (-1 if unknown), index len(names) is "no status yet"
+        self.index = [-1] * (max(self.codes) + 1)
+        for n, code in enumerate(self.codes):
+            self.index[code] = n
+        self.none_index = len(self.names)
+
+        self.labels = [status_labels.get(name, "???") for name in self.names]
+        self.descriptions = [f"{label} ({code})" for label, code in zip(self.labels, self.codes)]
+        if completed is None:
+            completed = [self.status_ids[name] for name in self.COMPLETED if name in self.status_ids]
+        completed = {int(code) for code in completed}
+        self.terminal = bytearray(code in completed for code in self.codes)
+        self.settled = bytearray(
+            bool(terminal) or name in self.UNTRACKED
+            for name, terminal in zip(self.names, self.terminal)
+        )
+
+        # Rank of the progress statuses (stuck ranks lowest so a stuck order moves on)
+        rank = [-1] * len(self.names)
+        for r, name in enumerate(self.PROGRESS, start=1):
+            if name in self.status_ids:
+                rank[self.names.index(name)] = r
+        if "stuck" in self.status_ids:
+            rank[self.names.index("stuck")] = 0
+
+        self.table = list()
+        for current in range(len(self.names) + 1):
+            row = bytearray(len(self.names))
+            for new in range(len(self.names)):
+                if current == self.none_index:
+                    row[new] = ACCEPTED
+                elif current == new:
+                    row[new] = DUPLICATE
+                elif self.terminal[current]:
+                    row[new] = FINAL
+                elif self.names[new] in self.INTERRUPTS:
+                    row[new] = ACCEPTED
+                elif rank[new] > rank[current]:
+                    row[new] = ACCEPTED
+                else:
+                    row[new] = BACKWARD
+            self.table.append(row)
+
+    @classmethod
+    def from_config(cls, sys_config: dict):
+        return cls(
+            sys_config["status-id"],
+            sys_config["status-label"],
+            completed=sys_config["state-store-orders"]["status_completed_when"],
+        )
+
+    def _index(self, status) -> int:
+        if status is None:
+            return self.none_index
+        try:
+            status = int(status)
+            return self.index[status] if 0 <= status < len(self.index) else -1
+        except (TypeError, ValueError):
+            return -1
+
+    def transition(self, current, new) -> int:
+        """
+        Result of moving an order from its `current` status (None if it has none) to `new`:
+        ACCEPTED, DUPLICATE, BACKWARD, FINAL or UNKNOWN (`new` is not a configured status).
+        An unknown `current` status accepts any known status.
+        """
+        new_index = self._index(new)
+        if new_index < 0:
+            return UNKNOWN
+        current_index = self._index(current)
+        if current_index < 0:
+            current_index = self.none_index
+        return self.table[current_index][new_index]
+
+    def label(self, status) -> str:
+        n = self._index(status)
+        return self.labels[n] if 0 <= n < self.none_index else f"{self.unknown_label} ({status})"
+
+    def describe(self, status) -> str:
+        """"<label> (<code>)", e.g. for log lines"""
+        n = self._index(status)
+        return self.descriptions[n] if 0 <= n < self.none_index else f"{self.unknown_label} ({status})"
+
+    def is_terminal(self, status) -> bool:
+        n = self._index(status)
+        return 0 <= n < self.none_index and bool(self.terminal[n])
+
+    def is_settled(self, status) -> bool:
+        """Terminal or stuck, i.e. the order does not need a stuck order deadline"""
+        n = self._index(status)
+        return 0 <= n < self.none_index and bool(self.settled[n])
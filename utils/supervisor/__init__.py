@@ -0,0 +1,138 @@
+import os
+import time
+import signal
+import logging
+import subprocess
+
+
+# Environment variables set for each worker process
+ENV_WORKER_ID = "PIZZA_WORKER_ID"
+ENV_WORKERS = "PIZZA_WORKERS"
+
+
+def get_worker_id() -> int:
+    """Worker number (0..N-1) of the current process if started by a Supervisor, else None"""
+    worker_id = os.environ.get(ENV_WORKER_ID)
+    return None if worker_id in (None, "") else int(worker_id)
+
+
+class Worker:
+    def __init__(self, worker_id: int, command: list):
+        self.worker_id = worker_id
+        self.command = command
+        self.process = None
+        self.started_at = 0
+        self.restart_at = 0
+        self.restart_delay = 0
+
+    @property
+    def pid(self) -> int:
+        return None if self.process is None else self.process.pid
+
+    def start(self, workers: int):
+        env = dict(os.environ)
+        env[ENV_WORKER_ID] = str(self.worker_id)
+        env[ENV_WORKERS] = str(workers)
+        self.process = subprocess.Popen(self.command, env=env)
+        self.started_at = time.monotonic()
+
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+
+class Supervisor:
+    """
+    Runs N worker processes of a microservice script, each with its own consumer
+    in the same consumer group, so the topic partitions are spread across the
+    workers by Kafka's group rebalancing (one core per worker).
+
+    Workers exiting while the supervisor is running are restarted, with an
+    exponential backoff when they exit right after being started (crash loop).
+    On SIGINT/SIGTERM every worker is sent SIGTERM (their GracefulShutdown
+    flushes the producer, commits offsets and closes the consumer, which hands
+    their partitions over), the supervisor waits for them up to
+    `shutdown_timeout_seconds` and kills any worker left.
+
+    Args:
+        command (list): Command line of a worker, e.g. [sys.executable, "msvc_bake.py", "kafka.ini", "default.ini"].
+        workers (int): Number of worker processes.
+        restart_delay_seconds (float, optional): Initial delay before restarting a worker. Defaults to 1.
+        max_restart_delay_seconds (float, optional): Maximum restart delay (backoff). Defaults to 60.
+        shutdown_timeout_seconds (float, optional): Time given to the workers to shut down gracefully. Defaults to 30.
+    """
+
+    # Workers running for longer than this are considered healthy (their restart delay is reset)
+    HEALTHY_AFTER_SECONDS = 30
+
+    def __init__(
+        self,
+        command: list,
+        workers: int,
+        restart_delay_seconds: float = 1,
+        max_restart_delay_seconds: float = 60,
+        shutdown_timeout_seconds: float = 30,
+    ):
+        self.workers = [Worker(n, command) for n in range(max(1, workers))]
+        self.restart_delay_seconds = restart_delay_seconds
+        self.max_restart_delay_seconds = max_restart_delay_seconds
+        self.shutdown_timeout_seconds = shutdown_timeout_seconds
+        self.stopping = False
+
+    def start_worker(self, worker: Worker):
+        worker.start(len(self.workers))
+        logging.info(f"Worker #{worker.worker_id} started (PID {worker.pid})")
+
+    def signal_handler(self, sig, frame):
+        if not self.stopping:
+            logging.info(f"Starting graceful shutdown of {len(self.workers)} worker(s)...")
+        self.stopping = True
+
+    def run(self, poll_interval: float = 0.5) -> int:
+        """Starts the workers and supervises them until a shutdown signal is received"""
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        while not self.stopping:
+            time.sleep(poll_interval)
+            now = time.monotonic()
+            for worker in self.workers:
+                if self.stopping or worker.running():
+                    continue
+                if worker.restart_at == 0:
+                    # Worker just exited: schedule its restart
+                    if now - worker.started_at >= self.HEALTHY_AFTER_SECONDS:
+                        worker.restart_delay = self.restart_delay_seconds
+                    else:
+                        worker.restart_delay = min(
+                            self.max_restart_delay_seconds,
+                            max(self.restart_delay_seconds, worker.restart_delay * 2),
+                        )
+                    worker.restart_at = now + worker.restart_delay
+                    logging.warning(
+                        f"Worker #{worker.worker_id} (PID {worker.pid}) exited with code {worker.process.returncode}, restarting in {worker.restart_delay} second(s)"
+                    )
+                elif now >= worker.restart_at:
+                    worker.restart_at = 0
+                    self.start_worker(worker)
+
+        return self.shutdown()
+
+    def shutdown(self) -> int:
+        """Stops the workers gracefully (SIGTERM), killing those still running after the timeout"""
+        for worker in self.workers:
+            if worker.running():
+                worker.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout_seconds
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning(f"Worker #{worker.worker_id} (PID {worker.pid}) did not shut down in time, killing it")
+                worker.process.kill()
+                worker.process.wait()
+        logging.info("Graceful shutdown completed")
+        return 0
@@ -0,0 +1,126 @@
+import json
+import time
+
+
+# Kafka header carrying the trace context of an order
+TRACE_HEADER = "pizza-trace"
+
+
+class TraceContext:
+    """
+    Trace context of an order, propagated from stage to stage in the Kafka
+    header `pizza-trace` as {"order_id": ..., "hops": [[stage, timestamp_ms], ...]}.
+
+    Each stage appends a hop when it receives an order (e.g. "assemble_in") and
+    when it emits it (e.g. "assembled"), so the time between two consecutive hops
+    is either queueing (Kafka/ksqlDB) or work done by a microservice.
+    """
+
+    __slots__ = ("order_id", "hops")
+
+    def __init__(self, order_id: str, hops: list = None):
+        self.order_id = order_id
+        self.hops = hops or list()
+
+    @classmethod
+    def from_event(cls, event, origin: str = None):
+        """
+        Gets the trace context from the headers of an event. Without it (e.g. the
+        event was produced by a client not propagating traces), a new trace is
+        started, with a first hop `origin` (if set) at the event timestamp.
+
+        Returns:
+            TraceContext: The trace context, None if there is none and `origin` is not set.
+        """
+        for key, value in event.headers() or list():
+            if key == TRACE_HEADER:
+                try:
+                    data = json.loads(value)
+                    return cls(data["order_id"], [list(hop) for hop in data["hops"]])
+                except Exception:
+                    break
+        if origin is None:
+            return None
+        order_id = event.key().decode() if isinstance(event.key(), bytes) else event.key()
+        trace = cls(order_id)
+        _, timestamp = event.timestamp()
+        if timestamp and timestamp > 0:
+            trace.hop(origin, timestamp)
+        return trace
+
+    def hop(self, stage: str, timestamp: int = None):
+        """Appends a hop (timestamp in milliseconds, defaults to now)"""
+        self.hops.append([stage, int(time.time() * 1000) if timestamp is None else timestamp])
+        return self
+
+    def encode(self) -> bytes:
+        return json.dumps(
+            {"order_id": self.order_id, "hops": self.hops},
+            separators=(",", ":"),
+        ).encode()
+
+    def headers(self) -> list:
+        """Kafka headers to produce the next event of the order with"""
+        return [(TRACE_HEADER, self.encode())]
+
+    def latencies(self) -> dict:
+        """Returns {"<stage>-><next stage>": milliseconds} of each hop"""
+        return hop_latencies(self.hops)
+
+    def total(self) -> int:
+        """Milliseconds from the first to the last hop"""
+        return self.hops[-1][1] - self.hops[0][1] if len(self.hops) > 1 else 0
+
+
+def hop_latencies(hops: list) -> dict:
+    return {
+        f"{previous[0]}->{current[0]}": current[1] - previous[1]
+        for previous, current in zip(hops, hops[1:])
+    }
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def latency_report(traces: list) -> dict:
+    """
+    Latency distributions of a set of traces.
+
+    Args:
+        traces (list): Hops of each trace ([[stage, timestamp_ms], ...]).
+
+    Returns:
+        dict: {
+            "traces": number of traces,
+            "hops": {hop: {"count", "p50", "p99", "max", "mean"}} (milliseconds),
+            "total": {"count", "p50", "p99", "max", "mean"} (milliseconds),
+            "slowest": hop where the orders spend the most time overall (None if no hops),
+        }
+    """
+    per_hop, totals = dict(), list()
+    for hops in traces:
+        if len(hops) < 2:
+            continue
+        for hop, latency in hop_latencies(hops).items():
+            per_hop.setdefault(hop, list()).append(latency)
+        totals.append(hops[-1][1] - hops[0][1])
+
+    def distribution(values: list) -> dict:
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else 0,
+            "mean": round(sum(values) / len(values), 1) if values else 0,
+        }
+
+    return {
+        "traces": len(totals),
+        "hops": {hop: distribution(values) for hop, values in per_hop.items()},
+        "total": distribution(totals),
+        "slowest": max(per_hop, key=lambda hop: sum(per_hop[hop]), default=None),
+    }